@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+
+import socket
+import sys
+import time
+from collections import deque
+from threading import Condition, Thread
+
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from VCCommon import binary_message
+from VCCommon import clock
+from VCCommon import message
+from VCCommon import VCLogger
+
+logger = VCLogger.Logger(VCLogger.Level.ALL)
+
+KEY_ACTIONS = [message.Actions.PRESSED, message.Actions.RELEASED]
+CONTROL_ACTIONS = [
+    message.Actions.RELOAD_DEVICE,
+    message.Actions.STOP_SERVER,
+    message.Actions.STOP_CONTROLLER,
+    message.Actions.LATENCY,
+    message.Actions.HEARTBEAT,
+]
+
+class Connection(Thread):
+    """ TCP connection to a VirtualController server.
+    Frames for every (key, action) pair are encoded once, when the protocol is
+    negotiated, so sending a key is a dict lookup and a queue put. A background
+    thread sends everything queued with a single sendall(), and reconnects
+    when the connection is lost; frames queued meanwhile are kept in a bounded
+    buffer, the oldest ones being dropped first.
+    With timestamps, the offset between the local clock and the server's is
+    measured when connecting, and every key event carries its send time so
+    that the server can measure the network latency.
+    With a heartbeat_interval, a HEARTBEAT is sent whenever nothing else was
+    sent for that many seconds, so that a server with a heartbeat timeout
+    knows the client is alive. """
+
+    def __init__(
+        self,
+        host,
+        port,
+        protocol = message.Protocols.BINARY,
+        controller_id = None,
+        buffer_size = 1024,
+        reconnect_delay = 1.0,
+        timestamps = False,
+        clock_rounds = 5,
+        unix_path = None,
+        heartbeat_interval = None,
+    ):
+        """ If unix_path is set, connect to the Unix domain socket of a server
+        running on the same host instead of host and port. """
+        Thread.__init__(self)
+        self.daemon = True
+        self.host = host
+        self.port = port
+        self.requested_protocol = protocol
+        self.protocol = None
+        self.controller_id = controller_id
+        self.reconnect_delay = reconnect_delay
+        self.timestamps = timestamps
+        self.clock_rounds = clock_rounds
+        self.unix_path = unix_path
+        self.heartbeat_interval = heartbeat_interval
+        self.last_sent = clock.monotonic()
+        # Server time minus local time, None until measured
+        self.clock_offset = None
+        self.sock = None
+        self.frames = {}
+        self.queue = deque(maxlen = buffer_size)
+        self.cond = Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def connect(self):
+        """ Open the socket and negotiate the protocol. Raise socket.error on failure. """
+        if self.unix_path is not None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.unix_path)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.connect((self.host, self.port))
+        try:
+            if self.timestamps:
+                self.clock_offset = self.sync_clock(sock)
+            protocol = self.handshake(sock)
+        except socket.error:
+            sock.close()
+            raise
+
+        if self.protocol is not None and protocol != self.protocol:
+            with self.cond:
+                logger.warning('Protocol changed to {}, dropping {} queued frames.', protocol, len(self.queue))
+                self.dropped += len(self.queue)
+                self.queue.clear()
+        if protocol != self.protocol:
+            self.protocol = protocol
+            self.frames = self.encode_frames()
+        self.sock = sock
+        logger.connection_info('Connected to {}, using protocol {}', self.address(), protocol)
+
+    def address(self):
+        """ Describe the server address, for the log """
+        if self.unix_path is not None:
+            return 'Unix socket {}'.format(self.unix_path)
+        return 'host {} on port {}'.format(self.host, self.port)
+
+    def handshake(self, sock):
+        """ Ask the server for a protocol, and bind this connection to a controller.
+        Return the protocol the server agreed to use """
+        if self.requested_protocol == message.Protocols.JSON and self.controller_id is None:
+            return message.Protocols.JSON
+
+        hello = message.Message(
+            title = message.Titles.CONTROL,
+            value = self.requested_protocol,
+            action = message.Actions.HELLO,
+            status = message.StatusCodes.OK,
+            controller = self.controller_id,
+        )
+        sock.sendall(hello.format_frame())
+
+        reply = self.read_reply(sock, message.MessageParser())
+        if reply is not None and reply.action == message.Actions.HELLO:
+            return reply.value
+        logger.warning('Server did not answer the handshake, using JSON.')
+        return message.Protocols.JSON
+
+    def sync_clock(self, sock):
+        """ Measure the offset between the server's clock and the local one
+        with a few CLOCK exchanges, keeping the one with the shortest round
+        trip. Return None if the server does not answer. """
+        parser = message.MessageParser()
+        best_rtt = None
+        offset = None
+        for i in range(self.clock_rounds):
+            request = message.Message(
+                title = message.Titles.CONTROL,
+                value = clock.monotonic(),
+                action = message.Actions.CLOCK,
+                status = message.StatusCodes.OK,
+            )
+            sock.sendall(request.format_frame())
+            reply = self.read_reply(sock, parser)
+            received_at = clock.monotonic()
+            if reply is None or reply.action != message.Actions.CLOCK:
+                logger.warning('Server did not answer the clock request, sending no timestamps.')
+                return None
+            try:
+                sent_at, server_time = reply.value
+            except (TypeError, ValueError):
+                return None
+            rtt = received_at - sent_at
+            if best_rtt is None or rtt < best_rtt:
+                best_rtt = rtt
+                offset = server_time - (sent_at + received_at) / 2
+        logger.connection_info('Clock offset with the server: {:.6f}s (round trip {:.3f}ms)', offset, best_rtt * 1000)
+        return offset
+
+    def read_reply(self, sock, parser):
+        """ Wait for the next message from the server. Return None after 2 seconds. """
+        sock.settimeout(2)
+        try:
+            replies = []
+            while not replies:
+                data = sock.recv(255)
+                if not data:
+                    break
+                replies = parser.feed(data)
+        except socket.timeout:
+            replies = []
+        finally:
+            sock.settimeout(None)
+        return replies[0] if replies else None
+
+    def encode(self, title, value, action):
+        """ Encode a message in the negotiated protocol. Return None if it can't be encoded. """
+        if self.protocol == message.Protocols.BINARY:
+            return binary_message.encode(title, value, action)
+        msg = message.Message(
+            title = title,
+            value = value,
+            action = action,
+            status = message.StatusCodes.OK,
+        )
+        return msg.format_frame() or None
+
+    def encode_frames(self):
+        """ Return the frames of every key event and control message, by (key, action).
+        Keys are indexed by every spelling a client may use ('A', 'a', 'KEY.ENTER', 'Key.enter'). """
+        frames = {}
+        for name in binary_message.KEY_IDS:
+            spellings = set([name, name.lower()])
+            if name.startswith('KEY.'):
+                spellings.add('Key.' + name[4:].lower())
+            for action in KEY_ACTIONS:
+                frame = self.encode(message.Titles.EVENT, name, action)
+                for spelling in spellings:
+                    frames[(spelling, action)] = frame
+        for action in CONTROL_ACTIONS:
+            frames[(None, action)] = self.encode(message.Titles.CONTROL, '-', action)
+        return frames
+
+    def send_key(self, key_name, action):
+        """ Queue a key event. Return False if the key can't be sent with this protocol. """
+        frame = self.frames.get((key_name, action))
+        if frame is None:
+            frame = self.encode(message.Titles.EVENT, key_name, action)
+            if frame is None:
+                return False
+            self.frames[(key_name, action)] = frame
+        if self.clock_offset is not None:
+            frame = self.timestamped(frame, key_name, action)
+        self.put(frame)
+        return True
+
+    def timestamped(self, frame, key_name, action):
+        """ Return the frame of a key event carrying the current time on the server's clock """
+        timestamp = clock.monotonic() + self.clock_offset
+        if self.protocol == message.Protocols.BINARY:
+            return binary_message.encode_timestamp(timestamp) + frame
+        msg = message.Message(
+            title = message.Titles.EVENT,
+            value = key_name,
+            action = action,
+            status = message.StatusCodes.OK,
+            timestamp = timestamp,
+        )
+        return msg.format_frame()
+
+    def send_axis(self, axis_name, value):
+        """ Queue an axis value. Return False if the axis can't be sent with this protocol. """
+        if self.protocol == message.Protocols.BINARY:
+            frame = binary_message.encode_axis(axis_name, value)
+            if frame is None:
+                return False
+            if self.clock_offset is not None:
+                frame = binary_message.encode_timestamp(clock.monotonic() + self.clock_offset) + frame
+        else:
+            msg = message.Message(
+                title = message.Titles.EVENT,
+                value = [axis_name, value],
+                action = message.Actions.AXIS,
+                status = message.StatusCodes.OK,
+            )
+            if self.clock_offset is not None:
+                msg.timestamp = clock.monotonic() + self.clock_offset
+            frame = msg.format_frame()
+        self.put(frame)
+        return True
+
+    def send_control(self, action):
+        """ Queue a control message (one of CONTROL_ACTIONS) """
+        self.put(self.frames[(None, action)])
+
+    def put(self, frame):
+        with self.cond:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append(frame)
+            if len(self.queue) == 1:
+                self.cond.notify()
+
+    def run(self):
+        if self.heartbeat_interval:
+            heartbeat = Thread(target = self.send_heartbeats)
+            heartbeat.daemon = True
+            heartbeat.start()
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    break
+                frames = list(self.queue)
+                self.queue.clear()
+
+            protocol = self.protocol
+            if self.sock is None and not self.reconnect():
+                if self.closed:
+                    self.dropped += len(frames)
+                    break
+                self.requeue(frames)
+                continue
+            if self.protocol != protocol:
+                # Encoded for the previous server, which this one can't parse
+                logger.warning('Protocol changed to {}, dropping {} frames being sent.', self.protocol, len(frames))
+                self.dropped += len(frames)
+                continue
+            try:
+                self.sock.sendall(''.join(frames))
+                self.last_sent = clock.monotonic()
+            except socket.error as err:
+                logger.warning('Connection to {} lost.', self.address(), err = err)
+                self.sock.close()
+                self.sock = None
+                self.requeue(frames)
+
+    def send_heartbeats(self):
+        """ Queue a HEARTBEAT whenever the connection was idle for heartbeat_interval.
+        Runs in its own thread, so that the sending thread never waits with a timeout. """
+        while not self.closed:
+            idle = clock.monotonic() - self.last_sent
+            if idle >= self.heartbeat_interval:
+                frame = self.frames.get((None, message.Actions.HEARTBEAT))
+                if frame is not None and self.sock is not None:
+                    self.put(frame)
+                # Counted as sent, so that it is queued once per interval
+                self.last_sent = clock.monotonic()
+                idle = 0
+            time.sleep(self.heartbeat_interval - idle)
+
+    def requeue(self, frames):
+        """ Put frames that could not be sent back in front of the queue """
+        with self.cond:
+            room = self.queue.maxlen - len(self.queue)
+            if room < len(frames):
+                self.dropped += len(frames) - room
+                frames = frames[len(frames) - room:] if room else []
+            self.queue.extendleft(reversed(frames))
+
+    def reconnect(self):
+        """ Try to connect again. Return False after waiting reconnect_delay if it failed. """
+        if self.closed:
+            return False
+        try:
+            self.connect()
+            return True
+        except socket.error as err:
+            logger.warning('Could not reconnect to {}', self.address(), err = err)
+            time.sleep(self.reconnect_delay)
+            return False
+
+    def close(self):
+        """ Send the queued frames and close the connection """
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.is_alive():
+            self.join()
+        if self.sock:
+            logger.connection_info('Closing socket')
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock.close()
+            self.sock = None
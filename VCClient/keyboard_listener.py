@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from pynput import keyboard
+import argparse
 import socket
 import sys
 
@@ -10,24 +11,30 @@ sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 from VCCommon import message
 from VCCommon import VCLogger
 
-logger = VCLogger.Logger(VCLogger.Level.ALL)
-
-host = '192.168.1.80'
-port = 2010
+from VCCommon import shm_ring
 
-if len(sys.argv) > 2:
-    port = int(sys.argv[2])
-if len(sys.argv) > 1:
-    host = sys.argv[1]
+from connection import Connection
+from ring_sender import RingSender
+from udp_sender import UdpSender
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-try:
-    sock.connect((host, port))
-except socket.error as e:
-    logger.fatal('Could not connect to host {} on port {}'.format(host, port), e)
+logger = VCLogger.Logger(VCLogger.Level.ALL)
 
-logger.connection_info('Connected to host {} on port {}'.format(host, port))
+arg_parser = argparse.ArgumentParser(description = 'Send keyboard events to a VirtualController server')
+arg_parser.add_argument('host', nargs = '?', default = '192.168.1.80')
+arg_parser.add_argument('port', nargs = '?', type = int, default = 2010)
+arg_parser.add_argument('--protocol', choices = [message.Protocols.JSON, message.Protocols.BINARY],
+    default = message.Protocols.BINARY, help = 'protocol requested to the server (default: BINARY)')
+arg_parser.add_argument('--controller', type = int, help = 'id of the controller to bind to')
+arg_parser.add_argument('--udp-port', type = int,
+    help = 'send key events as UDP datagrams to this port; control messages still use TCP')
+arg_parser.add_argument('--unix-socket',
+    help = 'connect to the Unix domain socket of a server running on this host instead of host and port')
+arg_parser.add_argument('--shm-ring',
+    help = 'send key events through the shared-memory ring of a server running on this host; control messages still use the connection')
+arg_parser.add_argument('--timestamps', action = 'store_true',
+    help = 'send the time of every key event, so that the server can measure the network latency')
+arg_parser.add_argument('--heartbeat', type = float, metavar = 'SECONDS',
+    help = 'send a heartbeat when no key was sent for this long, for servers run with --heartbeat-timeout')
 
 def is_special_key(key):
     if isinstance(key, keyboard.Key):
@@ -42,64 +49,70 @@ def get_key_name(key):
     else:
         return key.char.encode('utf8')
 
-def send_key(key_name, action):
-    msg = message.Message(
-        title = message.Titles.EVENT,
-        value = key_name,
-        action = action,
-        status = message.StatusCodes.OK,
-    )
-    send_message(msg)
-
-def send_message(message):
-    json_message = message.format_json()
-    logger.info('Sending json_message = {}'.format(json_message))
-    if json_message:
-        sock.send(json_message)
-
-def on_press(key):
-    key_name = get_key_name(key)
-    send_key(key_name, message.Actions.PRESSED)
-
-def on_release(key):
-    key_name = get_key_name(key)
-
-    if key_name == 'Key.backspace':
-        logger.info('Requesting reload of VirtualController')
-        msg = message.Message(
-            title = message.Titles.CONTROL,
-            value = '-',
-            action = message.Actions.RELOAD_DEVICE,
-            status = message.StatusCodes.OK,
-        )
-        send_message(msg)
-    elif key_name == 'T':
-        logger.info('Requesting termination of this connection')
-        msg = message.Message(
-            title = message.Titles.CONTROL,
-            value = '-',
-            action = message.Actions.STOP_CONTROLLER,
-            status = message.StatusCodes.OK,
-        )
-        send_message(msg)
-    elif key_name == 'Key.esc':
-        logger.info('Requesting termination of VirtualController')
-        msg = message.Message(
-            title = message.Titles.CONTROL,
-            value = '-',
-            action = message.Actions.STOP_SERVER,
-            status = message.StatusCodes.OK,
-        )
-        send_message(msg)
-        return False
-    else:
-        send_key(key_name, message.Actions.RELEASED)
-
-with keyboard.Listener(
-    on_press = on_press,
-    on_release = on_release) as listener:
-    listener.join()
-
-logger.connection_info('Closing socket')
-sock.shutdown(2)
-sock.close()
+def main():
+    args = arg_parser.parse_args()
+
+    conn = Connection(args.host, args.port, args.protocol, args.controller,
+        timestamps = args.timestamps, unix_path = args.unix_socket, heartbeat_interval = args.heartbeat)
+    try:
+        conn.connect()
+    except socket.error as e:
+        logger.fatal('Could not connect to {}'.format(conn.address()), e)
+    conn.start()
+
+    ring_sender = None
+    if args.shm_ring:
+        try:
+            ring_sender = RingSender(args.shm_ring, args.controller, args.timestamps)
+        except shm_ring.RingError as e:
+            logger.fatal('Could not open the shared-memory ring', e)
+
+    udp_sender = None
+    if args.udp_port:
+        udp_sender = UdpSender(args.host, args.udp_port, args.controller)
+        udp_sender.start()
+        logger.connection_info('Sending key events to UDP port {}', args.udp_port)
+
+    def send_key(key_name, action):
+        if ring_sender and ring_sender.send_key(key_name, action):
+            return
+        if udp_sender and udp_sender.send_key(key_name, action):
+            return
+        if not conn.send_key(key_name, action):
+            logger.warning('Key {} can not be sent with protocol {}.', key_name, conn.protocol)
+
+    def on_press(key):
+        send_key(get_key_name(key), message.Actions.PRESSED)
+
+    def on_release(key):
+        key_name = get_key_name(key)
+
+        if key_name == 'Key.backspace':
+            logger.info('Requesting reload of VirtualController')
+            conn.send_control(message.Actions.RELOAD_DEVICE)
+        elif key_name == 'Key.f12':
+            logger.info('Requesting the latency measured by VirtualController')
+            conn.send_control(message.Actions.LATENCY)
+        elif key_name == 'T':
+            logger.info('Requesting termination of this connection')
+            conn.send_control(message.Actions.STOP_CONTROLLER)
+        elif key_name == 'Key.esc':
+            logger.info('Requesting termination of VirtualController')
+            conn.send_control(message.Actions.STOP_SERVER)
+            return False
+        else:
+            send_key(key_name, message.Actions.RELEASED)
+
+    with keyboard.Listener(
+        on_press = on_press,
+        on_release = on_release) as listener:
+        listener.join()
+
+    if ring_sender:
+        ring_sender.close()
+    if udp_sender:
+        udp_sender.close()
+    conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+import sys
+from threading import Lock
+
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from VCCommon import clock
+from VCCommon import message
+from VCCommon import shm_ring
+from VCCommon import VCLogger
+
+logger = VCLogger.Logger(VCLogger.Level.ALL)
+
+class RingSender:
+    """ Send key events to a server running on the same host through its
+    shared-memory ring (see shm_ring.py). Sending is a few writes to shared
+    memory and one to the doorbell FIFO, from the calling thread: there is
+    no socket and no sender thread. Events that do not fit in a full ring
+    are dropped. """
+
+    def __init__(self, ring_path, controller_id = None, timestamps = False):
+        """ Raise shm_ring.RingError if the ring does not exist, or is used by another client """
+        self.producer = shm_ring.RingProducer(ring_path, controller_id)
+        self.timestamps = timestamps
+        self.slots = {}
+        # The ring has a single producer: threads of this process take turns
+        self.lock = Lock()
+        logger.connection_info('Sending key events to ring {}', ring_path)
+
+    def send_key(self, key_name, action):
+        """ Send a key event. Return False if the key can't be sent in binary. """
+        return self.send(message.Titles.EVENT, key_name, action)
+
+    def send_control(self, action):
+        """ Send a control message without an answer (RELOAD_DEVICE, STOP_SERVER, LATENCY, STOP_CONTROLLER) """
+        return self.send(message.Titles.CONTROL, '-', action)
+
+    def send(self, title, value, action):
+        slot = self.slots.get((title, value, action))
+        if slot is None:
+            slot = self.producer.slot(title, value, action)
+            if slot is None:
+                return False
+            self.slots[(title, value, action)] = slot
+        if self.timestamps:
+            # Every process of the host shares the monotonic clock
+            slot = slot[:-1] + (int(clock.monotonic() * 1e6),)
+        with self.lock:
+            if not self.producer.send([slot]):
+                logger.warning('Ring is full, dropped {} {}.', value, action)
+        return True
+
+    def close(self):
+        """ End the session, so that the server releases the keys still pressed """
+        with self.lock:
+            self.producer.send([self.producer.slot(message.Titles.CONTROL, '-', message.Actions.STOP_CONTROLLER)])
+            self.producer.close()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+""" Print the counters of a running VirtualController server (CONTROL/STATS). """
+
+import argparse
+import json
+import socket
+import sys
+import time
+
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from VCCommon import message
+from VCCommon import VCLogger
+
+logger = VCLogger.Logger(VCLogger.Level.ALL)
+
+arg_parser = argparse.ArgumentParser(description = 'Print the counters of a VirtualController server')
+arg_parser.add_argument('host', nargs = '?', default = '127.0.0.1')
+arg_parser.add_argument('port', nargs = '?', type = int, default = 2011)
+arg_parser.add_argument('--interval', type = float,
+    help = 'ask again every INTERVAL seconds instead of once')
+
+def request_stats(sock, parser):
+    """ Send a STATS request and return the counters answered by the server, or None """
+    request = message.Message(
+        title = message.Titles.CONTROL,
+        value = '-',
+        action = message.Actions.STATS,
+        status = message.StatusCodes.OK,
+    )
+    sock.sendall(request.format_frame())
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return None
+        for reply in parser.feed(data):
+            if reply.action == message.Actions.STATS:
+                return reply.value
+
+def main():
+    args = arg_parser.parse_args()
+    try:
+        sock = socket.create_connection((args.host, args.port), timeout = 5)
+    except socket.error as e:
+        logger.fatal('Could not connect to host {} on port {}'.format(args.host, args.port), e)
+
+    parser = message.MessageParser(max_message_size = 1 << 20)
+    try:
+        while True:
+            counters = request_stats(sock, parser)
+            if counters is None:
+                logger.warning('The server closed the connection.')
+                break
+            print json.dumps(counters, indent = 2, sort_keys = True)
+            if not args.interval:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import random
+import socket
+import sys
+from threading import Event, Lock, Thread
+
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from VCCommon import binary_message
+from VCCommon import message
+from VCCommon import VCLogger
+
+logger = VCLogger.Logger(VCLogger.Level.ALL)
+
+class UdpSender(Thread):
+    """ Send key events to the server as UDP datagrams (see binary_message.py).
+    Every datagram has a sequence number, so that the server drops late and
+    duplicated ones. The thread periodically sends a snapshot of the keys
+    currently pressed, so that a lost release is healed by the next snapshot. """
+
+    def __init__(self, host, port, controller_id = 0, snapshot_interval = 0.1):
+        Thread.__init__(self)
+        self.daemon = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect((host, port))
+        self.controller_id = controller_id or 0
+        self.snapshot_interval = snapshot_interval
+        # Start from a random sequence number, so a restarted client is not
+        # mistaken for late datagrams of the previous one
+        self.sequence = random.getrandbits(32)
+        self.pressed = set()
+        self.lock = Lock()
+        self.stop_event = Event()
+
+    def send_key(self, key_name, action):
+        """ Send a key event. Return False if the key can't be sent in binary. """
+        frame = binary_message.encode(message.Titles.EVENT, key_name, action)
+        if frame is None:
+            return False
+        with self.lock:
+            if action == message.Actions.PRESSED:
+                self.pressed.add(key_name)
+            else:
+                self.pressed.discard(key_name)
+            self.sequence += 1
+            self.send(binary_message.encode_events_datagram(self.sequence, self.controller_id, frame))
+        return True
+
+    def send_axis(self, axis_name, value):
+        """ Send an axis value. Return False if the axis can't be sent in binary.
+        A lost datagram is healed by the next value, which the server keeps anyway. """
+        frame = binary_message.encode_axis(axis_name, value)
+        if frame is None:
+            return False
+        with self.lock:
+            self.sequence += 1
+            self.send(binary_message.encode_events_datagram(self.sequence, self.controller_id, frame))
+        return True
+
+    def send_snapshot(self):
+        with self.lock:
+            self.sequence += 1
+            self.send(binary_message.encode_snapshot_datagram(self.sequence, self.controller_id, self.pressed))
+
+    def send(self, datagram):
+        try:
+            self.sock.send(datagram)
+        except socket.error as err:
+            logger.warning('Failed to send a datagram.', err = err)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.send_snapshot()
+            self.stop_event.wait(self.snapshot_interval)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def close(self):
+        """ Release the keys still pressed with an empty snapshot, and close the socket """
+        self.stop()
+        with self.lock:
+            self.pressed.clear()
+            self.sequence += 1
+            self.send(binary_message.encode_snapshot_datagram(self.sequence, self.controller_id, self.pressed))
+        self.sock.close()
@@ -2,11 +2,21 @@
 
 ###
 # Logging functions for the controller simulator.
+#
+# Messages are filtered by level before anything is formatted: arguments
+# given after the message are only used by str.format() once the record is
+# written. Records are written by a background thread, in batches, to one
+# or more sinks (console, plain text file, JSON lines file). Use
+# configure() to change the level, the sinks, or to write synchronously.
 ###
 
+import atexit
+import json
 import sys
 import os
 import time
+from collections import deque
+from threading import Condition, Lock, Thread
 from colors import Colors
 
 DATE_TIME_FORMAT = '%d/%m/%Y-%H:%M:%S'
@@ -20,52 +30,270 @@ class Level:
     SUCCESSES   = 4     # Add success log
     ALL         = 10    # Print all log messages
 
+# Tag and color of each kind of message
+TAGS = {
+    'FATAL ERROR':  Colors.RED_BOLD,
+    'WARNING':      Colors.YELLOW_BOLD,
+    'INFO':         Colors.WHITE_BOLD,
+    'OK':           Colors.GREEN_BOLD,
+    'CONNECT':      Colors.CYAN_BOLD,
+    'EVENT':        Colors.BLUE_BOLD,
+}
+
+def format_record(record):
+    """ Return the text of a (timestamp, level, tag, msg, args) record """
+    timestamp, level, tag, msg, args = record
+    if not args:
+        return msg
+    try:
+        return msg.format(*args)
+    except Exception:
+        return '{} {!r}'.format(msg, args)
+
+class ConsoleSink:
+    """ Write records to the terminal, with colors """
+    def __init__(self, stream = None):
+        self.stream = stream or sys.stdout
+
+    def write(self, records):
+        lines = []
+        for record in records:
+            tag = record[2]
+            lines.append('[ ' + TAGS[tag] + tag + Colors.RESET + ' ] ' + format_record(record) + '\n')
+        self.stream.write(''.join(lines))
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+class FileSink:
+    """ Append records to a text file, one line per record, with a timestamp """
+    def __init__(self, file_path):
+        self.file = open(file_path, 'a')
+
+    def write(self, records):
+        lines = []
+        for record in records:
+            date = time.strftime(DATE_TIME_FORMAT, time.localtime(record[0]))
+            lines.append('{}.{:03d} [{}] {}\n'.format(date, int(record[0] * 1000) % 1000, record[2], format_record(record)))
+        self.file.write(''.join(lines))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class JsonSink:
+    """ Append records to a file as JSON objects, one per line """
+    def __init__(self, file_path):
+        self.file = open(file_path, 'a')
+
+    def write(self, records):
+        lines = []
+        for record in records:
+            lines.append(json.dumps({
+                'time': record[0],
+                'level': record[1],
+                'tag': record[2],
+                'message': format_record(record),
+            }) + '\n')
+        self.file.write(''.join(lines))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class SyncWriter:
+    """ Write every record to the sinks right away, in the calling thread """
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self.lock = Lock()
+        self.dropped = 0
+
+    def submit(self, record):
+        with self.lock:
+            for sink in self.sinks:
+                sink.write((record,))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            for sink in self.sinks:
+                sink.close()
+
+class AsyncWriter(Thread):
+    """ Background thread writing records to the sinks.
+    Records are kept in a bounded queue; when it is full new records are
+    dropped and counted rather than slowing down the caller. Every wake-up
+    writes all pending records with a single write and flush per sink. """
+
+    def __init__(self, sinks, queue_size = 10000):
+        Thread.__init__(self)
+        self.daemon = True
+        self.sinks = sinks
+        self.queue_size = queue_size
+        self.records = deque()
+        self.cond = Condition()
+        self.write_lock = Lock()
+        self.closed = False
+        self.dropped = 0
+
+    def submit(self, record):
+        with self.cond:
+            if len(self.records) >= self.queue_size:
+                self.dropped += 1
+                return
+            self.records.append(record)
+            if len(self.records) == 1:
+                self.cond.notify()
+
+    def take(self):
+        """ Return all pending records """
+        with self.cond:
+            records = self.records
+            self.records = deque()
+        return records
+
+    def write(self, records):
+        with self.write_lock:
+            for sink in self.sinks:
+                try:
+                    sink.write(records)
+                except Exception:
+                    pass
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.records and not self.closed:
+                    self.cond.wait()
+                if self.closed and not self.records:
+                    return
+            self.write(self.take())
+
+    def flush(self):
+        """ Write the pending records from the calling thread """
+        records = self.take()
+        if records:
+            self.write(records)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.is_alive():
+            self.join()
+        self.flush()
+        with self.write_lock:
+            for sink in self.sinks:
+                sink.close()
+
+# Global configuration shared by every Logger
+_level = Level.ALL
+_writer = None
+
+def configure(level = Level.ALL, sinks = None, asynchronous = True, queue_size = 10000):
+    """ Set the maximum level written by every Logger, and where records are written.
+    sinks defaults to a single ConsoleSink. """
+    global _level, _writer
+    if sinks is None:
+        sinks = [ConsoleSink()]
+    if asynchronous:
+        writer = AsyncWriter(sinks, queue_size)
+        writer.start()
+    else:
+        writer = SyncWriter(sinks)
+
+    old_writer = _writer
+    _level = level
+    _writer = writer
+    if old_writer is not None:
+        old_writer.close()
+
+def flush():
+    """ Write every pending record before returning """
+    _writer.flush()
+
+def dropped_records():
+    """ Number of records dropped because the writer queue was full """
+    return _writer.dropped
+
+@atexit.register
+def _close_writer():
+    if _writer is not None:
+        _writer.close()
+
 class Logger:
     def __init__(self, level = Level.ALL):
         self.level = level
 
-    def print_err_msg(self, msg, err):
-        """ Print details about an error message """
+    def enabled(self, level):
+        """ Return True if messages of this level are written.
+        Callers can use it to skip computing expensive arguments. """
+        return level <= self.level and level <= _level
+
+    def log(self, level, tag, msg, args):
+        if level <= self.level and level <= _level:
+            _writer.submit((time.time(), level, tag, msg, args))
+
+    def err_msg(self, msg, err):
+        """ Return details about an error message """
         exc_type, exc_value, exc_tb = sys.exc_info()
+        if exc_tb is None:
+            return '\n|\tMessage: ' + msg + '\n|\tDetails: {0}'.format(err)
         file_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
         err_line = exc_tb.tb_lineno
-        tb_msg = exc_value.message
-        print '|\tDate: ' + time.strftime(DATE_TIME_FORMAT)
-        print '|\tIn: ' + file_name
-        print '|\tLine: {0}'.format(err_line)
-        print '|\tType: ' + exc_type.__name__
-        print '|\tMessage: ' + msg
-        print '|\tDetails: {0}'.format(err)
+        return '\n'.join([
+            '',
+            '|\tDate: ' + time.strftime(DATE_TIME_FORMAT),
+            '|\tIn: ' + file_name,
+            '|\tLine: {0}'.format(err_line),
+            '|\tType: ' + exc_type.__name__,
+            '|\tMessage: ' + msg,
+            '|\tDetails: {0}'.format(err),
+        ])
+
+    def print_err_msg(self, msg, err):
+        """ Print details about an error message """
+        print self.err_msg(msg, err)
 
     def fatal(self, msg, err):
         """ Messages related to fatal erros; will exit the program """
         if err is not None:
-            print '[ ' + Colors.RED_BOLD + 'FATAL ERROR' + Colors.RESET + ' ]'
-            self.print_err_msg(msg, err)
-        else:
-            print '[ ' + Colors.RED_BOLD + 'FATAL ERROR' + Colors.RESET + ' ] ' + msg
+            msg = self.err_msg(msg, err)
+        self.log(Level.ERRORS, 'FATAL ERROR', msg, ())
+        flush()
         exit()
 
-    def warning(self, msg, err = None):
-        """ Messages related to important warnings, that are not fatal """
+    def warning(self, msg, *args, **kwargs):
+        """ Messages related to important warnings, that are not fatal.
+        The details of an exception can be given as err; they are taken
+        right away, the message itself is formatted when it is written. """
+        if not self.enabled(Level.WARNINGS):
+            return
+        err = kwargs.get('err')
         if err is not None:
-            print '[ ' + Colors.YELLOW_BOLD + 'WARNING' + Colors.RESET + ' ]'
-            self.print_err_msg(msg, err)
-        else:
-            print '[ ' + Colors.YELLOW_BOLD + 'WARNING' + Colors.RESET + ' ] ' + msg
+            if args:
+                # Part of the format string, where braces are placeholders
+                err = '{0}'.format(err).replace('{', '{{').replace('}', '}}')
+            msg = self.err_msg(msg, err)
+        self.log(Level.WARNINGS, 'WARNING', msg, args)
 
-    def info(self, msg):
+    def info(self, msg, *args):
         """ Generic info message """
-        print '[ ' + Colors.WHITE_BOLD + 'INFO' + Colors.RESET + ' ] ' + msg
+        self.log(Level.ALL, 'INFO', msg, args)
 
-    def success(self, msg):
+    def success(self, msg, *args):
         """ Generic success messages """
-        print '[ ' + Colors.GREEN_BOLD + 'OK' + Colors.RESET + ' ] ' + msg
+        self.log(Level.SUCCESSES, 'OK', msg, args)
 
-    def connection_info(self, msg):
+    def connection_info(self, msg, *args):
         """ Messages related to socket connections / disconnections """
-        print '[ ' + Colors.CYAN_BOLD + 'CONNECT' + Colors.RESET + ' ] ' + msg
+        self.log(Level.CONNECTIONS, 'CONNECT', msg, args)
 
-    def event_info(self, msg):
+    def event_info(self, msg, *args):
         """ Messages related to uinput events generated """
-        print '[ ' + Colors.BLUE_BOLD + 'EVENT' + Colors.RESET + ' ] ' + msg
+        self.log(Level.EVENTS, 'EVENT', msg, args)
+
+configure()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+import struct
+
+import message
+import VCLogger
+
+""" Compact binary format, negotiated as an alternative to JSON messages.
+
+A client asks for it by sending the JSON message
+{"title": "CONTROL", "value": "BINARY", "action": "HELLO", "status": 0}
+and waits for the server to answer with a HELLO message. If the value of the
+answer is "BINARY", every following message on that connection is a fixed-size
+frame; otherwise the connection stays in JSON.
+
+Frame format (network byte order, 4 bytes):
+    opcode  (unsigned char)   one of Opcodes
+    action  (unsigned char)   index in ACTIONS
+    key     (unsigned short)  index in KEY_NAMES, 0 is reserved
+
+A BATCH frame has the action 0 and the number of events as key. It is
+followed by that many EVENT frames, which are decoded as a single
+EVENT/BATCH Message.
+
+A TIMESTAMP frame (action 0, key 0) is followed by the send time of the
+next message, in microseconds on the server's monotonic clock, as an
+unsigned long long (8 bytes). It becomes the timestamp of the next decoded
+Message (see message.py for the clock offset exchange).
+
+An AXIS frame (action 0) has the index of the axis name in AXIS_NAMES as
+key, and is followed by the value of the axis as a signed int (4 bytes).
+It is decoded as an EVENT/AXIS Message with the value [axis name, value].
+
+Binary frames always have the status StatusCodes.OK.
+
+UDP datagrams start with a header (network byte order, 6 bytes):
+    kind        (unsigned char)   one of DatagramKinds
+    controller  (unsigned char)   controller id
+    sequence    (unsigned int)    incremented by the sender for every datagram
+followed, for an EVENTS datagram, by EVENT frames, and for a SNAPSHOT datagram
+by a bitmap of the keys currently pressed by the sender (bit i of byte i / 8
+is the key KEY_NAMES[i]). The receiver drops datagrams whose sequence number
+is not newer than the last one it accepted from the same sender.
+"""
+
+logger = VCLogger.Logger(VCLogger.Level.ALL)
+
+FRAME = struct.Struct('!BBH')
+TIMESTAMP = struct.Struct('!Q')
+AXIS_VALUE = struct.Struct('!i')
+DATAGRAM_HEADER = struct.Struct('!BBI')
+
+class DatagramKinds:
+    EVENTS = 1
+    SNAPSHOT = 2
+
+class Opcodes:
+    EVENT = 1
+    CONTROL = 2
+    BATCH = 3
+    TIMESTAMP = 4
+    AXIS = 5
+
+ACTIONS = [
+    message.Actions.PRESSED,
+    message.Actions.RELEASED,
+    message.Actions.RELOAD_DEVICE,
+    message.Actions.STOP_SERVER,
+    message.Actions.STOP_CONTROLLER,
+    message.Actions.LATENCY,
+    message.Actions.STATS,
+    message.Actions.HEARTBEAT,
+]
+
+# Key names as sent by VCClient, upper case. New names must be appended at
+# the end of the list so that existing ids never change. Id 0 is reserved:
+# it names no key, and frames with it are invalid.
+KEY_NAMES = (
+    [None]
+    + [chr(c) for c in range(ord('A'), ord('Z') + 1)]
+    + [chr(c) for c in range(ord('0'), ord('9') + 1)]
+    + list('`-=[]\\;\',./ ')
+    + ['KEY.' + name for name in [
+        'ALT', 'ALT_L', 'ALT_R', 'ALT_GR', 'BACKSPACE', 'CAPS_LOCK',
+        'CMD', 'CMD_L', 'CMD_R', 'CTRL', 'CTRL_L', 'CTRL_R', 'DELETE',
+        'DOWN', 'END', 'ENTER', 'ESC', 'HOME', 'LEFT', 'PAGE_DOWN',
+        'PAGE_UP', 'RIGHT', 'SHIFT', 'SHIFT_L', 'SHIFT_R', 'SPACE', 'TAB',
+        'UP', 'INSERT', 'MENU', 'NUM_LOCK', 'PAUSE', 'PRINT_SCREEN',
+        'SCROLL_LOCK',
+    ]]
+    + ['KEY.F{}'.format(i) for i in range(1, 21)]
+)
+
+# Axis names, upper case, as defined by the key mapping profiles. New
+# names must be appended at the end of the list.
+AXIS_NAMES = ['LX', 'LY', 'RX', 'RY', 'LT', 'RT', 'HAT_X', 'HAT_Y']
+
+SNAPSHOT_SIZE = (len(KEY_NAMES) + 7) // 8
+
+ACTION_IDS = dict((action, i) for i, action in enumerate(ACTIONS))
+KEY_IDS = dict((name, i) for i, name in enumerate(KEY_NAMES) if name is not None)
+AXIS_IDS = dict((name, i) for i, name in enumerate(AXIS_NAMES))
+OPCODE_TITLES = {
+    Opcodes.EVENT: message.Titles.EVENT,
+    Opcodes.CONTROL: message.Titles.CONTROL,
+}
+TITLE_OPCODES = dict((title, opcode) for opcode, title in OPCODE_TITLES.items())
+
+def key_id(key_name):
+    """ Return the id of a key name, or None if it can't be sent in binary """
+    return KEY_IDS.get(key_name.upper())
+
+def key_name(key):
+    """ Return the key name of an id. Raise IndexError if there is none. """
+    name = KEY_NAMES[key]
+    if name is None:
+        raise IndexError('Key id {} is reserved'.format(key))
+    return name
+
+def encode(title, value, action):
+    """ Encode a message as a binary frame. Return None if one of the fields
+    has no binary representation. """
+    opcode = TITLE_OPCODES.get(title)
+    action_id = ACTION_IDS.get(action)
+    key = key_id(value)
+    if opcode is None or action_id is None or key is None:
+        return None
+    return FRAME.pack(opcode, action_id, key)
+
+def encode_axis(axis_name, value):
+    """ Encode an axis value as an AXIS frame. Return None if the axis has
+    no binary representation. """
+    axis = AXIS_IDS.get(axis_name.upper())
+    if axis is None:
+        return None
+    return FRAME.pack(Opcodes.AXIS, 0, axis) + AXIS_VALUE.pack(value)
+
+def encode_batch(events):
+    """ Encode a list of (key name, action) pairs as a BATCH frame.
+    Return None if one of the events has no binary representation. """
+    frames = [FRAME.pack(Opcodes.BATCH, 0, len(events))]
+    for key, action in events:
+        frame = encode(message.Titles.EVENT, key, action)
+        if frame is None:
+            return None
+        frames.append(frame)
+    return ''.join(frames)
+
+def encode_message(msg):
+    """ Encode a Message as a binary frame, or return None """
+    if msg.title == message.Titles.EVENT and msg.action == message.Actions.BATCH:
+        return encode_batch(msg.value)
+    if msg.title == message.Titles.EVENT and msg.action == message.Actions.AXIS:
+        return encode_axis(*msg.value)
+    return encode(msg.title, msg.value, msg.action)
+
+def encode_timestamp(timestamp):
+    """ Return the TIMESTAMP frame to send before a message sent at the given
+    time, in seconds on the server's clock """
+    return FRAME.pack(Opcodes.TIMESTAMP, 0, 0) + TIMESTAMP.pack(max(0, int(timestamp * 1e6)))
+
+def encode_events_datagram(sequence, controller, frames):
+    """ Return an EVENTS datagram carrying the given encoded EVENT frames """
+    return DATAGRAM_HEADER.pack(DatagramKinds.EVENTS, controller, sequence & 0xffffffff) + frames
+
+def encode_snapshot_datagram(sequence, controller, key_names):
+    """ Return a SNAPSHOT datagram for the given pressed key names """
+    bitmap = bytearray(SNAPSHOT_SIZE)
+    for name in key_names:
+        key = key_id(name)
+        if key is not None:
+            bitmap[key >> 3] |= 1 << (key & 7)
+    return DATAGRAM_HEADER.pack(DatagramKinds.SNAPSHOT, controller, sequence & 0xffffffff) + bytes(bitmap)
+
+def is_newer(sequence, last_sequence):
+    """ Compare 32 bits sequence numbers, allowing them to wrap around """
+    return 0 < ((sequence - last_sequence) & 0xffffffff) < 0x80000000
+
+def decode_snapshot(data, offset = 0):
+    """ Return the list of key names set in a snapshot bitmap """
+    key_names = []
+    for i in range(min(SNAPSHOT_SIZE, len(data) - offset)):
+        byte = data[offset + i]
+        if isinstance(byte, str):
+            byte = ord(byte)
+        if not byte:
+            continue
+        for bit in range(8):
+            if byte & (1 << bit):
+                key = (i << 3) | bit
+                if 0 < key < len(KEY_NAMES):
+                    key_names.append(KEY_NAMES[key])
+    return key_names
+
+class BinaryParser:
+    """ Incremental parser for a stream of binary frames. Same interface as
+    message.MessageParser, so a connection can switch parsers after the
+    handshake. """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.invalid_count = 0
+        # Timestamp of the next message, read from a TIMESTAMP frame
+        self.timestamp = None
+
+    def feed(self, data):
+        """ Append data received from the stream and return the list of complete,
+        valid Messages it contained. Invalid frames are counted and dropped. """
+        buf = self.buffer
+        buf += data
+        messages = []
+        unpack_from = FRAME.unpack_from
+        frame_size = FRAME.size
+        end = len(buf) - frame_size
+        offset = 0
+        while offset <= end:
+            opcode, action_id, key = unpack_from(buf, offset)
+            if opcode == Opcodes.BATCH:
+                batch_end = offset + frame_size * (key + 1)
+                if batch_end > len(buf):
+                    break
+                messages.append(self.read_batch(buf, offset + frame_size, key))
+                offset = batch_end
+                continue
+            if opcode == Opcodes.TIMESTAMP:
+                if offset + frame_size + TIMESTAMP.size > len(buf):
+                    break
+                self.timestamp = TIMESTAMP.unpack_from(buf, offset + frame_size)[0] * 1e-6
+                offset += frame_size + TIMESTAMP.size
+                continue
+            if opcode == Opcodes.AXIS:
+                if offset + frame_size + AXIS_VALUE.size > len(buf):
+                    break
+                value = AXIS_VALUE.unpack_from(buf, offset + frame_size)[0]
+                offset += frame_size + AXIS_VALUE.size
+                if key < len(AXIS_NAMES):
+                    messages.append(message.Message(
+                        title = message.Titles.EVENT,
+                        value = [AXIS_NAMES[key], value],
+                        action = message.Actions.AXIS,
+                        status = message.StatusCodes.OK,
+                        timestamp = self.timestamp,
+                    ))
+                else:
+                    self.invalid_count += 1
+                self.timestamp = None
+                continue
+
+            offset += frame_size
+            try:
+                messages.append(message.Message(
+                    title = OPCODE_TITLES[opcode],
+                    value = key_name(key),
+                    action = ACTIONS[action_id],
+                    status = message.StatusCodes.OK,
+                    timestamp = self.timestamp,
+                ))
+            except (KeyError, IndexError):
+                self.invalid_count += 1
+            self.timestamp = None
+
+        if offset:
+            del buf[:offset]
+        return messages
+
+    def read_batch(self, buf, offset, count):
+        """ Decode the count EVENT frames of a BATCH frame """
+        events = []
+        for i in range(count):
+            opcode, action_id, key = FRAME.unpack_from(buf, offset)
+            offset += FRAME.size
+            if opcode != Opcodes.EVENT or not 0 < key < len(KEY_NAMES) or action_id >= len(ACTIONS):
+                self.invalid_count += 1
+                continue
+            events.append([KEY_NAMES[key], ACTIONS[action_id]])
+        timestamp = self.timestamp
+        self.timestamp = None
+        return message.Message(
+            title = message.Titles.EVENT,
+            value = events,
+            action = message.Actions.BATCH,
+            status = message.StatusCodes.OK,
+            timestamp = timestamp,
+        )
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+""" Monotonic clock shared by the client and the server.
+Python 2 has no time.monotonic(), so clock_gettime(CLOCK_MONOTONIC) is called
+through ctypes. If librt can't be loaded, time.time() is used instead: it can
+jump when the system time is changed, so latency measurements may be wrong. """
+
+import ctypes
+import ctypes.util
+import os
+import time
+
+CLOCK_MONOTONIC = 1
+
+class timespec(ctypes.Structure):
+    _fields_ = [
+        ('tv_sec', ctypes.c_long),
+        ('tv_nsec', ctypes.c_long),
+    ]
+
+def _load_clock_gettime():
+    """ Return the clock_gettime function of the C library, or None """
+    for name in (ctypes.util.find_library('rt'), ctypes.util.find_library('c')):
+        if not name:
+            continue
+        try:
+            library = ctypes.CDLL(name, use_errno = True)
+            clock_gettime = library.clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        clock_gettime.restype = ctypes.c_int
+        return clock_gettime
+    return None
+
+_clock_gettime = _load_clock_gettime()
+
+if _clock_gettime is not None:
+    def monotonic():
+        """ Return the value, in seconds, of a clock that never goes backwards.
+        Only the difference between two values is meaningful. """
+        # ctypes releases the GIL during the call: every call needs its own timespec
+        ts = timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    IS_MONOTONIC = True
+else:
+    monotonic = time.time
+    IS_MONOTONIC = False
@@ -12,6 +12,40 @@ import VCLogger
 }
 
 Possible values for each field are specified in subclasses of Messages.
+
+Optional fields:
+    "controller": index of the controller the message is for, when the server
+                  hosts several controllers. Without it, the message goes to the
+                  controller the connection is bound to (see Actions.BIND and
+                  Actions.HELLO), or to the first controller.
+    "timestamp":  time the client sent the message, in seconds on the server's
+                  monotonic clock (see clock.py). Clients learn the offset
+                  between their clock and the server's with CLOCK messages,
+                  sent before the HELLO handshake:
+                  {"title": "CONTROL", "value": <client time>, "action": "CLOCK", "status": 0}
+                  is answered with the value [<client time>, <server time>].
+
+A BATCH event carries several key transitions, emitted as a single input frame:
+{
+    "title": "EVENT",
+    "value": [["A", "PRESSED"], ["KEY.LEFT", "PRESSED"]],
+    "action": "BATCH",
+    "status": 0
+}
+
+An AXIS event moves an analog axis (stick, trigger) defined by the key
+mapping profile of the controller to a value within its range:
+{
+    "title": "EVENT",
+    "value": ["LX", -12000],
+    "action": "AXIS",
+    "status": 0
+}
+
+On the wire, every JSON message is terminated by a newline (see
+Message.format_frame), so that a stream can carry several messages in one
+read, or one message across several reads. Use MessageParser to split a
+stream back into Messages.
 """
 
 logger = VCLogger.Logger(VCLogger.Level.ALL)
@@ -20,37 +54,52 @@ class Message:
     """ Represent a message received from, or sent to and socket.
     Transferred messages are formated in JSON """
 
-    def __init__(self, title = None, value = None, action = None, status = None):
+    def __init__(self, title = None, value = None, action = None, status = None, controller = None, timestamp = None):
         self.title = title
         self.value = value
         self.action = action
         self.status = status
+        self.controller = controller
+        self.timestamp = timestamp
+        # Set by the server: the connection this message was received from
+        self.client = None
+        # Set by the server when latency is measured: monotonic times at
+        # which the message was received and parsed
+        self.received_at = None
+        self.parsed_at = None
 
     def read_message(self, msg):
         """ Convert a message from JSON to Message """
         try:
             json_parsed = json.loads(msg)
         except ValueError as err:
-            logger.warning('Message is not in JSON format.', err)
+            logger.warning('Message is not in JSON format.', err = err)
+            return
+        if not isinstance(json_parsed, dict):
+            logger.warning("This message is not a JSON object: \n{}", msg)
             return
 
-        if json_parsed['title'] is None:
-            logger.warning("This message doesn't contain a title: \n{}".format(msg))
+        if json_parsed.get('title') is None:
+            logger.warning("This message doesn't contain a title: \n{}", msg)
             return
-        if json_parsed['value'] is None:
-            logger.warning("This message doesn't contain a value: \n{}".format(msg))
+        if json_parsed.get('value') is None:
+            logger.warning("This message doesn't contain a value: \n{}", msg)
             return
-        if json_parsed['action'] is None:
-            logger.warning("This message doesn't contain an action: \n{}".format(msg))
+        if json_parsed.get('action') is None:
+            logger.warning("This message doesn't contain an action: \n{}", msg)
             return
-        if json_parsed['status'] is None:
-            logger.warning("This message doesn't contain a status: \n{}".format(msg))
+        if json_parsed.get('status') is None:
+            logger.warning("This message doesn't contain a status: \n{}", msg)
             return
 
         self.title = json_parsed['title']
         self.value = json_parsed['value']
         self.action = json_parsed['action']
         self.status = json_parsed['status']
+        self.controller = json_parsed.get('controller')
+        timestamp = json_parsed.get('timestamp')
+        if isinstance(timestamp, (int, long, float)):
+            self.timestamp = timestamp
 
     def is_valid(self):
         """ Return True if all fields are set """
@@ -83,14 +132,64 @@ class Message:
         data['value'] = self.value
         data['action'] = self.action
         data['status'] = self.status
+        if self.controller is not None:
+            data['controller'] = self.controller
+        if self.timestamp is not None:
+            data['timestamp'] = self.timestamp
         return json.dumps(data)
 
+    def format_frame(self):
+        """ Stringify this message and terminate it, ready to be sent on a stream """
+        json_message = self.format_json()
+        if not json_message:
+            return ''
+        return json_message + FRAME_DELIMITER
+
     def __str__(self):
         return "Title: {}\n\
                 Value: {}\n\
                 Action: {}\n\
                 Status: {}\n".format(self.title, self.value, self.action, self.status)
 
+class MessageParser:
+    """ Incremental parser for a stream of newline-delimited JSON messages.
+    Data is accumulated in a reusable buffer; every complete message is
+    extracted on each call to feed(), partial messages are kept for the next one. """
+
+    def __init__(self, max_message_size = 4096):
+        self.buffer = bytearray()
+        self.max_message_size = max_message_size
+        self.invalid_count = 0
+
+    def feed(self, data):
+        """ Append data received from the stream and return the list of complete,
+        valid Messages it contained. Invalid messages are counted and dropped. """
+        buf = self.buffer
+        buf += data
+        messages = []
+        start = 0
+        end = buf.find(FRAME_DELIMITER, start)
+        while end >= 0:
+            if end > start:
+                msg = Message()
+                msg.read_message(bytes(buf[start:end]))
+                if msg.is_valid():
+                    messages.append(msg)
+                else:
+                    self.invalid_count += 1
+            start = end + 1
+            end = buf.find(FRAME_DELIMITER, start)
+
+        if start:
+            del buf[:start]
+        if len(buf) > self.max_message_size:
+            logger.warning('Dropping {} bytes of data without message delimiter.', len(buf))
+            self.invalid_count += 1
+            del buf[:]
+        return messages
+
+FRAME_DELIMITER = '\n'
+
 class Titles:
     EVENT = "EVENT"
     CONTROL = "CONTROL"
@@ -101,6 +200,24 @@ class Actions:
     RELOAD_DEVICE = "RELOAD_DEVICE"
     STOP_SERVER = "STOP_SERVER"
     STOP_CONTROLLER = "STOP_CONTROLLER"
+    HELLO = "HELLO" # Protocol handshake, the value is one of Protocols. A controller field binds the connection
+    BATCH = "BATCH" # The value is a list of [key, PRESSED|RELEASED] pairs
+    SNAPSHOT = "SNAPSHOT" # The value is the list of every key the client holds, the others are released
+    BIND = "BIND" # Send the next messages of this connection to the controller given as value
+    CLOCK = "CLOCK" # Clock offset request, the value is the client time; answered with [client time, server time]
+    LATENCY = "LATENCY" # Log the latency percentiles measured by the server
+    STATS = "STATS" # Answered on the same connection with the counters of the server, as a JSON object
+    SWITCH_PROFILE = "SWITCH_PROFILE" # Use the key mapping profile named by the value (JSON only)
+    REGISTER_MACRO = "REGISTER_MACRO" # Macros are played by the server, see VCServer/macros.py (JSON only)
+    TRIGGER_MACRO = "TRIGGER_MACRO"
+    CANCEL_MACRO = "CANCEL_MACRO"
+    TURBO = "TURBO"
+    AXIS = "AXIS" # The value is an [axis name, value] pair
+    HEARTBEAT = "HEARTBEAT" # Sent by idle clients so that the server knows they are alive
+
+class Protocols:
+    JSON = "JSON"
+    BINARY = "BINARY" # See binary_message.py
 
 class StatusCodes:
     ERROR = -1
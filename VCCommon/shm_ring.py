@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+import errno
+import fcntl
+import mmap
+import os
+import stat
+import struct
+
+import binary_message
+import message
+
+""" Shared-memory ring buffer for clients running on the same host as the server.
+
+The ring is a file (usually in /dev/shm) created by the server and mapped by
+one producer process (the client) and one consumer (the server). Its layout
+(native byte order) is:
+    offset 0    magic (8 bytes), slot count (unsigned int), slot size (unsigned int)
+    offset 64   head (unsigned long long), number of slots ever written
+    offset 128  tail (unsigned long long), number of slots ever read
+    offset 192  slot count fixed-size slots
+head is only written by the producer and tail by the consumer, on separate
+cache lines. The producer fills slots before publishing the new head, the
+consumer reads slots before publishing the new tail, so no lock is needed
+as long as there is a single producer: clients take an exclusive flock() on
+the file to guarantee it.
+
+A slot (network byte order, 16 bytes) is a binary frame (see
+binary_message.py), the controller id (UNBOUND for the default controller)
+and the send time in microseconds on the monotonic clock, 0 if unknown.
+Clocks are shared by every process of the host, so no offset is needed.
+
+After publishing slots, the producer writes a byte to the doorbell, a FIFO
+next to the ring (ring path + '.bell'), so that the server does not have to
+poll the ring. A full FIFO means a wake-up is already pending.
+"""
+
+RING_MAGIC = 'VCRING\x00\x01'
+HEADER = struct.Struct('=8sII')
+COUNTER = struct.Struct('=Q')
+SLOT = struct.Struct('!BBHBxxxQ')
+HEAD_OFFSET = 64
+TAIL_OFFSET = 128
+SLOTS_OFFSET = 192
+UNBOUND = 0xff
+
+class RingError(EnvironmentError):
+    """ Raised when a ring can't be created or opened """
+    pass
+
+def doorbell_path(ring_path):
+    return ring_path + '.bell'
+
+class ShmRing:
+    """ Memory mapping of a ring, used by both ends """
+
+    def __init__(self, ring_path, slot_count = None):
+        """ Create a ring with slot_count slots (a power of 2), replacing any
+        existing one, or open an existing ring if slot_count is None. """
+        self.path = ring_path
+        if slot_count is not None:
+            if slot_count <= 0 or slot_count & (slot_count - 1):
+                raise ValueError('The number of slots must be a power of 2.')
+            size = SLOTS_OFFSET + slot_count * SLOT.size
+            tmp_path = ring_path + '.tmp'
+            fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                os.ftruncate(fd, size)
+                os.write(fd, HEADER.pack(RING_MAGIC, slot_count, SLOT.size))
+                # Clients waiting on the old ring must not map a half-initialized one
+                os.rename(tmp_path, ring_path)
+            except OSError:
+                os.close(fd)
+                raise
+        else:
+            try:
+                fd = os.open(ring_path, os.O_RDWR)
+            except OSError as err:
+                raise RingError(err.errno, 'Can not open ring {}: {}'.format(ring_path, err.strerror))
+        self.fd = fd
+        try:
+            self.map = mmap.mmap(fd, 0)
+        except (ValueError, EnvironmentError) as err:
+            os.close(fd)
+            raise RingError(errno.EINVAL, 'Can not map ring {}: {}'.format(ring_path, err))
+        magic, self.slot_count, slot_size = HEADER.unpack_from(self.map, 0)
+        if magic != RING_MAGIC or slot_size != SLOT.size or len(self.map) < SLOTS_OFFSET + self.slot_count * SLOT.size:
+            self.close()
+            raise RingError(errno.EINVAL, '{} is not a ring.'.format(ring_path))
+        self.mask = self.slot_count - 1
+
+    def head(self):
+        return COUNTER.unpack_from(self.map, HEAD_OFFSET)[0]
+
+    def tail(self):
+        return COUNTER.unpack_from(self.map, TAIL_OFFSET)[0]
+
+    def push(self, slots):
+        """ Producer: append packed slots. Return how many fit in the ring. """
+        head = self.head()
+        room = self.slot_count - (head - self.tail())
+        slots = slots[:room]
+        pack_into = SLOT.pack_into
+        for slot in slots:
+            pack_into(self.map, SLOTS_OFFSET + (head & self.mask) * SLOT.size, *slot)
+            head += 1
+        if slots:
+            COUNTER.pack_into(self.map, HEAD_OFFSET, head)
+        return len(slots)
+
+    def drain(self):
+        """ Consumer: return the list of slots written since the last call,
+        as (opcode, action id, key id, controller, timestamp) tuples. """
+        tail = self.tail()
+        head = self.head()
+        if head == tail:
+            return []
+        unpack_from = SLOT.unpack_from
+        slots = []
+        for i in xrange(tail, head):
+            slots.append(unpack_from(self.map, SLOTS_OFFSET + (i & self.mask) * SLOT.size))
+        COUNTER.pack_into(self.map, TAIL_OFFSET, head)
+        return slots
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def create_doorbell(ring_path):
+    """ Create the doorbell FIFO of a ring and open it for the server. Return the fd.
+    The FIFO is also open for writing, so that it never reports a hang-up
+    when a client closes its end. """
+    bell_path = doorbell_path(ring_path)
+    try:
+        if not stat.S_ISFIFO(os.stat(bell_path).st_mode):
+            raise RingError(errno.EEXIST, '{} exists and is not a FIFO.'.format(bell_path))
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        os.mkfifo(bell_path, 0o600)
+    return os.open(bell_path, os.O_RDWR | os.O_NONBLOCK)
+
+def clear_doorbell(fd):
+    """ Read every pending byte of a doorbell """
+    while True:
+        try:
+            if not os.read(fd, 512):
+                return
+        except OSError as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            if err.errno != errno.EINTR:
+                raise
+
+def remove(ring_path):
+    """ Remove the files of a ring """
+    for file_path in (ring_path, doorbell_path(ring_path)):
+        try:
+            os.unlink(file_path)
+        except OSError:
+            pass
+
+class RingProducer:
+    """ Client end of a ring: encodes key events and control messages as slots. """
+
+    def __init__(self, ring_path, controller_id = None):
+        self.ring = ShmRing(ring_path)
+        try:
+            fcntl.flock(self.ring.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as err:
+            self.ring.close()
+            raise RingError(err.errno, 'Ring {} is already used by another client.'.format(ring_path))
+        try:
+            self.bell = os.open(doorbell_path(ring_path), os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as err:
+            self.ring.close()
+            raise RingError(err.errno, 'No server is reading ring {}: {}'.format(ring_path, err.strerror))
+        self.controller = UNBOUND if controller_id is None else controller_id
+        self.dropped = 0
+
+    def slot(self, title, value, action, timestamp = None):
+        """ Return the slot of a message, or None if it has no binary representation """
+        frame = binary_message.encode(title, value, action)
+        if frame is None:
+            return None
+        opcode, action_id, key = binary_message.FRAME.unpack(frame)
+        return (opcode, action_id, key, self.controller, max(0, int(timestamp * 1e6)) if timestamp else 0)
+
+    def send(self, slots):
+        """ Publish slots and ring the doorbell. Slots that do not fit are dropped. """
+        written = self.ring.push(slots)
+        self.dropped += len(slots) - written
+        try:
+            os.write(self.bell, 'x')
+        except OSError as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return written
+
+    def close(self):
+        if self.bell is not None:
+            os.close(self.bell)
+            self.bell = None
+        # Closing the file releases the lock
+        self.ring.close()
+
+def decode(slot):
+    """ Return the Message of a slot, with its controller id (None if unbound).
+    Raise KeyError or IndexError if the slot is invalid. """
+    opcode, action_id, key, controller, timestamp = slot
+    msg = message.Message(
+        title = binary_message.OPCODE_TITLES[opcode],
+        value = binary_message.key_name(key),
+        action = binary_message.ACTIONS[action_id],
+        status = message.StatusCodes.OK,
+        timestamp = timestamp * 1e-6 if timestamp else None,
+    )
+    return msg, None if controller == UNBOUND else controller
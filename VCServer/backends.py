@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""
+Device backends used by the Controller to emit input events.
+An event is a (type, code) tuple as defined in event_codes.py; absolute axes
+may be given as (type, code, min, max, fuzz, flat) when opening a device.
+
+- UinputBackend: python-uinput (https://github.com/tuomasjjrasanen/python-uinput)
+- RawUinputBackend: talks to /dev/uinput directly, one write() per frame
+- RecordingBackend: in-memory device, to run the server without uinput or root
+"""
+
+import fcntl
+import os
+import struct
+import sys
+import time
+
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from VCCommon import VCLogger
+
+from event_codes import EventTypes, SYN_REPORT, ABS_MAX
+
+logger = VCLogger.Logger(VCLogger.Level.ALL)
+
+class Backend:
+    """ Interface of a device backend. A backend object represents one device:
+    open() creates it, destroy() removes it. """
+
+    def open(self, events, name, bustype, vendor, product, version):
+        """ Create the device, supporting the given list of events """
+        raise NotImplementedError()
+
+    def emit(self, event, value, syn = True):
+        """ Emit a single event, followed by a SYN_REPORT if syn is True """
+        raise NotImplementedError()
+
+    def emit_batch(self, events):
+        """ Emit a list of (event, value) pairs followed by a single SYN_REPORT """
+        for event, value in events:
+            self.emit(event, value, syn = False)
+        self.syn()
+
+    def emit_click(self, event):
+        """ Press and release a key """
+        self.emit(event, 1)
+        self.emit(event, 0)
+
+    def syn(self):
+        """ Emit a SYN_REPORT """
+        raise NotImplementedError()
+
+    def destroy(self):
+        """ Remove the device """
+        raise NotImplementedError()
+
+class UinputBackend(Backend):
+    """ Backend based on the python-uinput module """
+
+    def __init__(self):
+        self.device = None
+
+    def open(self, events, name, bustype, vendor, product, version):
+        import uinput
+        self.device = uinput.Device(
+            events = events,
+            name = name,
+            bustype = bustype,
+            vendor = vendor,
+            product = product,
+            version = version,
+        )
+
+    def emit(self, event, value, syn = True):
+        self.device.emit(event, value, syn)
+
+    def emit_click(self, event):
+        self.device.emit_click(event)
+
+    def syn(self):
+        self.device.syn()
+
+    def destroy(self):
+        self.device.destroy()
+        self.device = None
+
+class RawUinputBackend(Backend):
+    """ Backend writing struct input_event arrays to /dev/uinput.
+    The device is set up with ioctl() calls; a whole frame is packed in a
+    preallocated buffer and sent with a single write(). """
+
+    DEVICE_PATH = '/dev/uinput'
+
+    # ioctl requests from /usr/include/linux/uinput.h
+    UI_DEV_CREATE  = 0x5501
+    UI_DEV_DESTROY = 0x5502
+    UI_SET_EVBIT   = 0x40045564
+    UI_SET_KEYBIT  = 0x40045565
+    UI_SET_ABSBIT  = 0x40045567
+
+    # struct input_event { struct timeval time; __u16 type; __u16 code; __s32 value; }
+    INPUT_EVENT = struct.Struct('llHHi')
+    # struct uinput_user_dev { char name[80]; struct input_id id; __u32 ff_effects_max;
+    #                          __s32 absmax[64], absmin[64], absfuzz[64], absflat[64]; }
+    USER_DEV = struct.Struct('80sHHHHI{0}i{0}i{0}i{0}i'.format(ABS_MAX + 1))
+
+    def __init__(self, max_batch = 64):
+        self.fd = None
+        self.buffer = bytearray(self.INPUT_EVENT.size * (max_batch + 1))
+        self.view = memoryview(self.buffer)
+
+    def open(self, events, name, bustype, vendor, product, version):
+        absmax = [0] * (ABS_MAX + 1)
+        absmin = [0] * (ABS_MAX + 1)
+        absfuzz = [0] * (ABS_MAX + 1)
+        absflat = [0] * (ABS_MAX + 1)
+
+        self.fd = os.open(self.DEVICE_PATH, os.O_WRONLY | os.O_NONBLOCK)
+        try:
+            fcntl.ioctl(self.fd, self.UI_SET_EVBIT, EventTypes.SYN)
+            event_types = set()
+            for event in events:
+                ev_type, code = event[0], event[1]
+                if ev_type not in event_types:
+                    fcntl.ioctl(self.fd, self.UI_SET_EVBIT, ev_type)
+                    event_types.add(ev_type)
+                if ev_type == EventTypes.KEY:
+                    fcntl.ioctl(self.fd, self.UI_SET_KEYBIT, code)
+                elif ev_type == EventTypes.ABS:
+                    fcntl.ioctl(self.fd, self.UI_SET_ABSBIT, code)
+                    if len(event) > 2:
+                        absmin[code], absmax[code], absfuzz[code], absflat[code] = event[2:6]
+                else:
+                    raise ValueError('Event type {} is not supported by this backend'.format(ev_type))
+
+            user_dev = self.USER_DEV.pack(
+                name[:79], bustype, vendor, product, version, 0,
+                *(absmax + absmin + absfuzz + absflat)
+            )
+            os.write(self.fd, user_dev)
+            fcntl.ioctl(self.fd, self.UI_DEV_CREATE)
+        except Exception:
+            os.close(self.fd)
+            self.fd = None
+            raise
+
+    def emit(self, event, value, syn = True):
+        if syn:
+            self.emit_batch(((event, value),))
+        else:
+            os.write(self.fd, self.INPUT_EVENT.pack(0, 0, event[0], event[1], value))
+
+    def emit_batch(self, events):
+        size = self.INPUT_EVENT.size * (len(events) + 1)
+        if size > len(self.buffer):
+            self.buffer = bytearray(size)
+            self.view = memoryview(self.buffer)
+
+        pack_into = self.INPUT_EVENT.pack_into
+        buf = self.buffer
+        offset = 0
+        for event, value in events:
+            pack_into(buf, offset, 0, 0, event[0], event[1], value)
+            offset += self.INPUT_EVENT.size
+        pack_into(buf, offset, 0, 0, EventTypes.SYN, SYN_REPORT, 0)
+        os.write(self.fd, self.view[:size])
+
+    def syn(self):
+        os.write(self.fd, self.INPUT_EVENT.pack(0, 0, EventTypes.SYN, SYN_REPORT, 0))
+
+    def destroy(self):
+        try:
+            fcntl.ioctl(self.fd, self.UI_DEV_DESTROY)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+class RecordingBackend(Backend):
+    """ In-memory device. Emitted events are counted and, if keep_events is
+    True, recorded as (timestamp, type, code, value) tuples; SYN_REPORT are
+    recorded with the type EventTypes.SYN. """
+
+    def __init__(self, keep_events = True):
+        self.keep_events = keep_events
+        self.events = []
+        self.supported_events = []
+        self.name = None
+        self.event_count = 0
+        self.syn_count = 0
+        self.is_open = False
+
+    def open(self, events, name, bustype, vendor, product, version):
+        self.supported_events = list(events)
+        self.name = name
+        self.is_open = True
+
+    def emit(self, event, value, syn = True):
+        self.event_count += 1
+        if self.keep_events:
+            self.events.append((time.time(), event[0], event[1], value))
+        if syn:
+            self.syn()
+
+    def syn(self):
+        self.syn_count += 1
+        if self.keep_events:
+            self.events.append((time.time(), EventTypes.SYN, SYN_REPORT, 0))
+
+    def destroy(self):
+        self.is_open = False
+
+# Backends selectable by name
+BACKENDS = {
+    'uinput': UinputBackend,
+    'raw': RawUinputBackend,
+    'recording': RecordingBackend,
+}
@@ -1,38 +1,38 @@
 #!/usr/bin/env python
 
 """
-Virtual controller based on python-uinput
-(https://github.com/tuomasjjrasanen/python-uinput)
+Virtual controller emitting events on the uinput driver, through one of the
+device backends defined in backends.py (python-uinput by default).
 A VCClient can send keyboard events, causing this Controller to emit
-the events on the uinput driver.
+the events on the uinput driver. Several Controllers can be served by the
+same ControllerHub (hub.py).
 Input messages must be in the JSON format specified in message.py; other messages
 will be ignored.
 """
 
 import sys
-import time
-import fcntl
 from threading import Thread
 
 from os import path
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
+from VCCommon import clock
 from VCCommon import message
 from VCCommon import VCLogger
 
+import backends
 import bus_types
-import socket_server
-
-try:
-    import uinput
-except ImportError as err:
-    logger.fatal('Failed to import uinput. Are you sure it is installed?', err)
+import key_profiles
+import key_state
+import stats
+from event_codes import EventCodes, EventTypes
 
 logger = VCLogger.Logger(VCLogger.Level.ALL)
-logger.success('Imported module uinput.')
 
-class Controller(Thread):
-    """ This class handles the uinput device """
+class Controller:
+    """ This class handles the uinput device of one player.
+    Controllers are hosted by a ControllerHub (see hub.py), which owns the
+    network front end and the emitter thread calling handle_messages. """
     def __init__(
         self,
         name = 'Controller',
@@ -40,213 +40,612 @@ class Controller(Thread):
         device_bus_type = bus_types.BusTypes.USB,
         device_version = 1,
         keys = None,
+        coalesce_reads = False,
+        backend = backends.UinputBackend,
+        warm_standby = False,
+        profiles = None,
+        axis_rate = 0,
     ):
-        """ Set the uinput device settings, and define the list of keys the controller will support """
-        Thread.__init__(self)
+        """ Set the uinput device settings, and define the list of keys the controller will support.
+        keys is a {key name: event} dict or a compiled key_profiles.Profile.
+        profiles is the ProfileLibrary searched by SWITCH_PROFILE messages.
+        If coalesce_reads is True, key events received in the same read are
+        emitted as a single input frame (one SYN_REPORT).
+        backend is called without arguments to create each device (see backends.py).
+        If warm_standby is True, a spare device is kept open so that a reload
+        only has to switch devices. The spare device is registered like any
+        other, so it is visible to applications listing input devices.
+        Axis values (AXIS messages) are coalesced: only the latest value of each
+        axis is emitted, with the next input frame, at the end of each group of
+        messages, or, if axis_rate is set, at most axis_rate times per second. """
         self.name = name
         self.device = None
         self.device_name = device_name
         self.device_bus_type = device_bus_type
         self.device_version = device_version
         if keys is None:
-            self.keys = Keys.KEYS_JOYSTICK
-        else:
-            self.keys = keys
-        self.server_sock = socket_server.SocketServer(cb_read = self.on_client_event, port = 2011)
-
-    def run(self):
-        self.__stop = False
-        """ Start the Controller. Start the TCP socket server and open the uinput device. """
-        logger.info('Starting Controller {}.'.format(self.name))
-        self.open_device()
-        self.start_tcp_server()
-
-        while not self.__stop:
-            time.sleep(1)
-
-        # Stop socket server
-        logger.info('Stopping Controller {}...'.format(self.name))
-        self.stop_tcp_server()
-        self.close_device()
-
-    def stop(self):
-        """ Stop the Controller. Closes the TCP socket server, and closes the uinput device. """
-        self.__stop = True
-
-    def is_running(self):
-        return not self.__stop
+            keys = Keys.KEYS_JOYSTICK
+        if not isinstance(keys, key_profiles.Profile):
+            keys = key_profiles.Profile(name, keys)
+        self.profile = keys
+        self.keys = keys.keys
+        self.profiles = profiles
+        # Profile waiting for a new device, because its events are not registered on the current one
+        self.pending_profile = None
+        self.coalesce_reads = coalesce_reads
+        self.backend = backend
+        self.warm_standby = warm_standby
+        self.standby = None
+        self.reloading = False
+        self.closed = False
+        # Function queuing a (function, argument) call for the thread handling
+        # the messages, set by the ControllerHub. Without it, reloads are synchronous.
+        self.defer = None
+        self.key_state = key_state.KeyState()
+        self.axis_rate = axis_rate
+        # Scheduler timing the axis flushes, set by the ControllerHub
+        self.scheduler = None
+        self.axis_flush_timer = None
+        self.last_axis_flush = 0.0
+        # Latest value of each axis not emitted yet, last emitted value, and
+        # client that moved it last, by event
+        self.pending_axes = {}
+        self.axis_values = {}
+        self.axis_owners = {}
+        # Only written by the emitter thread
+        self.counters = stats.Counters(
+            'messages', 'unsupported_keys', 'unsupported_messages', 'reloads',
+            'axis_updates', 'axis_coalesced', 'axis_emitted')
 
-    def start_tcp_server(self):
-        """ Start the SocketServer thread. """
-        self.server_sock.start()
-
-    def stop_tcp_server(self):
-        """ Stop the SocketServer thread. """
-        self.server_sock.stop()
-        self.server_sock.close()
-        self.server_sock.join()
+    def create_device(self):
+        """ Create and open a new device with the settings of this Controller,
+        registering the events of its profile, or of the profile it switches to.
+        Can be called from any thread; raise an exception if it fails. """
+        profile = self.pending_profile or self.profile
+        device = self.backend()
+        device.open(
+            events = list(profile.events),
+            name = self.device_name,
+            bustype	= self.device_bus_type,
+            vendor = 0,
+            product	= 0,
+            version = self.device_version,
+        )
+        device.registered_events = profile.events
+        return device
 
     def open_device(self):
         """ Open the uinput device for this Controller
         This will exit the program if it fails """
         try:
-            self.device = uinput.Device(
-                events = self.keys.values(),
-                name = self.device_name,
-                bustype	= self.device_bus_type,
-                vendor = 0,
-                product	= 0,
-                version = self.device_version,
-            )
+            self.device = self.create_device()
+            self.key_state.clear()
+            self.compile_keys()
         except Exception as err:
-            Logger.fatal('Failed to open a uinput device. Have you loaded the module (sudo modprobe uinput)? Are you running this script as root?', err)
+            logger.fatal('Failed to open a uinput device. Have you loaded the module (sudo modprobe uinput)? Are you running this script as root?', err)
+        self.closed = False
         logger.success('Opened uinput device for controller ' + self.name)
+        if self.warm_standby:
+            run_in_background(self.prepare_standby)
 
     def close_device(self):
-        """ Close the uinput device for this Controller. """
+        """ Close the uinput device for this Controller, and its standby device. """
+        self.closed = True
+        standby, self.standby = self.standby, None
+        if standby is not None:
+            self.destroy_device(standby)
         try:
             self.device.destroy()
         except Exception as err:
             logger.fatal('Failed to destroy a uinput device.', err)
         logger.success('Destroyed uinput device for controller ' + self.name)
 
+    def destroy_device(self, device):
+        """ Destroy a device that is no longer used. Can be called from any thread. """
+        try:
+            device.destroy()
+        except Exception as err:
+            logger.warning('Failed to destroy a uinput device of controller {}.', self.name, err = err)
+
+    def reload_device(self):
+        """ Replace the device without interrupting the one in use: the new
+        device is taken from the standby, or created in a background thread
+        while the current one keeps emitting events. Only called from the
+        thread handling the messages. """
+        if self.reloading:
+            logger.info('Device of controller {} is already being reloaded.', self.name)
+            return
+        if self.standby is not None:
+            device, self.standby = self.standby, None
+            if self.pending_profile is None or self.pending_profile.fits(device.registered_events):
+                self.switch_device(device)
+                return
+            run_in_background(self.destroy_device, device)
+        if self.defer is None:
+            try:
+                device = self.create_device()
+            except Exception as err:
+                logger.warning('Failed to create a new uinput device, keeping the current one.', err = err)
+                return
+            self.switch_device(device)
+            return
+        self.reloading = True
+        run_in_background(self.prepare_device)
+
+    def prepare_device(self):
+        """ Create the next device in a background thread, and hand it to the thread handling the messages """
+        try:
+            device = self.create_device()
+        except Exception as err:
+            logger.warning('Failed to create a new uinput device, keeping the current one.', err = err)
+            if not self.defer((self.switch_device, None)):
+                self.reloading = False
+            return
+        if not self.defer((self.switch_device, device)):
+            # The emitter is stopped: nothing will switch to the device
+            self.reloading = False
+            self.destroy_device(device)
+
+    def switch_device(self, device):
+        """ Release the held keys on the current device, make the new one
+        current, then destroy the old one in the background. Only called from
+        the thread handling the messages, so no event is emitted meanwhile. """
+        self.reloading = False
+        if device is None:
+            if self.pending_profile is not None:
+                logger.warning('Could not switch to profile {}.', self.pending_profile.name)
+                self.pending_profile = None
+            return
+        if self.closed:
+            self.destroy_device(device)
+            return
+        old_device = self.device
+        held = self.key_state.pressed()
+        if held:
+            old_device.emit_batch([((EventTypes.KEY, code), 0) for code in held])
+        self.key_state.clear()
+        # The new device does not know the axis positions yet
+        self.axis_values.clear()
+        self.device = device
+        logger.info('Device of controller {} switched, released {} held key(s).', self.name, len(held))
+        if self.pending_profile is not None:
+            self.set_profile(self.pending_profile)
+            self.pending_profile = None
+        run_in_background(self.destroy_device, old_device)
+        if self.warm_standby:
+            run_in_background(self.prepare_standby)
+
+    def prepare_standby(self):
+        """ Create a spare device in a background thread """
+        try:
+            device = self.create_device()
+        except Exception as err:
+            logger.warning('Failed to create a standby uinput device.', err = err)
+            return
+        if self.defer is None or not self.defer((self.set_standby, device)):
+            self.set_standby(device)
+
+    def set_standby(self, device):
+        if self.standby is not None or self.closed:
+            run_in_background(self.destroy_device, device)
+            return
+        self.standby = device
+        logger.info('Standby device of controller {} ready.', self.name)
+
+    def switch_profile(self, profile):
+        """ Use another key mapping. If the current device registered every
+        event of the profile, only the lookup table is replaced; otherwise a
+        new device is created, as for a reload. Only called from the thread
+        handling the messages. """
+        if profile is self.profile and self.pending_profile is None:
+            return
+        if self.reloading:
+            logger.warning('Device of controller {} is being reloaded, can not switch profile.', self.name)
+            return
+        if profile.fits(self.device.registered_events):
+            frame = [((EventTypes.KEY, code), 0) for code in self.key_state.pressed()]
+            # The axes of the old profile go back to rest, as its keys are released
+            for axis in self.profile.axes:
+                value = self.axis_values.get(axis.event)
+                if value is not None and value != axis.rest:
+                    frame.append((axis.event, axis.rest))
+            if frame:
+                self.device.emit_batch(frame)
+            self.key_state.clear()
+            self.set_profile(profile)
+            return
+        logger.info('Profile {} needs a new device for controller {}.', profile.name, self.name)
+        self.pending_profile = profile
+        self.reload_device()
+
+    def set_profile(self, profile):
+        """ Replace the compiled key mapping """
+        self.profile = profile
+        self.keys = profile.keys
+        self.key_codes = profile.key_codes
+        self.axis_names = profile.axis_names
+        self.pending_axes.clear()
+        self.axis_values.clear()
+        self.axis_owners.clear()
+        logger.success('Controller {} uses profile {}'.format(self.name, profile.name))
+
     def list_keys(self):
         """ Print a list of keys supported by this controller. """
         print 'Controller ' + self.name + ' supports the following keys:'
         print self.keys.keys()
 
+    def compile_keys(self):
+        """ Build the flat lookup tables used for every event: key name to event
+        code, including case-folded aliases of each name (compiled with the
+        profile), and (title, action) to handler. Called when the device is opened. """
+        self.key_codes = self.profile.key_codes
+        self.axis_names = self.profile.axis_names
+        self.handlers = {
+            (message.Titles.CONTROL, message.Actions.RELOAD_DEVICE): self.on_reload_device,
+            (message.Titles.CONTROL, message.Actions.SWITCH_PROFILE): self.on_switch_profile,
+            (message.Titles.EVENT, message.Actions.PRESSED): self.on_key_pressed,
+            (message.Titles.EVENT, message.Actions.RELEASED): self.on_key_released,
+            (message.Titles.EVENT, message.Actions.BATCH): self.on_batch,
+            (message.Titles.EVENT, message.Actions.SNAPSHOT): self.on_snapshot,
+            (message.Titles.EVENT, message.Actions.AXIS): self.on_axis,
+        }
+
+    def key_code(self, key):
+        """ Return the event emitted for a key name, or None if the key is not supported. """
+        code = self.key_codes.get(key)
+        if code is None:
+            code = self.key_codes.get(key.upper())
+        return code
+
     def has_key(self, key):
         """ Check if this Controller has a given key. """
-        return key in self.keys
+        return self.key_code(key) is not None
 
     def click_key(self, key):
         """ Emit a click for a key. The key must be defined in Controller.keys. """
-        if not self.has_key(key):
-            logger.warning('Key {0} is not supported by this Controller.'.format(key))
+        code = self.key_code(key)
+        if code is None:
+            logger.warning('Key {} is not supported by this Controller.', key)
         else:
-            self.device.emit_click(self.keys[key])
-            logger.event_info('Sending uinput event: click key {} ({}).'.format(key, sekf.keys[key]))
+            self.device.emit_click(code)
+            logger.event_info('Sending uinput event: click key {} ({}).', key, code)
 
-    def press_key(self, key):
-        """ Press down on a key. The key must be defined in Controller.keys. """
-        if not self.has_key(key):
+    def press_key(self, key, client = None):
+        """ Press down on a key. The key must be defined in Controller.keys.
+        Nothing is emitted if the key is already pressed by this client, or by another one. """
+        code = self.key_code(key)
+        if code is None:
             raise ValueError('Key {0} is not supported by this Controller.'.format(key))
+        if not self.key_state.press(client, code[1]):
+            return
+        if self.pending_axes:
+            self.emit_batch([(code, 1)])
         else:
-            self.device.emit(self.keys[key], 1)
-            logger.event_info('Sending uinput event: press key {} ({}).'.format(key, self.keys[key]))
+            self.device.emit(code, 1)
+        logger.event_info('Sending uinput event: press key {} ({}).', key, code)
 
-    def release_key(self, key):
-        """ Release a key. The key must be defined in Controller.keys. """
-        if not self.has_key(key):
+    def release_key(self, key, client = None):
+        """ Release a key. The key must be defined in Controller.keys.
+        Nothing is emitted if this client does not hold the key, or if another client still holds it. """
+        code = self.key_code(key)
+        if code is None:
             raise ValueError('Key {0} is not supported by this Controller.'.format(key))
+        if not self.key_state.release(client, code[1]):
+            return
+        if self.pending_axes:
+            self.emit_batch([(code, 0)])
         else:
-            self.device.emit(self.keys[key], 0)
-            logger.event_info('Sending uinput event: release key {} ({}).'.format(key, self.keys[key]))
-
-    def on_client_event(self, msg):
-        """ Callback function called by the SocketServer when it receives a valid
-        Message. Will trigger the uinput event if the Message is supported by this
-        Cotroller. """
-        logger.info('Controller received message: {}'.format(msg.format_json()))
-        if msg.is_valid():
-            if msg.is_ok():
-                if msg.title == message.Titles.CONTROL:
-                    if msg.action == message.Actions.RELOAD_DEVICE:
-                        logger.info('Reloading device...')
-                        self.close_device()
-                        self.open_device()
-                        logger.info('Device reloaded!')
-                    elif msg.action == message.Actions.STOP_SERVER:
-                        logger.info('Stopping server...')
-                        self.stop()
-                        return
-
-                elif msg.title == message.Titles.EVENT:
-                    # Convert to upper case to ignore case of input
-                    in_key = msg.value.upper()
-
-                    if msg.action == message.Actions.PRESSED:
-                        try:
-                            self.press_key(in_key)
-                        except ValueError as e:
-                            logger.warning(str(e))
-                    elif msg.action == message.Actions.RELEASED:
-                        try:
-                            self.release_key(in_key)
-                        except ValueError as e:
-                            logger.warning(str(e))
-                    else:
-                        logger.warning('Invalid action: {}. Ignoring message.'.format(msg.action))
-
-                else:
-                    logger.info('Message not supported: {}. Ignoring it.'.format(msg.title))
+            self.device.emit(code, 0)
+        logger.event_info('Sending uinput event: release key {} ({}).', key, code)
+
+    def release_client(self, client):
+        """ Release, in a single frame, every key held by a client (e.g. when it
+        disconnects), and bring back the axes it moved last to their rest position. """
+        for event, owner in self.axis_owners.items():
+            if owner == client:
+                del self.axis_owners[event]
+                self.pending_axes[event] = self.profile.axis_events[event].rest
+        codes = self.key_state.release_client(client)
+        if codes:
+            self.emit_batch([((EventTypes.KEY, code), 0) for code in codes])
+            logger.event_info('Sending uinput event: released {} key(s) held by {}.', len(codes), client)
+        elif self.pending_axes:
+            self.flush_axes()
+
+    def set_axis(self, axis, value, client = None):
+        """ Set the next value of an axis of the profile. Only the latest value
+        set before the axes are flushed is emitted. """
+        event = axis.event
+        self.counters.axis_updates += 1
+        if event in self.pending_axes:
+            self.counters.axis_coalesced += 1
+        self.pending_axes[event] = axis.filter(value)
+        self.axis_owners[event] = client
+        if self.axis_rate and self.axis_flush_timer is None and self.scheduler is not None and self.defer is not None:
+            due = max(clock.monotonic(), self.last_axis_flush + 1.0 / self.axis_rate)
+            self.axis_flush_timer = self.scheduler.call_at(due, self.request_axis_flush)
+
+    def request_axis_flush(self, argument = None):
+        """ Called by the scheduler thread: flush the axes in the emitter thread """
+        if not self.defer((self.on_axis_flush_timer, None)):
+            self.axis_flush_timer = None
+
+    def on_axis_flush_timer(self, argument = None):
+        self.axis_flush_timer = None
+        self.flush_axes()
+
+    def take_axes(self):
+        """ Return the (event, value) pairs of the pending axis values that
+        changed since they were last emitted, and forget them. """
+        batch = [(event, value) for event, value in self.pending_axes.items() if self.axis_values.get(event) != value]
+        self.axis_values.update(self.pending_axes)
+        self.pending_axes.clear()
+        self.last_axis_flush = clock.monotonic()
+        self.counters.axis_emitted += len(batch)
+        return batch
+
+    def flush_axes(self, argument = None):
+        """ Emit the pending axis values as an input frame """
+        if not self.pending_axes:
+            return
+        batch = self.take_axes()
+        if batch:
+            self.device.emit_batch(batch)
+            logger.event_info('Sending uinput event: {} axis value(s).', len(batch))
+
+    def emit_batch(self, batch):
+        """ Emit a list of (event, value) pairs as an input frame, with the pending axis values """
+        if self.pending_axes:
+            batch = self.take_axes() + batch
+        self.device.emit_batch(batch)
+
+    def apply_snapshot(self, key_names, client = None):
+        """ Make the keys held by a client match a snapshot of its pressed keys:
+        keys missing from the snapshot are released, new ones are pressed,
+        all in a single frame. """
+        snapshot = {}
+        for key in key_names:
+            code = self.key_code(key)
+            if code is not None and code[0] == EventTypes.KEY:
+                snapshot[code[1]] = code
+
+        held = self.key_state.client_keys.get(client, ())
+        batch = []
+        for code in list(held):
+            if code not in snapshot and self.key_state.release(client, code):
+                batch.append(((EventTypes.KEY, code), 0))
+        for code, event in snapshot.items():
+            if code not in held and self.key_state.press(client, code):
+                batch.append((event, 1))
+        if batch:
+            self.emit_batch(batch)
+            logger.event_info('Sending uinput event: {} key(s) changed by a snapshot from {}.', len(batch), client)
+
+    def key_stats(self):
+        """ Return the counters of emitted and suppressed key transitions. """
+        return self.key_state.stats()
+
+    def stats(self):
+        """ Return the message, error and reload counters, and the key transition counters. """
+        controller_stats = self.counters.snapshot()
+        controller_stats['keys'] = self.key_state.stats()
+        return controller_stats
+
+    def emit_frame(self, events, client = None):
+        """ Emit a list of (key, value) transitions as a single input frame:
+        every event is written without synchronization, followed by one SYN_REPORT.
+        Unsupported keys are skipped with a warning, transitions that do not
+        change the state of the device are suppressed. """
+        batch = []
+        for key, value in events:
+            code = self.key_code(key)
+            if code is None:
+                self.counters.unsupported_keys += 1
+                logger.warning('Key {} is not supported by this Controller.', key)
+                continue
+            if value:
+                changed = self.key_state.press(client, code[1])
             else:
-                logger.warning('Message status is not OK, ignoring it.')
-        else:
-            logger.warning("This message is not valid. Shouldn't have called on_client_event...")
+                changed = self.key_state.release(client, code[1])
+            if not changed:
+                continue
+            batch.append((code, value))
+            logger.event_info('Sending uinput event: key {} ({}) value {}, no sync.', key, code, value)
+        if batch:
+            self.emit_batch(batch)
+            logger.event_info('Sending uinput event: sync {} event(s).', len(batch))
+
+    def key_events(self, msg):
+        """ Return the list of (key, value) transitions carried by an EVENT Message,
+        or None if the Message is not a valid key event. """
+        if msg.title != message.Titles.EVENT or not msg.is_ok():
+            return None
+        if msg.action == message.Actions.BATCH:
+            try:
+                return [(key, KEY_VALUES[action]) for key, action in msg.value]
+            except (KeyError, TypeError, ValueError, AttributeError):
+                logger.warning('Invalid batch: {}. Ignoring message.', msg.value)
+                return []
+        value = KEY_VALUES.get(msg.action)
+        if value is None:
+            return None
+        return [(msg.value, value)]
+
+    def handle_messages(self, msgs):
+        """ Handle a list of Messages. Only called from the emitter thread.
+        With coalesce_reads, consecutive key events are merged in one frame.
+        Axis values still pending are flushed at the end, unless axis_rate is set. """
+        self.counters.messages += len(msgs)
+        if not self.coalesce_reads or len(msgs) == 1:
+            for msg in msgs:
+                self.handle_message(msg)
+            if self.pending_axes and self.axis_flush_timer is None:
+                self.flush_axes()
+            return
+
+        frame = []
+        client = None
+        for msg in msgs:
+            events = self.key_events(msg)
+            if events is None or msg.client != client:
+                if frame:
+                    self.emit_frame(frame, client)
+                    frame = []
+                client = msg.client
+            if events is None:
+                self.handle_message(msg)
+            else:
+                frame.extend(events)
+        if frame:
+            self.emit_frame(frame, client)
+        if self.pending_axes and self.axis_flush_timer is None:
+            self.flush_axes()
+
+    def handle_message(self, msg):
+        """ Trigger the uinput event if the Message is supported by this
+        Cotroller. Only called from the emitter thread, so that a single thread
+        ever writes to, or reloads, the device. """
+        logger.info('Controller received message: {} {} {}', msg.title, msg.action, msg.value)
+        if msg.status != message.StatusCodes.OK:
+            logger.warning('Message status is not OK, ignoring it.')
+            return
+
+        handler = self.handlers.get((msg.title, msg.action))
+        if handler is None:
+            self.counters.unsupported_messages += 1
+            logger.info('Message not supported: {} {}. Ignoring it.', msg.title, msg.action)
+            return
+        handler(msg)
+
+    def on_reload_device(self, msg):
+        logger.info('Reloading device...')
+        self.counters.reloads += 1
+        self.reload_device()
+
+    def on_switch_profile(self, msg):
+        if self.profiles is None:
+            logger.warning('Controller {} has no profiles to switch to.', self.name)
+            return
+        try:
+            profile = self.profiles.get(msg.value)
+        except key_profiles.ProfileError as e:
+            logger.warning('{}', e)
+            return
+        self.switch_profile(profile)
+
+    def on_key_pressed(self, msg):
+        try:
+            self.press_key(msg.value, msg.client)
+        except ValueError as e:
+            self.counters.unsupported_keys += 1
+            logger.warning('{}', e)
+
+    def on_key_released(self, msg):
+        try:
+            self.release_key(msg.value, msg.client)
+        except ValueError as e:
+            self.counters.unsupported_keys += 1
+            logger.warning('{}', e)
+
+    def on_batch(self, msg):
+        self.emit_frame(self.key_events(msg), msg.client)
+
+    def on_axis(self, msg):
+        try:
+            name, value = msg.value
+            axis = self.axis_names.get(name.upper())
+            value = int(value)
+        except (TypeError, ValueError, AttributeError):
+            logger.warning('Invalid axis value: {}. Ignoring message.', msg.value)
+            return
+        if axis is None:
+            self.counters.unsupported_keys += 1
+            logger.warning('Axis {} is not supported by this Controller.', name)
+            return
+        self.set_axis(axis, value, msg.client)
+
+    def on_snapshot(self, msg):
+        if not isinstance(msg.value, list):
+            logger.warning('Invalid snapshot: {}. Ignoring message.', msg.value)
+            return
+        self.apply_snapshot(msg.value, msg.client)
+
+def run_in_background(function, *args):
+    """ Call a function in a new daemon thread """
+    thread = Thread(target = function, args = args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+# Value emitted for each key action
+KEY_VALUES = {
+    message.Actions.PRESSED: 1,
+    message.Actions.RELEASED: 0,
+}
 
 class Keys:
-    """ This class lists the keys used on controllers """
+    """ This class lists the keys used on controllers. The same mappings are
+    available as profiles (joystick, test_2 and test) in VCServer/profiles. """
     KEYS_JOYSTICK = {
-        'A': uinput.KEY_A,
-        'Z': uinput.KEY_B,
-        'S': uinput.KEY_X,
-        'D': uinput.KEY_Y,
-        '1': uinput.KEY_1, # Player 1
-        '2': uinput.KEY_2, # Player 2
-        'KEY.ENTER': uinput.KEY_ENTER, # start
-        'KEY.SPACE':uinput.KEY_SPACE, # select
-        'C': uinput.KEY_C, # insert coin
-        'KEY.LEFT': uinput.KEY_LEFT, # left
-        'KEY.RIGHT': uinput.KEY_RIGHT, # right
-        'KEY.UP': uinput.KEY_UP, # up
-        'KEY.DOWN': uinput.KEY_DOWN, # down
-        'KEY.F4': uinput.KEY_F4, # F4
-        'KEY.SHIFT': uinput.KEY_LEFTSHIFT,  # Left shoulder to load a save
-        'KEY.SHIFT_R': uinput.KEY_RIGHTSHIFT,  # Right shoulder to save game
+        'A': EventCodes.KEY_A,
+        'Z': EventCodes.KEY_B,
+        'S': EventCodes.KEY_X,
+        'D': EventCodes.KEY_Y,
+        '1': EventCodes.KEY_1, # Player 1
+        '2': EventCodes.KEY_2, # Player 2
+        'KEY.ENTER': EventCodes.KEY_ENTER, # start
+        'KEY.SPACE':EventCodes.KEY_SPACE, # select
+        'C': EventCodes.KEY_C, # insert coin
+        'KEY.LEFT': EventCodes.KEY_LEFT, # left
+        'KEY.RIGHT': EventCodes.KEY_RIGHT, # right
+        'KEY.UP': EventCodes.KEY_UP, # up
+        'KEY.DOWN': EventCodes.KEY_DOWN, # down
+        'KEY.F4': EventCodes.KEY_F4, # F4
+        'KEY.SHIFT': EventCodes.KEY_LEFTSHIFT,  # Left shoulder to load a save
+        'KEY.SHIFT_R': EventCodes.KEY_RIGHTSHIFT,  # Right shoulder to save game
     }
 
     KEYS_TEST_2 = {
-        'A': uinput.BTN_A,
-        'Z': uinput.BTN_B,
-        'S': uinput.BTN_X,
-        'D': uinput.BTN_Y,
-        'KEY.SHIFT': uinput.BTN_TL,
-        'KEY.CAPS_LOCK': uinput.BTN_TL2,
-        'KEY.SHIFT_R': uinput.BTN_TR,
-        '`': uinput.BTN_TR2,
-        '1': uinput.BTN_1, # Player 1
-        '2': uinput.BTN_2, # Player 2
-        'KEY.ENTER': uinput.BTN_START, # start
-        'KEY.SPACE':uinput.BTN_SELECT, # select
-        'M': uinput.BTN_MODE,
-        'KEY.CMD': uinput.BTN_THUMBL,
-        'KEY.CMD_R': uinput.BTN_THUMBR,
-        'C': uinput.BTN_C, # insert coin
-        'Z': uinput.BTN_Z, # Dont know
-        'KEY.LEFT': uinput.BTN_DPAD_LEFT, # left
-        'KEY.RIGHT': uinput.BTN_DPAD_RIGHT, # right
-        'KEY.UP': uinput.BTN_DPAD_UP, # up
-        'KEY.DOWN': uinput.BTN_DPAD_DOWN, # down
-        'KEY.F4': uinput.KEY_F4, # F4
+        'A': EventCodes.BTN_A,
+        'Z': EventCodes.BTN_B,
+        'S': EventCodes.BTN_X,
+        'D': EventCodes.BTN_Y,
+        'KEY.SHIFT': EventCodes.BTN_TL,
+        'KEY.CAPS_LOCK': EventCodes.BTN_TL2,
+        'KEY.SHIFT_R': EventCodes.BTN_TR,
+        '`': EventCodes.BTN_TR2,
+        '1': EventCodes.BTN_1, # Player 1
+        '2': EventCodes.BTN_2, # Player 2
+        'KEY.ENTER': EventCodes.BTN_START, # start
+        'KEY.SPACE':EventCodes.BTN_SELECT, # select
+        'M': EventCodes.BTN_MODE,
+        'KEY.CMD': EventCodes.BTN_THUMBL,
+        'KEY.CMD_R': EventCodes.BTN_THUMBR,
+        'C': EventCodes.BTN_C, # insert coin
+        'W': EventCodes.BTN_Z,
+        'KEY.LEFT': EventCodes.BTN_DPAD_LEFT, # left
+        'KEY.RIGHT': EventCodes.BTN_DPAD_RIGHT, # right
+        'KEY.UP': EventCodes.BTN_DPAD_UP, # up
+        'KEY.DOWN': EventCodes.BTN_DPAD_DOWN, # down
+        'KEY.F4': EventCodes.KEY_F4, # F4
     }
 
     KEYS_TEST = {
-        'A': uinput.BTN_A,
-        'Z': uinput.BTN_B,
-        'C': uinput.BTN_C,
-        'S': uinput.BTN_X,
-        'D': uinput.BTN_Y,
-        'W': uinput.BTN_Z,
-        'KEY.SHIFT':        uinput.BTN_TL,  # Trigger Left
-        'KEY.SHIFT_R':      uinput.BTN_TR,  # Trigger Right
-        'KEY.CAPS_LOCK':    uinput.BTN_TL2, # Trigger Left 2
-        '`':            uinput.BTN_TR2,     # Trigger Right 2
-        'KEY.CMD':      uinput.BTN_SELECT,  # Select
-        'KEY.CMD_R':    uinput.BTN_START,   # Start
-        'M':            uinput.BTN_MODE,    # Mode
-        'KEY.ALT':      uinput.BTN_THUMBL,  # Thumb Left
-        'KEY.ALT_R':    uinput.BTN_THUMBR,  # Thumb Right
+        'A': EventCodes.BTN_A,
+        'Z': EventCodes.BTN_B,
+        'C': EventCodes.BTN_C,
+        'S': EventCodes.BTN_X,
+        'D': EventCodes.BTN_Y,
+        'W': EventCodes.BTN_Z,
+        'KEY.SHIFT':        EventCodes.BTN_TL,  # Trigger Left
+        'KEY.SHIFT_R':      EventCodes.BTN_TR,  # Trigger Right
+        'KEY.CAPS_LOCK':    EventCodes.BTN_TL2, # Trigger Left 2
+        '`':            EventCodes.BTN_TR2,     # Trigger Right 2
+        'KEY.CMD':      EventCodes.BTN_SELECT,  # Select
+        'KEY.CMD_R':    EventCodes.BTN_START,   # Start
+        'M':            EventCodes.BTN_MODE,    # Mode
+        'KEY.ALT':      EventCodes.BTN_THUMBL,  # Thumb Left
+        'KEY.ALT_R':    EventCodes.BTN_THUMBR,  # Thumb Right
     }
 
     #KEY_STOP_CONTROLLER = 'KEY.ESC'
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""
+Emit stage between the network and the uinput device.
+Network threads push decoded events in a bounded EventQueue, and a single
+Emitter thread drains it, so the device is only ever written from one thread.
+Only items flagged as droppable (key presses, whose loss can not leave a key
+held) are ever discarded when the queue is full. Releases and internal calls
+(device switches, macro steps, axis flushes...) are always run.
+"""
+
+import sys
+import time
+from collections import deque
+from threading import Condition, Thread
+
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from VCCommon import clock
+from VCCommon import VCLogger
+
+import realtime
+
+logger = VCLogger.Logger(VCLogger.Level.ALL)
+
+class Backpressure:
+    """ What EventQueue.put does when the queue is full """
+    DROP_OLDEST = "DROP_OLDEST" # Discard the oldest droppable item to make room
+    BLOCK       = "BLOCK"       # Wait until the Emitter made room
+
+class EventQueue:
+    """ Bounded FIFO queue with a single consumer.
+    The consumer takes every queued item at once, so the lock is taken once
+    per batch rather than once per item. Items are queued as (droppable, item)
+    pairs. """
+
+    def __init__(self, max_size = 1024, backpressure = Backpressure.DROP_OLDEST):
+        if backpressure not in (Backpressure.DROP_OLDEST, Backpressure.BLOCK):
+            raise ValueError('Unknown backpressure policy: {}'.format(backpressure))
+        self.max_size = max_size
+        self.backpressure = backpressure
+        self.items = deque()
+        self.cond = Condition()
+        self.closed = False
+        self.put_count = 0
+        self.dropped = 0
+        self.max_depth = 0
+        # Number of droppable items queued
+        self.droppable_count = 0
+        # Items queued beyond max_size because nothing could be dropped
+        self.overflowed = 0
+        # Written by the consumer only
+        self.spin_wakeups = 0
+        self.blocking_waits = 0
+
+    def put(self, item, droppable = False):
+        """ Queue an item received from a client. When the queue is full,
+        BLOCK waits for room; DROP_OLDEST discards the oldest droppable item,
+        or this item if it is droppable and no other is queued, and otherwise
+        queues it beyond max_size.
+        Return False if it could not be queued because the queue is closed. """
+        with self.cond:
+            if self.closed:
+                return False
+            if len(self.items) >= self.max_size:
+                if self.backpressure == Backpressure.BLOCK:
+                    while len(self.items) >= self.max_size and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        return False
+                elif self.droppable_count:
+                    self.drop_oldest()
+                elif droppable:
+                    self.dropped += 1
+                    return True
+                else:
+                    self.overflowed += 1
+            self.append(item, droppable)
+        return True
+
+    def put_control(self, item):
+        """ Queue an internal item: it is never dropped and never waits for
+        room, so that it can be queued from any thread, the consumer included.
+        Return False if the queue is closed. """
+        with self.cond:
+            if self.closed:
+                return False
+            if len(self.items) >= self.max_size:
+                self.overflowed += 1
+            self.append(item, False)
+        return True
+
+    def append(self, item, droppable):
+        """ Called with the lock held """
+        items = self.items
+        items.append((droppable, item))
+        if droppable:
+            self.droppable_count += 1
+        self.put_count += 1
+        depth = len(items)
+        if depth > self.max_depth:
+            self.max_depth = depth
+        if depth == 1:
+            self.cond.notify_all()
+
+    def drop_oldest(self):
+        """ Discard the oldest droppable item. Called with the lock held,
+        when the queue is full: droppable items are then most of it, so the
+        first one is near the head. """
+        items = self.items
+        for i, (droppable, item) in enumerate(items):
+            if droppable:
+                del items[i]
+                self.droppable_count -= 1
+                self.dropped += 1
+                return
+
+    def get_all(self, spin = 0.0):
+        """ Wait for items and return all of them as (droppable, item) pairs, oldest first.
+        Return an empty deque once the queue is closed and empty.
+        If spin is set, poll the queue for up to spin seconds before waiting
+        on the condition, to avoid the wake-up latency of a blocked thread. """
+        if spin and not self.items and not self.closed:
+            deadline = clock.monotonic() + spin
+            # Reading the length without the lock is safe under the GIL
+            while not self.items and not self.closed and clock.monotonic() < deadline:
+                # Releases the GIL, so that the producers can run
+                time.sleep(0)
+            if self.items:
+                self.spin_wakeups += 1
+        with self.cond:
+            if not self.items and not self.closed:
+                self.blocking_waits += 1
+            while not self.items and not self.closed:
+                self.cond.wait()
+            items = self.items
+            self.items = deque()
+            self.droppable_count = 0
+            if self.backpressure == Backpressure.BLOCK:
+                self.cond.notify_all()
+        return items
+
+    def close(self):
+        """ Refuse new items and wake up the consumer and blocked producers """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def depth(self):
+        return len(self.items)
+
+    def stats(self):
+        """ Return the queue counters """
+        return {
+            'depth': len(self.items),
+            'max_depth': self.max_depth,
+            'queued': self.put_count,
+            'dropped': self.dropped,
+            'overflowed': self.overflowed,
+            'spin_wakeups': self.spin_wakeups,
+            'blocking_waits': self.blocking_waits,
+        }
+
+class Emitter(Thread):
+    """ Thread draining an EventQueue into a handler function.
+    The handler is the only code writing to the device. """
+
+    def __init__(self, handler, max_size = 1024, backpressure = Backpressure.DROP_OLDEST, realtime_config = None):
+        """ realtime_config is the realtime.RealtimeConfig of the thread, if any """
+        Thread.__init__(self)
+        self.daemon = True
+        self.handler = handler
+        self.queue = EventQueue(max_size, backpressure)
+        self.realtime_config = realtime_config
+        self.realtime_report = None
+
+    def put(self, item, droppable = False):
+        """ Queue an item received from a client for the handler """
+        return self.queue.put(item, droppable)
+
+    def put_control(self, item):
+        """ Queue an internal item for the handler, it is never dropped """
+        return self.queue.put_control(item)
+
+    def run(self):
+        logger.info('Starting emitter (queue size {}, {})', self.queue.max_size, self.queue.backpressure)
+        self.realtime_report = realtime.apply('emitter', self.realtime_config)
+        spin = self.realtime_config.busy_poll if self.realtime_config is not None else 0.0
+        while True:
+            items = self.queue.get_all(spin)
+            if not items:
+                break
+            for droppable, item in items:
+                try:
+                    self.handler(item)
+                except Exception as err:
+                    logger.warning('Emitter failed to handle an event.', err = err)
+        logger.info('Emitter stopped')
+
+    def stop(self):
+        """ Stop the Emitter once the queued items are handled """
+        self.queue.close()
+
+    def stats(self):
+        return self.queue.stats()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+class EventTypes:
+    """ This class defines the event types as defined in /usr/include/linux/input-event-codes.h """
+    SYN = 0x00
+    KEY = 0x01
+    REL = 0x02
+    ABS = 0x03
+
+SYN_REPORT = 0x00
+KEY_MAX = 0x2ff
+ABS_MAX = 0x3f
+
+class EventCodes:
+    """ This class defines the events as defined in /usr/include/linux/input-event-codes.h
+    Each event is a (type, code) tuple, the same format as the constants of python-uinput. """
+    KEY_ESC         = (EventTypes.KEY, 1)
+    KEY_1           = (EventTypes.KEY, 2)
+    KEY_2           = (EventTypes.KEY, 3)
+    KEY_3           = (EventTypes.KEY, 4)
+    KEY_4           = (EventTypes.KEY, 5)
+    KEY_5           = (EventTypes.KEY, 6)
+    KEY_6           = (EventTypes.KEY, 7)
+    KEY_7           = (EventTypes.KEY, 8)
+    KEY_8           = (EventTypes.KEY, 9)
+    KEY_9           = (EventTypes.KEY, 10)
+    KEY_0           = (EventTypes.KEY, 11)
+    KEY_MINUS       = (EventTypes.KEY, 12)
+    KEY_EQUAL       = (EventTypes.KEY, 13)
+    KEY_BACKSPACE   = (EventTypes.KEY, 14)
+    KEY_TAB         = (EventTypes.KEY, 15)
+    KEY_Q           = (EventTypes.KEY, 16)
+    KEY_W           = (EventTypes.KEY, 17)
+    KEY_E           = (EventTypes.KEY, 18)
+    KEY_R           = (EventTypes.KEY, 19)
+    KEY_T           = (EventTypes.KEY, 20)
+    KEY_Y           = (EventTypes.KEY, 21)
+    KEY_U           = (EventTypes.KEY, 22)
+    KEY_I           = (EventTypes.KEY, 23)
+    KEY_O           = (EventTypes.KEY, 24)
+    KEY_P           = (EventTypes.KEY, 25)
+    KEY_LEFTBRACE   = (EventTypes.KEY, 26)
+    KEY_RIGHTBRACE  = (EventTypes.KEY, 27)
+    KEY_ENTER       = (EventTypes.KEY, 28)
+    KEY_LEFTCTRL    = (EventTypes.KEY, 29)
+    KEY_A           = (EventTypes.KEY, 30)
+    KEY_S           = (EventTypes.KEY, 31)
+    KEY_D           = (EventTypes.KEY, 32)
+    KEY_F           = (EventTypes.KEY, 33)
+    KEY_G           = (EventTypes.KEY, 34)
+    KEY_H           = (EventTypes.KEY, 35)
+    KEY_J           = (EventTypes.KEY, 36)
+    KEY_K           = (EventTypes.KEY, 37)
+    KEY_L           = (EventTypes.KEY, 38)
+    KEY_SEMICOLON   = (EventTypes.KEY, 39)
+    KEY_APOSTROPHE  = (EventTypes.KEY, 40)
+    KEY_GRAVE       = (EventTypes.KEY, 41)
+    KEY_LEFTSHIFT   = (EventTypes.KEY, 42)
+    KEY_BACKSLASH   = (EventTypes.KEY, 43)
+    KEY_Z           = (EventTypes.KEY, 44)
+    KEY_X           = (EventTypes.KEY, 45)
+    KEY_C           = (EventTypes.KEY, 46)
+    KEY_V           = (EventTypes.KEY, 47)
+    KEY_B           = (EventTypes.KEY, 48)
+    KEY_N           = (EventTypes.KEY, 49)
+    KEY_M           = (EventTypes.KEY, 50)
+    KEY_COMMA       = (EventTypes.KEY, 51)
+    KEY_DOT         = (EventTypes.KEY, 52)
+    KEY_SLASH       = (EventTypes.KEY, 53)
+    KEY_RIGHTSHIFT  = (EventTypes.KEY, 54)
+    KEY_LEFTALT     = (EventTypes.KEY, 56)
+    KEY_SPACE       = (EventTypes.KEY, 57)
+    KEY_CAPSLOCK    = (EventTypes.KEY, 58)
+    KEY_F1          = (EventTypes.KEY, 59)
+    KEY_F2          = (EventTypes.KEY, 60)
+    KEY_F3          = (EventTypes.KEY, 61)
+    KEY_F4          = (EventTypes.KEY, 62)
+    KEY_F5          = (EventTypes.KEY, 63)
+    KEY_F6          = (EventTypes.KEY, 64)
+    KEY_F7          = (EventTypes.KEY, 65)
+    KEY_F8          = (EventTypes.KEY, 66)
+    KEY_F9          = (EventTypes.KEY, 67)
+    KEY_F10         = (EventTypes.KEY, 68)
+    KEY_NUMLOCK     = (EventTypes.KEY, 69)
+    KEY_SCROLLLOCK  = (EventTypes.KEY, 70)
+    KEY_F11         = (EventTypes.KEY, 87)
+    KEY_F12         = (EventTypes.KEY, 88)
+    KEY_RIGHTCTRL   = (EventTypes.KEY, 97)
+    KEY_RIGHTALT    = (EventTypes.KEY, 100)
+    KEY_HOME        = (EventTypes.KEY, 102)
+    KEY_UP          = (EventTypes.KEY, 103)
+    KEY_PAGEUP      = (EventTypes.KEY, 104)
+    KEY_LEFT        = (EventTypes.KEY, 105)
+    KEY_RIGHT       = (EventTypes.KEY, 106)
+    KEY_END         = (EventTypes.KEY, 107)
+    KEY_DOWN        = (EventTypes.KEY, 108)
+    KEY_PAGEDOWN    = (EventTypes.KEY, 109)
+    KEY_INSERT      = (EventTypes.KEY, 110)
+    KEY_DELETE      = (EventTypes.KEY, 111)
+    KEY_PAUSE       = (EventTypes.KEY, 119)
+    KEY_LEFTMETA    = (EventTypes.KEY, 125)
+    KEY_RIGHTMETA   = (EventTypes.KEY, 126)
+
+    BTN_0           = (EventTypes.KEY, 0x100)
+    BTN_1           = (EventTypes.KEY, 0x101)
+    BTN_2           = (EventTypes.KEY, 0x102)
+    BTN_3           = (EventTypes.KEY, 0x103)
+    BTN_4           = (EventTypes.KEY, 0x104)
+    BTN_5           = (EventTypes.KEY, 0x105)
+    BTN_6           = (EventTypes.KEY, 0x106)
+    BTN_7           = (EventTypes.KEY, 0x107)
+    BTN_8           = (EventTypes.KEY, 0x108)
+    BTN_9           = (EventTypes.KEY, 0x109)
+    BTN_TRIGGER     = (EventTypes.KEY, 0x120)
+    BTN_A           = (EventTypes.KEY, 0x130)
+    BTN_B           = (EventTypes.KEY, 0x131)
+    BTN_C           = (EventTypes.KEY, 0x132)
+    BTN_X           = (EventTypes.KEY, 0x133)
+    BTN_Y           = (EventTypes.KEY, 0x134)
+    BTN_Z           = (EventTypes.KEY, 0x135)
+    BTN_TL          = (EventTypes.KEY, 0x136)
+    BTN_TR          = (EventTypes.KEY, 0x137)
+    BTN_TL2         = (EventTypes.KEY, 0x138)
+    BTN_TR2         = (EventTypes.KEY, 0x139)
+    BTN_SELECT      = (EventTypes.KEY, 0x13a)
+    BTN_START       = (EventTypes.KEY, 0x13b)
+    BTN_MODE        = (EventTypes.KEY, 0x13c)
+    BTN_THUMBL      = (EventTypes.KEY, 0x13d)
+    BTN_THUMBR      = (EventTypes.KEY, 0x13e)
+    BTN_DPAD_UP     = (EventTypes.KEY, 0x220)
+    BTN_DPAD_DOWN   = (EventTypes.KEY, 0x221)
+    BTN_DPAD_LEFT   = (EventTypes.KEY, 0x222)
+    BTN_DPAD_RIGHT  = (EventTypes.KEY, 0x223)
+
+    ABS_X           = (EventTypes.ABS, 0x00)
+    ABS_Y           = (EventTypes.ABS, 0x01)
+    ABS_Z           = (EventTypes.ABS, 0x02)
+    ABS_RX          = (EventTypes.ABS, 0x03)
+    ABS_RY          = (EventTypes.ABS, 0x04)
+    ABS_RZ          = (EventTypes.ABS, 0x05)
+    ABS_THROTTLE    = (EventTypes.ABS, 0x06)
+    ABS_RUDDER      = (EventTypes.ABS, 0x07)
+    ABS_WHEEL       = (EventTypes.ABS, 0x08)
+    ABS_GAS         = (EventTypes.ABS, 0x09)
+    ABS_BRAKE       = (EventTypes.ABS, 0x0a)
+    ABS_HAT0X       = (EventTypes.ABS, 0x10)
+    ABS_HAT0Y       = (EventTypes.ABS, 0x11)
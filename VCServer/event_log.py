@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+Append-only binary log of the events emitted on the devices, used to
+reproduce a session with replay.py.
+
+The file starts with a header (little endian, 16 bytes):
+    magic       8 bytes, LOG_MAGIC
+    start time  double, wall clock time when the log was created
+followed by fixed-size records (little endian, 18 bytes):
+    timestamp   double, monotonic time in seconds
+    controller  unsigned short, id of the controller
+    type        unsigned short, event type (see event_codes.py)
+    code        unsigned short, event code
+    value       int, event value
+A SYN_REPORT is recorded at the end of every input frame. Every session
+appended to the log starts with a session record (controller and type
+SESSION), whose value is the wall clock time in seconds: the monotonic
+clock of a session has nothing to do with the one of the previous session
+(e.g. after a reboot), so readers must reset their time base on it.
+"""
+
+import mmap
+import struct
+import sys
+import time
+from threading import Lock
+
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from VCCommon import clock
+
+from event_codes import EventTypes, SYN_REPORT
+
+LOG_MAGIC = 'VCLOG\x00\x00\x01'
+HEADER = struct.Struct('<8sd')
+RECORD = struct.Struct('<dHHHi')
+# Controller id and event type of the record starting a session
+SESSION = 0xffff
+
+class EventLogError(ValueError):
+    """ Raised when a file is not an event log """
+    pass
+
+class EventLog:
+    """ Writer of an event log. Records are packed in memory and written by
+    a buffered file, flushed when flush_interval seconds have passed since
+    the last flush or flush_size bytes are pending, so that a crash loses at
+    most that much of the session. close() flushes the rest. """
+
+    def __init__(self, file_path, buffer_size = 1 << 16, flush_interval = 1.0, flush_size = 1 << 14):
+        self.file_path = file_path
+        self.file = open(file_path, 'ab', buffer_size)
+        if self.file.tell() == 0:
+            self.file.write(HEADER.pack(LOG_MAGIC, time.time()))
+        self.file.write(RECORD.pack(clock.monotonic(), SESSION, SESSION, 0, int(time.time())))
+        self.lock = Lock()
+        self.record_count = 0
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.pending_size = 0
+        self.flushed_at = clock.monotonic()
+
+    def write_frame(self, controller_id, events, syn = True):
+        """ Record a list of (event, value) pairs, followed by a SYN_REPORT if syn is True """
+        timestamp = clock.monotonic()
+        pack = RECORD.pack
+        records = [pack(timestamp, controller_id, event[0], event[1], value) for event, value in events]
+        if syn:
+            records.append(pack(timestamp, controller_id, EventTypes.SYN, SYN_REPORT, 0))
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(''.join(records))
+            self.record_count += len(records)
+            self.pending_size += len(records) * RECORD.size
+            if self.pending_size >= self.flush_size or timestamp - self.flushed_at >= self.flush_interval:
+                self._flush(timestamp)
+
+    def _flush(self, now):
+        self.file.flush()
+        self.pending_size = 0
+        self.flushed_at = now
+
+    def schedule_flush(self, scheduler):
+        """ Also check the flush interval from a Scheduler, so that the tail of
+        a burst does not stay in the buffer until the next frame """
+        def check(argument):
+            with self.lock:
+                if self.file is None:
+                    return
+                now = clock.monotonic()
+                if self.pending_size and now - self.flushed_at >= self.flush_interval:
+                    self._flush(now)
+            scheduler.call_later(self.flush_interval, check)
+        scheduler.call_later(self.flush_interval, check)
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self._flush(clock.monotonic())
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+class LoggingBackend:
+    """ Device backend writing every emitted frame to an EventLog, and
+    forwarding it to another backend. """
+
+    def __init__(self, device, log, controller_id):
+        self.device = device
+        self.log = log
+        self.controller_id = controller_id
+
+    def open(self, events, name, bustype, vendor, product, version):
+        self.device.open(events, name, bustype, vendor, product, version)
+
+    def emit(self, event, value, syn = True):
+        self.device.emit(event, value, syn)
+        self.log.write_frame(self.controller_id, [(event, value)], syn)
+
+    def emit_batch(self, events):
+        self.device.emit_batch(events)
+        self.log.write_frame(self.controller_id, events)
+
+    def emit_click(self, event):
+        self.device.emit_click(event)
+        self.log.write_frame(self.controller_id, [(event, 1)])
+        self.log.write_frame(self.controller_id, [(event, 0)])
+
+    def syn(self):
+        self.device.syn()
+        self.log.write_frame(self.controller_id, [])
+
+    def destroy(self):
+        self.device.destroy()
+
+def logging_backend(backend, log, controller_id):
+    """ Return a backend factory creating devices of the given backend, logged to log """
+    def create():
+        return LoggingBackend(backend(), log, controller_id)
+    return create
+
+class EventLogReader:
+    """ Memory-mapped event log. Iterating returns the records as
+    (timestamp, controller, type, code, value) tuples, session records
+    included (see is_session). """
+
+    def __init__(self, file_path):
+        self.file = open(file_path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        except ValueError:
+            # mmap refuses empty files
+            self.file.close()
+            raise EventLogError('{} is empty.'.format(file_path))
+        if len(self.map) < HEADER.size:
+            self.close()
+            raise EventLogError('{} is not an event log.'.format(file_path))
+        magic, self.start_time = HEADER.unpack_from(self.map, 0)
+        if magic != LOG_MAGIC:
+            self.close()
+            raise EventLogError('{} is not an event log.'.format(file_path))
+        # A record being written when the log was copied may be incomplete
+        self.record_count = (len(self.map) - HEADER.size) // RECORD.size
+
+    def __len__(self):
+        return self.record_count
+
+    def __iter__(self):
+        unpack_from = RECORD.unpack_from
+        buf = self.map
+        offset = HEADER.size
+        for i in xrange(self.record_count):
+            yield unpack_from(buf, offset)
+            offset += RECORD.size
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+def is_session(record):
+    """ Return True if a record read from a log starts a session """
+    return record[1] == SESSION and record[2] == SESSION
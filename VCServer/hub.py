@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+
+"""
+Host several Controllers behind a single network front end.
+All clients connect to the same SocketServer; each message is routed to a
+Controller by its controller field, or by the controller its connection was
+bound to (see message.Actions.BIND). A single Emitter thread writes to all
+the devices, so the number of threads does not grow with the number of players.
+"""
+
+import sys
+from threading import Event, Thread
+
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from VCCommon import clock
+from VCCommon import message
+from VCCommon import VCLogger
+
+import emitter
+import latency as latency_stats
+import macros
+import playout
+import scheduler
+import socket_server
+import stats
+
+logger = VCLogger.Logger(VCLogger.Level.ALL)
+
+class ControllerHub(Thread):
+    """ Run a SocketServer and an Emitter for a list of Controllers.
+    Controller ids are their index in the list. """
+
+    def __init__(
+        self,
+        controllers,
+        host = '0.0.0.0',
+        port = 2011,
+        max_clients = 8,
+        queue_size = 1024,
+        backpressure = emitter.Backpressure.DROP_OLDEST,
+        udp_port = None,
+        latency = False,
+        unix_path = None,
+        ring_path = None,
+        ring_slots = 1024,
+        playout_delay = None,
+        controller_ids = None,
+        worker = None,
+        network_realtime = None,
+        emitter_realtime = None,
+        heartbeat_timeout = None,
+        tcp_keepalive = None,
+    ):
+        """ queue_size and backpressure configure the queue between the network and the devices.
+        If udp_port is set, key events are also accepted as UDP datagrams on that port.
+        If latency is True, the time spent by every Message in each stage is
+        measured (see latency.py).
+        unix_path and ring_path add the same-host transports of SocketServer.
+        If playout_delay is set to a (min, max) pair of seconds, timestamped
+        events are played with their original spacing (see playout.py).
+        controller_ids are the ids of the controllers, their index by default.
+        worker is the supervisor.WorkerLink of a hub running in a worker process:
+        the port is shared with the other workers, and connections and control
+        messages for their controllers are passed to them.
+        network_realtime and emitter_realtime are the realtime.RealtimeConfig
+        of the socket server and emitter threads.
+        heartbeat_timeout and tcp_keepalive detect dead clients, whose keys are
+        then released (see SocketServer). """
+        Thread.__init__(self)
+        self.controllers = list(controllers)
+        if controller_ids is None:
+            controller_ids = range(len(self.controllers))
+        self.controllers_by_id = dict(zip(controller_ids, self.controllers))
+        self.worker = worker
+        self.scheduler = scheduler.Scheduler()
+        for ctrl in self.controllers:
+            ctrl.defer = self.defer
+            ctrl.scheduler = self.scheduler
+        self.latency = latency_stats.LatencyRecorder() if latency else None
+        self.server_sock = socket_server.SocketServer(
+            cb_read = self.on_client_event,
+            cb_read_batch = self.on_client_events,
+            cb_disconnect = self.on_client_disconnect,
+            host = host,
+            port = port,
+            max_clients = max_clients,
+            udp_port = udp_port,
+            latency = latency,
+            cb_stats = self.stats,
+            unix_path = unix_path,
+            ring_path = ring_path,
+            ring_slots = ring_slots,
+            reuse_port = worker is not None,
+            cb_handoff = worker.handoff if worker is not None else None,
+            realtime_config = network_realtime,
+            heartbeat_timeout = heartbeat_timeout,
+            keepalive = tcp_keepalive,
+        )
+        if worker is not None:
+            worker.attach(self)
+        self.emitter = emitter.Emitter(self.handle_item, queue_size, backpressure, emitter_realtime)
+        self.macros = macros.MacroEngine(self.scheduler, self.defer)
+        self.playout = None
+        if playout_delay is not None:
+            self.playout = playout.Playout(self.scheduler, self.play, *playout_delay)
+        self.stop_event = Event()
+        self.started_at = clock.monotonic()
+        self.message_rate = stats.Rate(self.started_at)
+
+    def run(self):
+        """ Open the devices, start the emitter and the socket server, and
+        wait until the hub is stopped. """
+        logger.info('Starting hub with {} controller(s).', len(self.controllers))
+        for ctrl in self.controllers:
+            ctrl.open_device()
+        self.emitter.start()
+        self.scheduler.start()
+        self.server_sock.start()
+
+        self.stop_event.wait()
+
+        logger.info('Stopping hub...')
+        self.server_sock.stop()
+        self.server_sock.join()
+        self.server_sock.close()
+        self.scheduler.stop()
+        self.scheduler.join()
+        self.scheduler.close()
+        self.emitter.stop()
+        self.emitter.join()
+        for ctrl in self.controllers:
+            ctrl.close_device()
+
+    def stop(self):
+        """ Stop the hub: closes the socket server and the uinput devices. """
+        self.stop_event.set()
+
+    def is_running(self):
+        return not self.stop_event.is_set()
+
+    def queue_stats(self):
+        """ Return the counters of the queue between the network and the devices. """
+        return self.emitter.stats()
+
+    def stats(self):
+        """ Return the operational counters of the hub, answered to CONTROL/STATS.
+        messages_per_second is measured since the previous call. """
+        now = clock.monotonic()
+        network = self.server_sock.counters.snapshot()
+        network['clients'] = len(self.server_sock.clients)
+        network['messages_per_second'] = self.message_rate.update(now, network['messages'])
+        return {
+            'uptime': now - self.started_at,
+            'network': network,
+            'queue': self.emitter.stats(),
+            'macros': self.macros.stats(),
+            'scheduler': self.scheduler.stats(),
+            'playout': self.playout.stats() if self.playout is not None else None,
+            'worker': self.worker.stats() if self.worker is not None else None,
+            'realtime': self.realtime_stats(),
+            'controllers': dict((ctrl.name, ctrl.stats()) for ctrl in self.controllers),
+            'dropped_log_records': VCLogger.dropped_records(),
+        }
+
+    def realtime_stats(self):
+        """ Return the real-time settings applied to the socket server and emitter threads """
+        return {
+            'network': self.server_sock.realtime_report,
+            'emitter': self.emitter.realtime_report,
+        }
+
+    def controller(self, controller_id):
+        """ Return the Controller with the given id, or None. Messages without
+        a controller id go to the controller 0. """
+        if controller_id is None:
+            controller_id = 0
+        try:
+            return self.controllers_by_id.get(int(controller_id))
+        except (ValueError, TypeError):
+            return None
+
+    def defer(self, item):
+        """ Queue a (function, argument) call for the emitter thread. It is
+        never dropped. Return False if the emitter is stopped. """
+        return self.emitter.put_control(item)
+
+    def on_client_event(self, msg):
+        """ Callback function called by the SocketServer for a single Message. """
+        self.on_client_events([msg])
+
+    def on_client_events(self, msgs):
+        """ Callback function called by the SocketServer with all the Messages
+        extracted from a single read. Consecutive Messages for the same
+        Controller are queued together for the emitter thread. """
+        ctrl = None
+        group = []
+        for msg in msgs:
+            if msg.title == message.Titles.CONTROL and msg.action == message.Actions.STOP_SERVER:
+                if group:
+                    self.queue_group(ctrl, group)
+                logger.info('Stopping server...')
+                if self.worker is not None:
+                    self.worker.request_stop()
+                else:
+                    self.stop()
+                return
+            if msg.title == message.Titles.CONTROL and msg.action == message.Actions.LATENCY:
+                # Logged by the emitter thread, after the events received before
+                if group:
+                    self.queue_group(ctrl, group)
+                    group = []
+                self.emitter.put((self.log_latency, msg.client))
+                continue
+
+            target = self.controller(msg.controller)
+            if target is None and self.worker is not None and self.worker.is_remote(0 if msg.controller is None else msg.controller):
+                self.worker.forward(msg)
+                continue
+            if target is None:
+                logger.warning('No controller {}, ignoring message.', msg.controller)
+                continue
+            if self.playout is not None:
+                timed = msg.timestamp is not None and msg.title == message.Titles.EVENT
+                if timed or self.playout.pending(msg.client):
+                    # Played by the scheduler thread, maybe right away: the
+                    # messages received before must be queued first
+                    if group:
+                        self.queue_group(ctrl, group)
+                        group = []
+                    if timed:
+                        self.playout.schedule(target, msg)
+                        continue
+                    if self.playout.hold(target, msg):
+                        continue
+            if msg.title == message.Titles.CONTROL and msg.action in macros.MACRO_ACTIONS:
+                # Handled by the emitter thread, in order with the other messages
+                if group:
+                    self.queue_group(ctrl, group)
+                    group = []
+                self.emitter.put((self.macros.handle_message, (target, msg)))
+                continue
+            if target is not ctrl:
+                if group:
+                    self.queue_group(ctrl, group)
+                ctrl = target
+                group = []
+            group.append(msg)
+
+        if group:
+            self.queue_group(ctrl, group)
+
+    def play(self, ctrl, msgs):
+        """ Queue Messages played by the Playout. Called from the scheduler
+        thread, which must never wait for room in the queue: that would stall
+        every timer, so they are queued like internal items. """
+        for msg in msgs:
+            if msg.title == message.Titles.CONTROL and msg.action in macros.MACRO_ACTIONS:
+                self.defer((self.macros.handle_message, (ctrl, msg)))
+            else:
+                self.defer(self.group_item(ctrl, [msg]))
+
+    def queue_group(self, ctrl, group):
+        """ Queue a group of Messages for a Controller, timed if latency is measured.
+        Only a group of key presses may be dropped when the queue is full:
+        dropping a release or a control message could leave a key held. """
+        droppable = True
+        for msg in group:
+            if msg.title != message.Titles.EVENT or msg.action != message.Actions.PRESSED:
+                droppable = False
+                break
+        self.emitter.put(self.group_item(ctrl, group), droppable)
+
+    def group_item(self, ctrl, group):
+        """ Return the emitter item handling a group of Messages for a Controller """
+        if self.latency is None:
+            return (ctrl.handle_messages, group)
+        return (self.handle_timed, (ctrl, group))
+
+    def handle_timed(self, item):
+        """ Handle a group of Messages and record the latency of every stage """
+        ctrl, group = item
+        started_at = clock.monotonic()
+        ctrl.handle_messages(group)
+        self.latency.record(ctrl.name, group, started_at, clock.monotonic())
+
+    def latency_report(self):
+        """ Return the latency percentiles per client and per controller,
+        or None if latency is not measured. """
+        if self.latency is None:
+            return None
+        return self.latency.report()
+
+    def log_latency(self, client = None):
+        """ Log the latency percentiles of every client and controller """
+        if self.latency is None:
+            logger.warning('Latency is not measured by this server.')
+            return
+        if client is not None:
+            logger.info('Latency requested by {}', client)
+        logger.info('Latency percentiles:\n{}', self.latency.format_report())
+
+    def on_client_disconnect(self, client):
+        """ Callback function called by the SocketServer when a connection is
+        closed: stop the macros it started, and release the keys it still
+        holds on every Controller, here and on the workers it sent events to. """
+        if self.worker is not None:
+            self.worker.forget(client)
+        if self.playout is not None:
+            self.playout.forget(client)
+        self.emitter.put((self.macros.cancel_client, client))
+        for ctrl in self.controllers:
+            self.emitter.put((ctrl.release_client, client))
+        if self.latency is not None:
+            # By the emitter thread too, the only writer of the histograms
+            self.emitter.put((self.latency.forget, client))
+
+    def key_stats(self):
+        """ Return the key transition counters of every Controller, by name. """
+        return dict((ctrl.name, ctrl.key_stats()) for ctrl in self.controllers)
+
+    def handle_item(self, item):
+        """ Run a (function, argument) item queued for the emitter thread,
+        e.g. a Controller's handle_messages with a group of Messages. """
+        function, argument = item
+        function(argument)
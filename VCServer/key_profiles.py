@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+"""
+Key mapping profiles: which device event each key name sent by the clients emits.
+Profiles are JSON files, by default in VCServer/profiles:
+{
+    "name": "joystick",
+    "keys": {
+        "A": "KEY_A",
+        "KEY.ENTER": "KEY_ENTER",
+        ...
+    },
+    "axes": {
+        "LX": {"event": "ABS_X", "min": -32768, "max": 32767, "fuzz": 16, "deadzone": 2000},
+        ...
+    }
+}
+Events are the names of EventCodes (event_codes.py). A profile is rejected
+if a key is listed twice, if an event name is unknown, or if two key names
+are the same key once case-folded (e.g. "a" and "A").
+Axes are optional. Each one is registered on the device with its range; fuzz
+and flat are passed to the kernel (flat defaults to the deadzone). The rest
+position of an axis is the center of its range unless "rest" is given (e.g.
+the minimum, for a trigger): values within deadzone of it are sent as the
+rest position, which is also restored when the client moving the axis leaves.
+Profiles are compiled once, when they are loaded: switching the profile of
+a Controller only replaces a reference to the compiled lookup table.
+"""
+
+import json
+import os
+import sys
+
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from VCCommon import VCLogger
+
+from event_codes import EventCodes, EventTypes
+
+logger = VCLogger.Logger(VCLogger.Level.ALL)
+
+PROFILES_DIR = path.join(path.dirname(path.abspath(__file__)), 'profiles')
+
+class ProfileError(ValueError):
+    """ Raised when a profile can't be loaded """
+    pass
+
+def key_aliases(name):
+    """ Return the spellings of a key name accepted by the Controller:
+    the name itself, its upper and lower case, and for special keys the
+    spelling used by pynput ('KEY.ENTER' -> 'Key.enter'). """
+    aliases = set([name, name.upper(), name.lower()])
+    if name.upper().startswith('KEY.'):
+        aliases.add('Key.' + name[4:].lower())
+    return aliases
+
+class Axis:
+    """ An absolute axis of a profile """
+
+    def __init__(self, name, event, minimum, maximum, fuzz = 0, flat = None, deadzone = 0, rest = None):
+        self.name = name
+        self.event = event
+        self.minimum = minimum
+        self.maximum = maximum
+        if rest is None:
+            rest = int((minimum + maximum) / 2.0)
+        self.rest = rest
+        self.deadzone = deadzone
+        if flat is None:
+            flat = deadzone
+        # Event registered on the device, with the range of the axis
+        self.registration = event + (minimum, maximum, fuzz, flat)
+
+    def filter(self, value):
+        """ Clamp a value to the range of the axis, and apply the deadzone """
+        if value < self.minimum:
+            value = self.minimum
+        elif value > self.maximum:
+            value = self.maximum
+        if abs(value - self.rest) <= self.deadzone:
+            return self.rest
+        return value
+
+class Profile:
+    """ A compiled key mapping.
+    keys maps key names to (type, code) events, key_codes maps every alias of
+    the key names to their event, and events is the set of events the device
+    must support (axes with their range). axis_names maps the upper case
+    names of the axes to their Axis, axis_events maps their event to it. """
+
+    def __init__(self, name, keys, axes = ()):
+        self.name = name
+        self.keys = dict(keys)
+        self.axes = list(axes)
+        self.events = frozenset(self.keys.values() + [axis.registration for axis in self.axes])
+        self.key_codes = compile_keys(self.keys)
+        self.axis_names = dict((axis.name.upper(), axis) for axis in self.axes)
+        self.axis_events = dict((axis.event, axis) for axis in self.axes)
+
+    def fits(self, events):
+        """ Return True if a device registered with the given events can emit every event of this profile """
+        return self.events.issubset(events)
+
+def compile_keys(keys):
+    """ Return the {alias: event} lookup table of a {key name: event} mapping.
+    Raise ProfileError if two key names have the same alias or the same event. """
+    key_codes = {}
+    owners = {}
+    event_owners = {}
+    for name, event in sorted(keys.items()):
+        # Two keys on one event would release it while the other is still held
+        other = event_owners.get(event)
+        if other is not None:
+            raise ProfileError('Keys {!r} and {!r} are mapped to the same event.'.format(other, name))
+        event_owners[event] = name
+        for alias in key_aliases(name):
+            owner = owners.get(alias)
+            if owner is not None and owner != name:
+                raise ProfileError('Keys {!r} and {!r} are the same key.'.format(owner, name))
+            owners[alias] = name
+            key_codes[alias] = event
+    return key_codes
+
+def parse_axis(name, spec):
+    """ Return the Axis defined by a profile entry. Raise ProfileError if it is invalid. """
+    if not isinstance(spec, dict):
+        raise ProfileError('Axis {!r} must be an object.'.format(name))
+    event = getattr(EventCodes, str(spec.get('event')), None)
+    if not isinstance(event, tuple) or event[0] != EventTypes.ABS:
+        raise ProfileError('Unknown absolute axis {!r} for axis {!r}.'.format(spec.get('event'), name))
+    try:
+        minimum = int(spec.get('min', -32768))
+        maximum = int(spec.get('max', 32767))
+        fuzz = int(spec.get('fuzz', 0))
+        deadzone = int(spec.get('deadzone', 0))
+        flat = spec.get('flat')
+        if flat is not None:
+            flat = int(flat)
+        rest = spec.get('rest')
+        if rest is not None:
+            rest = int(rest)
+    except (TypeError, ValueError):
+        raise ProfileError('Invalid range for axis {!r}.'.format(name))
+    if minimum >= maximum or fuzz < 0 or deadzone < 0 or 2 * deadzone >= maximum - minimum:
+        raise ProfileError('Invalid range for axis {!r}.'.format(name))
+    if rest is not None and not minimum <= rest <= maximum:
+        raise ProfileError('Rest position of axis {!r} is out of its range.'.format(name))
+    return Axis(str(name), event, minimum, maximum, fuzz, flat, deadzone, rest)
+
+def reject_duplicates(pairs):
+    """ object_pairs_hook of json.loads refusing objects with the same key twice """
+    obj = {}
+    for key, value in pairs:
+        if key in obj:
+            raise ProfileError('Key {!r} is defined twice.'.format(key))
+        obj[key] = value
+    return obj
+
+def parse_profile(text, default_name = None):
+    """ Return the Profile defined by a JSON document. Raise ProfileError if it is invalid. """
+    try:
+        data = json.loads(text, object_pairs_hook = reject_duplicates)
+    except ValueError as err:
+        if isinstance(err, ProfileError):
+            raise
+        raise ProfileError('Invalid JSON: {}'.format(err))
+    if not isinstance(data, dict) or not isinstance(data.get('keys'), dict):
+        raise ProfileError('A profile must be an object with a "keys" object.')
+
+    name = data.get('name', default_name)
+    if not name:
+        raise ProfileError('The profile has no name.')
+    keys = {}
+    for key_name, event_name in data['keys'].items():
+        event = getattr(EventCodes, str(event_name), None)
+        if not isinstance(event, tuple):
+            raise ProfileError('Unknown event {!r} for key {!r}.'.format(event_name, key_name))
+        keys[str(key_name)] = event
+
+    axes = data.get('axes', {})
+    if not isinstance(axes, dict):
+        raise ProfileError('"axes" must be an object.')
+    axis_list = []
+    events = set()
+    names = set()
+    for axis_name, spec in sorted(axes.items()):
+        axis = parse_axis(axis_name, spec)
+        if axis.event in events or axis.name.upper() in names:
+            raise ProfileError('Axis {!r} is defined twice.'.format(axis_name))
+        if axis.event in keys.values():
+            raise ProfileError('Axis {!r} is mapped to the event of a key.'.format(axis_name))
+        events.add(axis.event)
+        names.add(axis.name.upper())
+        axis_list.append(axis)
+    return Profile(str(name), keys, axis_list)
+
+def load_profile(file_path):
+    """ Load and compile a profile file. Raise ProfileError if it is invalid. """
+    default_name = path.splitext(path.basename(file_path))[0]
+    try:
+        with open(file_path) as profile_file:
+            text = profile_file.read()
+    except IOError as err:
+        raise ProfileError('Can not read {}: {}'.format(file_path, err))
+    try:
+        return parse_profile(text, default_name)
+    except ProfileError as err:
+        raise ProfileError('{}: {}'.format(file_path, err))
+
+class ProfileLibrary:
+    """ Compiled profiles, by name.
+    Every profile of the directory is loaded and compiled when the library is
+    created; invalid files are skipped with a warning. """
+
+    def __init__(self, directory = PROFILES_DIR):
+        self.directory = directory
+        self.profiles = {}
+        self.load_all()
+
+    def load_all(self):
+        """ (Re)load every .json file of the directory """
+        profiles = {}
+        if path.isdir(self.directory):
+            for file_name in sorted(os.listdir(self.directory)):
+                if not file_name.endswith('.json'):
+                    continue
+                try:
+                    profile = load_profile(path.join(self.directory, file_name))
+                except ProfileError as err:
+                    logger.warning('Ignoring profile: {}', err)
+                    continue
+                if profile.name in profiles:
+                    logger.warning('Ignoring {}: profile {} is already defined.', file_name, profile.name)
+                    continue
+                profiles[profile.name] = profile
+        self.profiles = profiles
+        logger.info('Loaded {} key profile(s) from {}', len(profiles), self.directory)
+
+    def add(self, profile):
+        self.profiles[profile.name] = profile
+
+    def get(self, name):
+        """ Return the compiled profile with the given name. Raise ProfileError if there is none. """
+        profile = self.profiles.get(name)
+        if profile is None:
+            raise ProfileError('No profile named {!r}.'.format(name))
+        return profile
+
+    def names(self):
+        return sorted(self.profiles.keys())
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+from event_codes import KEY_MAX
+
+class KeyState:
+    """ Pressed state of the keys of one device, and of the keys each client holds.
+    A transition is only written to the device when it changes the state of
+    the device: repeated presses (autorepeat) and releases of keys that are
+    not held are suppressed. A key stays pressed as long as one client holds it. """
+
+    def __init__(self):
+        # Number of clients holding each key code
+        self.holders = bytearray(KEY_MAX + 1)
+        # Client -> set of key codes it holds
+        self.client_keys = {}
+        self.emitted_presses = 0
+        self.emitted_releases = 0
+        self.suppressed_presses = 0
+        self.suppressed_releases = 0
+
+    def press(self, client, code):
+        """ Record that a client pressed a key code.
+        Return True if the press must be written to the device. """
+        keys = self.client_keys.get(client)
+        if keys is None:
+            keys = self.client_keys[client] = set()
+        elif code in keys:
+            self.suppressed_presses += 1
+            return False
+        keys.add(code)
+        holders = self.holders[code]
+        if holders < 255:
+            self.holders[code] = holders + 1
+        if holders:
+            self.suppressed_presses += 1
+            return False
+        self.emitted_presses += 1
+        return True
+
+    def release(self, client, code):
+        """ Record that a client released a key code.
+        Return True if the release must be written to the device. """
+        keys = self.client_keys.get(client)
+        if keys is None or code not in keys:
+            self.suppressed_releases += 1
+            return False
+        keys.discard(code)
+        if not keys:
+            del self.client_keys[client]
+        holders = self.holders[code] - 1
+        self.holders[code] = holders
+        if holders:
+            self.suppressed_releases += 1
+            return False
+        self.emitted_releases += 1
+        return True
+
+    def release_client(self, client):
+        """ Forget every key held by a client.
+        Return the list of key codes that must be released on the device. """
+        keys = self.client_keys.get(client)
+        if not keys:
+            return []
+        released = []
+        for code in list(keys):
+            if self.release(client, code):
+                released.append(code)
+        return released
+
+    def is_pressed(self, code):
+        return self.holders[code] > 0
+
+    def pressed(self):
+        """ Return the list of key codes currently pressed on the device """
+        return [code for code, holders in enumerate(self.holders) if holders]
+
+    def clear(self):
+        """ Forget every pressed key, e.g. when the device is recreated """
+        self.holders = bytearray(KEY_MAX + 1)
+        self.client_keys = {}
+
+    def stats(self):
+        """ Return the transition counters """
+        return {
+            'emitted_presses': self.emitted_presses,
+            'emitted_releases': self.emitted_releases,
+            'suppressed_presses': self.suppressed_presses,
+            'suppressed_releases': self.suppressed_releases,
+            'held_keys': sum(1 for holders in self.holders if holders),
+            'clients': len(self.client_keys),
+        }
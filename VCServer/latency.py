@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+"""
+Latency measurements of the path from a client key press to the device.
+Each Message is timed at every stage of the server:
+    network  client send time (Message.timestamp) -> received by the socket server
+    parse    received -> decoded into a Message
+    queue    decoded -> taken by the emitter thread
+    emit     taken by the emitter thread -> written to the device
+    total    client send time, or reception if the client sends no timestamp -> written
+Durations are counted in Histograms with fixed buckets, so recording a value
+is a bisect and an increment, and the memory used does not grow with the
+number of events.
+"""
+
+from bisect import bisect_left
+
+STAGES = ['network', 'parse', 'queue', 'emit', 'total']
+PERCENTILES = [50, 90, 99, 99.9]
+
+# Upper bounds of the buckets, in seconds: 4 buckets per power of two from
+# 1 microsecond to about 16 seconds, so a percentile is known within 19%.
+BUCKET_BOUNDS = [1e-6 * 2 ** (i / 4.0) for i in range(4 * 24 + 1)]
+
+class Histogram:
+    """ Count durations in logarithmic buckets.
+    Percentiles are the upper bound of the bucket they fall in. """
+
+    def __init__(self, bounds = BUCKET_BOUNDS):
+        self.bounds = bounds
+        # The last bucket counts the durations above the last bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, duration):
+        """ Count a duration, in seconds. Negative durations (clock offset
+        errors) are counted in the first bucket. """
+        self.counts[bisect_left(self.bounds, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def merge(self, other):
+        """ Add the counts of another Histogram with the same buckets """
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """ Return the duration below which percent % of the durations are, or None """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if i == len(self.bounds):
+                    return self.max
+                return min(self.bounds[i], self.max)
+        return self.max
+
+    def summary(self):
+        """ Return the count, mean, max and percentiles, in milliseconds """
+        if not self.count:
+            return {'count': 0}
+        summary = {
+            'count': self.count,
+            'mean': self.total / self.count * 1000,
+            'max': self.max * 1000,
+        }
+        for percent in PERCENTILES:
+            summary['p{}'.format(percent)] = self.percentile(percent) * 1000
+        return summary
+
+class LatencyRecorder:
+    """ Histograms of every stage, per client and per controller.
+    Only record() and forget() write to the histograms, and they are only
+    called from the emitter thread, so no lock is needed; reports read a
+    copy of them from any thread. """
+
+    def __init__(self):
+        self.clients = {}
+        self.controllers = {}
+
+    def stages(self, histograms, name):
+        """ Return the {stage: Histogram} dict of a client or controller """
+        stages = histograms.get(name)
+        if stages is None:
+            stages = histograms[name] = dict((stage, Histogram()) for stage in STAGES)
+        return stages
+
+    def record(self, controller_name, msgs, started_at, emitted_at):
+        """ Record the stages of a group of Messages, taken by the emitter
+        thread at started_at and written to the device at emitted_at. """
+        controller_stages = self.stages(self.controllers, controller_name)
+        client = None
+        client_stages = None
+        for msg in msgs:
+            received_at = msg.received_at
+            if received_at is None:
+                continue
+            if client_stages is None or msg.client != client:
+                client = msg.client
+                client_stages = self.stages(self.clients, str(client))
+
+            sent_at = received_at
+            if msg.timestamp is not None:
+                sent_at = msg.timestamp
+                network = received_at - sent_at
+                controller_stages['network'].record(network)
+                client_stages['network'].record(network)
+            parse = msg.parsed_at - received_at
+            queue = started_at - msg.parsed_at
+            emit = emitted_at - started_at
+            total = emitted_at - sent_at
+            for stages in (controller_stages, client_stages):
+                stages['parse'].record(parse)
+                stages['queue'].record(queue)
+                stages['emit'].record(emit)
+                stages['total'].record(total)
+
+    def forget(self, client):
+        """ Drop the histograms of a disconnected client """
+        self.clients.pop(str(client), None)
+
+    def report(self):
+        """ Return the summary of every stage, per client and per controller """
+        def summaries(histograms):
+            # A copy, as the emitter thread may add or remove clients meanwhile
+            return dict(
+                (name, dict((stage, hist.summary()) for stage, hist in stages.items()))
+                for name, stages in dict(histograms).items())
+        return {
+            'clients': summaries(self.clients),
+            'controllers': summaries(self.controllers),
+        }
+
+    def format_report(self):
+        """ Return the percentiles of every controller and client as a text table """
+        columns = ['p{}'.format(percent) for percent in PERCENTILES] + ['max']
+        lines = ['{:<30} {:<8} {:>8} '.format('', 'stage', 'count')
+            + ' '.join('{:>8}'.format(column) for column in columns) + ' (ms)']
+        for kind, histograms in (('controller', dict(self.controllers)), ('client', dict(self.clients))):
+            for name in sorted(histograms.keys()):
+                for stage in STAGES:
+                    summary = histograms[name][stage].summary()
+                    if not summary['count']:
+                        continue
+                    lines.append('{:<30} {:<8} {:>8} '.format(
+                        '{} {}'.format(kind, name)[:30], stage, summary['count'])
+                        + ' '.join('{:>8.3f}'.format(summary[column]) for column in columns))
+        return '\n'.join(lines)
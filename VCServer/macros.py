@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+"""
+Macros played by the server, so that the timing of a sequence of key events
+does not depend on the network. JSON control messages (routed to a
+controller like any other message):
+
+    REGISTER_MACRO  {"name": "hadouken", "steps": [["KEY.DOWN", "PRESSED", 0],
+                     ["KEY.RIGHT", "PRESSED", 16], ["KEY.DOWN", "RELEASED", 0], ...]}
+                    Each step is a key, an action and a delay in milliseconds
+                    after the previous step. Steps with no delay are emitted as
+                    a single input frame. Macros are shared by every controller.
+    TRIGGER_MACRO   "hadouken": play a macro on the controller. Triggering a
+                    macro that is still playing on it restarts it.
+    CANCEL_MACRO    "hadouken", or "*" for every macro and turbo of the controller
+    TURBO           {"key": "A", "hz": 15}: press and release the key 15 times
+                    per second until a TURBO message with "hz": 0.
+
+Steps are scheduled at their offset from the start of the macro on the
+Scheduler's monotonic clock, so timing errors do not accumulate, and handed
+to the emitter thread to be written. Each run of a macro holds its keys as
+its own client (see key_state.py): keys still pressed when a macro ends or is
+cancelled are released. Runs belong to the client that started them, and are
+cancelled when it disconnects.
+"""
+
+import math
+import sys
+from threading import Lock
+
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from VCCommon import clock
+from VCCommon import message
+from VCCommon import VCLogger
+
+logger = VCLogger.Logger(VCLogger.Level.ALL)
+
+MAX_STEPS = 1024
+MAX_TURBO_HZ = 100
+
+MACRO_ACTIONS = frozenset([
+    message.Actions.REGISTER_MACRO,
+    message.Actions.TRIGGER_MACRO,
+    message.Actions.CANCEL_MACRO,
+    message.Actions.TURBO,
+])
+
+KEY_VALUES = {
+    message.Actions.PRESSED: 1,
+    message.Actions.RELEASED: 0,
+}
+
+class MacroError(ValueError):
+    """ Raised for an invalid macro definition """
+    pass
+
+class Macro:
+    """ A compiled macro: frames is a list of (offset in seconds from the
+    start, [(key, value), ...]) tuples. """
+
+    def __init__(self, name, frames):
+        self.name = name
+        self.frames = frames
+
+    def frame(self, index):
+        """ Return the frame at index, or None after the last one """
+        if index < len(self.frames):
+            return self.frames[index]
+        return None
+
+def parse_macro(value):
+    """ Compile a REGISTER_MACRO value. Raise MacroError if it is invalid. """
+    if not isinstance(value, dict):
+        raise MacroError('A macro must be an object with a name and steps.')
+    name = value.get('name')
+    steps = value.get('steps')
+    if not isinstance(name, basestring) or not name or name == '*':
+        raise MacroError('Invalid macro name: {!r}'.format(name))
+    if not isinstance(steps, list) or not steps or len(steps) > MAX_STEPS:
+        raise MacroError('A macro must have between 1 and {} steps.'.format(MAX_STEPS))
+
+    frames = []
+    offset = 0.0
+    for step in steps:
+        try:
+            key, action, delay = step
+            key_value = KEY_VALUES[action]
+            delay = finite_float(delay)
+        except (TypeError, ValueError, KeyError):
+            raise MacroError('Invalid step {!r} in macro {}'.format(step, name))
+        if delay < 0 or not isinstance(key, basestring):
+            raise MacroError('Invalid step {!r} in macro {}'.format(step, name))
+        if delay or not frames:
+            offset += delay / 1000.0
+            if math.isinf(offset):
+                raise MacroError('Macro {} is too long.'.format(name))
+            frames.append((offset, []))
+        frames[-1][1].append((key, key_value))
+    return Macro(name, frames)
+
+def finite_float(value):
+    """ Return value as a float. Raise ValueError if it is not a finite
+    number: NaN and infinity would corrupt the order of the Scheduler. """
+    number = float(value)
+    if math.isnan(number) or math.isinf(number):
+        raise ValueError('{!r} is not a finite number'.format(value))
+    return number
+
+class Turbo:
+    """ Endless press / release of one key at a given rate. Same interface as Macro. """
+
+    def __init__(self, key, hz):
+        self.name = 'turbo ' + key
+        self.key = key
+        self.half_period = 0.5 / hz
+
+    def frame(self, index):
+        return (index * self.half_period, [(self.key, 1 - index % 2)])
+
+class MacroRun:
+    """ A macro playing on one controller, started by the client owner """
+
+    def __init__(self, engine, ctrl, macro, owner, generation):
+        self.engine = engine
+        self.controller = ctrl
+        self.macro = macro
+        self.owner = owner
+        # Each run holds its keys as its own client, so that the calls of
+        # a cancelled run never touch the keys of the next one
+        self.client = ('macro', macro.name, generation)
+        self.start = None
+        self.index = 0
+        self.timer = None
+        self.cancelled = False
+
+    def schedule(self, start):
+        self.start = start
+        self.timer = self.engine.scheduler.call_at(start + self.macro.frame(0)[0], self.fire)
+
+    def fire(self, argument = None):
+        """ Called by the scheduler thread when the next frame is due """
+        if self.cancelled:
+            return
+        offset, events = self.macro.frame(self.index)
+        self.index += 1
+        next_frame = self.macro.frame(self.index)
+        if next_frame is None:
+            self.engine.defer((self.play_last, events))
+            self.engine.finished(self)
+            return
+        self.engine.defer((self.play, events))
+        self.timer = self.engine.scheduler.call_at(self.start + next_frame[0], self.fire)
+
+    def play(self, events):
+        """ Emit a frame, in the emitter thread """
+        if not self.cancelled:
+            self.controller.emit_frame(events, self.client)
+
+    def play_last(self, events):
+        if self.cancelled:
+            return
+        self.play(events)
+        self.controller.release_client(self.client)
+
+    def cancel(self):
+        """ Stop the macro and release its keys, in the emitter thread """
+        self.cancelled = True
+        if self.timer is not None:
+            self.engine.scheduler.cancel(self.timer)
+        self.controller.release_client(self.client)
+
+class MacroEngine:
+    """ Registered macros, and the macros playing on each controller. """
+
+    def __init__(self, scheduler, defer):
+        """ defer queues a (function, argument) call for the emitter thread """
+        self.scheduler = scheduler
+        self.defer = defer
+        self.macros = {}
+        # (controller name, macro name) -> MacroRun
+        self.runs = {}
+        self.generation = 0
+        self.lock = Lock()
+
+    def handle_message(self, item):
+        """ Handle a (Controller, Message) pair with one of MACRO_ACTIONS.
+        Only called from the emitter thread. """
+        ctrl, msg = item
+        try:
+            if msg.action == message.Actions.REGISTER_MACRO:
+                self.register(parse_macro(msg.value))
+            elif msg.action == message.Actions.TRIGGER_MACRO:
+                self.trigger(ctrl, msg.value, msg.client)
+            elif msg.action == message.Actions.CANCEL_MACRO:
+                self.cancel(ctrl, msg.value)
+            elif msg.action == message.Actions.TURBO:
+                self.turbo(ctrl, msg.value, msg.client)
+        except MacroError as e:
+            logger.warning('{}', e)
+
+    def register(self, macro):
+        self.macros[macro.name] = macro
+        logger.info('Registered macro {} ({} frames)', macro.name, len(macro.frames))
+
+    def trigger(self, ctrl, name, owner = None):
+        macro = self.macros.get(name)
+        if macro is None:
+            raise MacroError('No macro named {!r}.'.format(name))
+        self.start(ctrl, macro, owner)
+
+    def start(self, ctrl, macro, owner = None):
+        """ Play a Macro or Turbo on a controller for the client owner,
+        restarting it if it is already playing """
+        with self.lock:
+            self.generation += 1
+            run = MacroRun(self, ctrl, macro, owner, self.generation)
+            previous = self.runs.get((ctrl.name, macro.name))
+            self.runs[(ctrl.name, macro.name)] = run
+        if previous is not None:
+            previous.cancel()
+        run.schedule(clock.monotonic())
+
+    def cancel(self, ctrl, name):
+        """ Cancel a macro playing on a controller, or all of them if name is '*' """
+        with self.lock:
+            if name == '*':
+                keys = [key for key in self.runs if key[0] == ctrl.name]
+            else:
+                keys = [(ctrl.name, name)]
+            runs = [self.runs.pop(key) for key in keys if key in self.runs]
+        for run in runs:
+            run.cancel()
+
+    def cancel_client(self, owner):
+        """ Cancel every run started by a client, e.g. when it disconnects.
+        Only called from the emitter thread. """
+        with self.lock:
+            keys = [key for key, run in self.runs.items() if run.owner == owner]
+            runs = [self.runs.pop(key) for key in keys]
+        for run in runs:
+            logger.info('Cancelling {} of {}', run.macro.name, owner)
+            run.cancel()
+
+    def turbo(self, ctrl, value, owner = None):
+        """ Start, or stop if hz is 0, the autofire of a key """
+        if not isinstance(value, dict) or not isinstance(value.get('key'), basestring):
+            raise MacroError('Invalid turbo: {!r}'.format(value))
+        try:
+            hz = finite_float(value.get('hz', 0))
+        except (TypeError, ValueError):
+            raise MacroError('Invalid turbo rate: {!r}'.format(value.get('hz')))
+        if hz < 0 or hz > MAX_TURBO_HZ:
+            raise MacroError('Turbo rate must be between 0 and {} Hz.'.format(MAX_TURBO_HZ))
+        if not ctrl.has_key(value['key']):
+            raise MacroError('Key {} is not supported by controller {}.'.format(value['key'], ctrl.name))
+        if hz:
+            self.start(ctrl, Turbo(value['key'], hz), owner)
+        else:
+            self.cancel(ctrl, 'turbo ' + value['key'])
+
+    def finished(self, run):
+        """ Forget a macro that emitted its last frame """
+        with self.lock:
+            key = (run.controller.name, run.macro.name)
+            if self.runs.get(key) is run:
+                del self.runs[key]
+
+    def stats(self):
+        return {
+            'registered': len(self.macros),
+            'playing': len(self.runs),
+        }
@@ -1,20 +1,199 @@
 #!/usr/bin/env python
 
+import argparse
+import signal
+import sys
 import time
 
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from VCCommon import VCLogger
+
+import backends
 import controller
-import socket_server
+import event_log
+import hub
+import key_profiles
+import realtime
+import supervisor
 
-def main():
+LOG_LEVELS = ['ERRORS', 'WARNINGS', 'CONNECTIONS', 'EVENTS', 'SUCCESSES', 'ALL']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'VirtualController server')
+    parser.add_argument('--backend', choices = sorted(backends.BACKENDS), default = 'uinput',
+        help = 'device backend (default: uinput)')
+    parser.add_argument('--players', type = int, default = 1,
+        help = 'number of controllers hosted by this server (default: 1)')
+    parser.add_argument('--port', type = int, default = 2011,
+        help = 'TCP port the clients connect to (default: 2011)')
+    parser.add_argument('--udp-port', type = int,
+        help = 'also receive key events as UDP datagrams on this port')
+    parser.add_argument('--unix-socket',
+        help = 'also accept clients on a Unix domain socket at this path')
+    parser.add_argument('--shm-ring',
+        help = 'also receive key events from a shared-memory ring at this path, e.g. /dev/shm/vc_ring')
+    parser.add_argument('--shm-slots', type = int, default = 1024,
+        help = 'number of slots of the shared-memory ring, a power of 2 (default: 1024)')
+    parser.add_argument('--profiles', default = key_profiles.PROFILES_DIR,
+        help = 'directory of the key mapping profiles (default: VCServer/profiles)')
+    parser.add_argument('--profile',
+        help = 'key mapping profile used by every controller (default: the built-in joystick mapping)')
+    parser.add_argument('--axis-rate', type = float, default = 0,
+        help = 'emit the latest value of each analog axis at most this many times per second (default: with every input frame)')
+    parser.add_argument('--playout', type = float, nargs = 2, metavar = ('MIN_MS', 'MAX_MS'),
+        help = 'play timestamped events with their original spacing, delayed by MIN_MS to MAX_MS milliseconds')
+    parser.add_argument('--warm-standby', action = 'store_true',
+        help = 'keep a spare device open for every controller, so that a reload is immediate')
+    parser.add_argument('--record',
+        help = 'append every emitted event to this binary log (see replay.py)')
+    parser.add_argument('--heartbeat-timeout', type = float, metavar = 'SECONDS',
+        help = 'close the connections silent for this long and release their keys; clients must send heartbeats more often')
+    parser.add_argument('--tcp-keepalive', type = int, nargs = 3, metavar = ('IDLE', 'INTERVAL', 'COUNT'),
+        help = 'send TCP keepalive probes after IDLE seconds without data, every INTERVAL seconds, and drop the client after COUNT unanswered probes')
+    parser.add_argument('--workers', type = int, default = 1,
+        help = 'share the controllers between this many worker processes listening on the same port (default: 1)')
+    parser.add_argument('--net-cpus', type = realtime.parse_cpus,
+        help = 'pin the socket server thread to these CPUs, e.g. 2 or 2-3')
+    parser.add_argument('--emit-cpus', type = realtime.parse_cpus,
+        help = 'pin the emitter thread (device writes) to these CPUs')
+    parser.add_argument('--rt-priority', type = int, default = 0,
+        help = 'run the socket server and emitter threads with this SCHED_FIFO priority, 1-99 (default: 0, normal scheduler)')
+    parser.add_argument('--busy-poll', type = float, default = 0, metavar = 'US',
+        help = 'poll for new events for up to US microseconds before blocking, in the socket server and emitter threads (default: 0)')
+    parser.add_argument('--latency', action = 'store_true',
+        help = 'measure the latency of every stage; percentiles are logged on SIGUSR1 or a CONTROL/LATENCY message')
+    parser.add_argument('--log-level', choices = LOG_LEVELS, default = 'ALL',
+        help = 'most verbose level of messages to log (default: ALL)')
+    parser.add_argument('--log-file', help = 'write the log to this text file instead of the terminal')
+    parser.add_argument('--log-json', help = 'write the log to this file as JSON lines instead of the terminal')
+    return parser.parse_args()
+
+def configure_logging(args, asynchronous = True):
+    sinks = []
+    if args.log_file:
+        sinks.append(VCLogger.FileSink(args.log_file))
+    if args.log_json:
+        sinks.append(VCLogger.JsonSink(args.log_json))
+    if not sinks:
+        sinks.append(VCLogger.ConsoleSink())
+    VCLogger.configure(level = getattr(VCLogger.Level, args.log_level), sinks = sinks, asynchronous = asynchronous)
+
+def load_keys(args):
+    """ Return the profile library and the key mapping selected by --profile """
+    profiles = key_profiles.ProfileLibrary(args.profiles)
+    keys = None
+    if args.profile:
+        try:
+            keys = profiles.get(args.profile)
+        except key_profiles.ProfileError as err:
+            VCLogger.Logger().fatal('Invalid --profile, available profiles: {}'.format(', '.join(profiles.names())), err)
+    return profiles, keys
+
+def realtime_configs(args):
+    """ Return the RealtimeConfig of the socket server and emitter threads, None if not used """
+    try:
+        configs = [realtime.RealtimeConfig(cpus, args.rt_priority, args.busy_poll / 1e6)
+            for cpus in (args.net_cpus, args.emit_cpus)]
+    except ValueError as err:
+        VCLogger.Logger().fatal('Invalid real-time settings', err)
+    return [config if config.is_enabled() else None for config in configs]
+
+def run_hub(args, controller_ids, record_path = None, worker = None):
+    """ Serve the controllers with the given ids until the hub stops """
+    profiles, keys = load_keys(args)
+    network_realtime, emitter_realtime = realtime_configs(args)
+
+    log = None
+    if record_path:
+        log = event_log.EventLog(record_path)
+
+    controllers = []
+    for i in controller_ids:
+        backend = backends.BACKENDS[args.backend]
+        if log is not None:
+            backend = event_log.logging_backend(backend, log, i)
+        controllers.append(controller.Controller(
+            name = 'Player {}'.format(i + 1),
+            device_name = 'virtual_controller' if i == 0 else 'virtual_controller_{}'.format(i + 1),
+            backend = backend,
+            warm_standby = args.warm_standby,
+            axis_rate = args.axis_rate,
+            keys = keys,
+            profiles = profiles,
+        ))
+
+    server = hub.ControllerHub(
+        controllers,
+        port = args.port,
+        udp_port = args.udp_port,
+        latency = args.latency,
+        unix_path = args.unix_socket,
+        ring_path = args.shm_ring,
+        ring_slots = args.shm_slots,
+        playout_delay = [delay / 1000.0 for delay in args.playout] if args.playout else None,
+        controller_ids = controller_ids,
+        worker = worker,
+        network_realtime = network_realtime,
+        emitter_realtime = emitter_realtime,
+        heartbeat_timeout = args.heartbeat_timeout,
+        tcp_keepalive = args.tcp_keepalive,
+    )
+    if log is not None:
+        log.schedule_flush(server.scheduler)
+    if args.latency:
+        signal.signal(signal.SIGUSR1, lambda signum, frame: server.log_latency())
     try:
-        ctrl = controller.Controller(name = 'Player 1')
-        ctrl.start()
-        while True: ctrl.join(5)
+        server.start()
+        while server.is_alive(): server.join(5)
     except KeyboardInterrupt:
         print 'Received keyboard interrupt, terminating VirtualController...'
-        ctrl.stop()
+        server.stop()
+
+    server.join()
+    if log is not None:
+        log.close()
+
+def run_worker(args, link):
+    """ Body of a worker process in supervisor mode """
+    # Ctrl+C reaches the whole process group: the supervisor stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The log writer thread of the supervisor does not exist in the fork
+    configure_logging(args)
+    try:
+        controller_ids = [i for i in range(args.players) if link.owns(i)]
+        record_path = '{}.{}'.format(args.record, link.index) if args.record else None
+        run_hub(args, controller_ids, record_path, worker = link)
+    finally:
+        # Worker processes exit without running the atexit handlers
+        VCLogger.flush()
+
+def main():
+    args = parse_args()
 
-    ctrl.join()
+    if args.workers <= 1:
+        configure_logging(args)
+        run_hub(args, range(args.players), args.record)
+        print 'Done'
+        return
+
+    configure_logging(args, asynchronous = False)
+    logger = VCLogger.Logger()
+    if args.udp_port or args.unix_socket or args.shm_ring:
+        logger.fatal('--udp-port, --unix-socket and --shm-ring can not be shared by several --workers.', None)
+    if args.workers > args.players:
+        logger.fatal('--workers can not be larger than --players.', None)
+    # Fail now rather than in every worker
+    load_keys(args)
+    realtime_configs(args)
+
+    workers = supervisor.Supervisor(args.workers, args.players, lambda link: run_worker(args, link))
+    try:
+        workers.run()
+    except KeyboardInterrupt:
+        print 'Received keyboard interrupt, terminating VirtualController...'
+        workers.stop()
 
     print 'Done'
 
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""
+Jitter buffer: play timestamped events with the spacing they had on the client.
+Wireless clients deliver events in bursts (events 16ms apart on the client
+arrive 1ms apart, then nothing for 40ms). In playout mode, an event carrying a
+timestamp (see message.py) is emitted at
+    timestamp + base transit time of its client + playout delay
+where the base transit time is the smallest (arrival - timestamp) seen
+recently, which absorbs the residual clock offset of the client, and the
+playout delay follows the largest extra transit time seen recently, between
+min_delay and max_delay. The delay grows at once when a burst arrives and
+decays with a half life, so a steady client pays min_delay.
+
+Events are scheduled on the Scheduler's monotonic clock and handed to the
+emitter thread when they are due; the events of a client are never
+reordered. The messages of a client without a timestamp (e.g. releases or
+control messages) are queued behind its timestamped events still waiting, so
+that they can't overtake them. An event arriving after its playout time is
+late: a key press or an axis value is dropped, anything else (releases,
+batches, snapshots) is played at once so that no key stays pressed.
+"""
+
+import sys
+from threading import Lock
+
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from VCCommon import clock
+from VCCommon import message
+
+import latency
+import stats
+
+# Actions of the late events that can be dropped without leaving a key pressed
+DROPPABLE_ACTIONS = frozenset([message.Actions.PRESSED, message.Actions.AXIS])
+
+class ClientTiming:
+    """ Transit time estimates of one client """
+
+    def __init__(self, now, transit, window):
+        self.window = window
+        # Minimum transit time of the current and previous windows
+        self.window_start = now
+        self.window_min = transit
+        self.previous_min = transit
+        # Largest transit time above the base, decaying
+        self.peak = 0.0
+        self.peak_at = now
+        # Playout time of the last event, so events are never reordered
+        self.last_due = 0.0
+        self.timers = set()
+
+    def base(self):
+        return min(self.window_min, self.previous_min)
+
+    def update(self, now, transit, half_life):
+        """ Account for the transit time of a new event """
+        if now - self.window_start >= self.window:
+            self.previous_min = self.window_min
+            self.window_min = transit
+            self.window_start = now
+        elif transit < self.window_min:
+            self.window_min = transit
+        self.peak *= 0.5 ** ((now - self.peak_at) / half_life)
+        self.peak_at = now
+        extra = transit - self.base()
+        if extra > self.peak:
+            self.peak = extra
+
+class Playout:
+    """ Schedule timestamped Messages for the emitter thread """
+
+    def __init__(self, scheduler, deliver, min_delay = 0.002, max_delay = 0.05, window = 2.0, half_life = 2.0):
+        """ deliver(controller, messages) queues Messages for the emitter thread;
+        it is called from the scheduler thread and must not wait. Delays are in seconds; window is the time over which the base transit
+        time of a client is its minimum, half_life the time after which the
+        playout delay forgets half of a burst. """
+        self.scheduler = scheduler
+        self.deliver = deliver
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.window = window
+        self.half_life = half_life
+        self.clients = {}
+        # Taken by the network thread scheduling events, the scheduler thread
+        # playing them and the thread forgetting a client
+        self.lock = Lock()
+        self.added_delay = latency.Histogram()
+        self.counters = stats.Counters('scheduled', 'held', 'played', 'late_dropped', 'late_played')
+
+    def delay(self, timing):
+        return min(self.max_delay, max(self.min_delay, timing.peak))
+
+    def schedule(self, ctrl, msg):
+        """ Play a Message with a timestamp at its playout time """
+        now = clock.monotonic()
+        transit = now - msg.timestamp
+        with self.lock:
+            timing = self.clients.get(msg.client)
+            if timing is None:
+                timing = ClientTiming(now, transit, self.window)
+                self.clients[msg.client] = timing
+            # The delay is the one known before this event: a burst makes it late
+            due = msg.timestamp + timing.base() + self.delay(timing)
+            timing.update(now, transit, self.half_life)
+            if due < timing.last_due:
+                due = timing.last_due
+
+            if due < now:
+                if msg.action in DROPPABLE_ACTIONS:
+                    self.counters.late_dropped += 1
+                    return
+                self.counters.late_played += 1
+                due = now
+            timing.last_due = due
+            self.counters.scheduled += 1
+            self.added_delay.record(due - now)
+            self.call_at(timing, due, ctrl, msg)
+
+    def pending(self, client):
+        """ Return True if events of a client are waiting for their playout time """
+        timing = self.clients.get(client)
+        return timing is not None and bool(timing.timers)
+
+    def hold(self, ctrl, msg):
+        """ Queue a Message without a timestamp behind the events of its client
+        still waiting for their playout time. Return False if there are none:
+        the Message can then be handled at once. """
+        with self.lock:
+            timing = self.clients.get(msg.client)
+            if timing is None or not timing.timers:
+                return False
+            self.counters.held += 1
+            # Timers due at the same time are called in order
+            self.call_at(timing, timing.last_due, ctrl, msg)
+            return True
+
+    def call_at(self, timing, due, ctrl, msg):
+        # play() takes the lock before reading the timer from the item
+        item = [ctrl, msg, None]
+        item[2] = timer = self.scheduler.call_at(due, self.play, item)
+        timing.timers.add(timer)
+
+    def play(self, item):
+        """ Called by the scheduler thread when a Message is due """
+        with self.lock:
+            ctrl, msg, timer = item
+            timing = self.clients.get(msg.client)
+            if timing is None or timer not in timing.timers:
+                return
+            timing.timers.discard(timer)
+            self.counters.played += 1
+            # Queued under the lock, so that it is queued before the keys
+            # of a disconnected client are released
+            self.deliver(ctrl, [msg])
+
+    def forget(self, client):
+        """ Cancel the events of a client that disconnected. Once this returns,
+        no event of the client is queued any more. """
+        with self.lock:
+            timing = self.clients.pop(client, None)
+            if timing is None:
+                return
+            for timer in timing.timers:
+                self.scheduler.cancel(timer)
+
+    def stats(self):
+        with self.lock:
+            delays = dict((str(client), self.delay(timing) * 1000) for client, timing in self.clients.items())
+        playout_stats = self.counters.snapshot()
+        playout_stats['added_delay_ms'] = self.added_delay.summary()
+        playout_stats['client_delay_ms'] = delays
+        return playout_stats
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""
+Real-time mode of the threads on the path from a socket to the device: the
+socket server thread and the emitter thread. Each of them can be
+    pinned       to a set of CPUs, so that it is not migrated between cores
+                 and keeps its caches warm
+    prioritized  with the SCHED_FIFO policy, so that it preempts the normal
+                 processes (an emulator using every core) as soon as it is
+                 woken up; this needs CAP_SYS_NICE or an RLIMIT_RTPRIO
+    busy-polling for a bounded time before blocking, so that an event
+                 arriving shortly after the previous one does not pay the
+                 wake-up latency of the scheduler
+Python 2 has no os.sched_setaffinity(), so the C library is called through
+ctypes. A setting that can't be applied is reported and the thread runs
+without it. Busy-polling burns a core while clients are active: it is meant
+for threads pinned to a core of their own. Measure the difference with
+benchmarks/load_test.py.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import sys
+
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from VCCommon import VCLogger
+
+logger = VCLogger.Logger(VCLogger.Level.ALL)
+
+SCHED_OTHER = 0
+SCHED_FIFO = 1
+
+# Size of the CPU mask passed to sched_setaffinity, in CPUs (glibc's cpu_set_t)
+CPU_SETSIZE = 1024
+MASK_WORD_BITS = ctypes.sizeof(ctypes.c_ulong) * 8
+
+class sched_param(ctypes.Structure):
+    _fields_ = [
+        ('sched_priority', ctypes.c_int),
+    ]
+
+def _load_libc():
+    """ Return the C library, or None if it has no scheduler functions """
+    name = ctypes.util.find_library('c')
+    if not name:
+        return None
+    try:
+        libc = ctypes.CDLL(name, use_errno = True)
+        libc.sched_setaffinity.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_void_p]
+        libc.sched_setscheduler.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(sched_param)]
+        libc.sched_get_priority_max.argtypes = [ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+_libc = _load_libc()
+
+class RealtimeConfig:
+    """ Real-time settings of one thread """
+
+    def __init__(self, cpus = None, priority = 0, busy_poll = 0.0):
+        """ cpus is the list of CPUs the thread may run on, None for any.
+        priority is the SCHED_FIFO priority (1 to 99), 0 to keep the normal
+        scheduler. busy_poll is how long, in seconds, the thread polls for
+        new events before blocking. """
+        if priority < 0 or priority > 99:
+            raise ValueError('The real-time priority must be between 0 and 99.')
+        if busy_poll < 0:
+            raise ValueError('The busy-poll time can not be negative.')
+        self.cpus = sorted(set(cpus)) if cpus else None
+        self.priority = priority
+        self.busy_poll = busy_poll
+
+    def is_enabled(self):
+        return self.cpus is not None or self.priority > 0 or self.busy_poll > 0
+
+def parse_cpus(text):
+    """ Return the sorted list of CPUs of a list like '2,3' or '0-3,6'.
+    Raise ValueError if it is invalid. """
+    cpus = set()
+    for part in text.split(','):
+        first, sep, last = part.strip().partition('-')
+        first = int(first)
+        last = int(last) if sep else first
+        if first < 0 or last < first or last >= CPU_SETSIZE:
+            raise ValueError('Invalid CPU range: {}'.format(part))
+        cpus.update(range(first, last + 1))
+    return sorted(cpus)
+
+def _check(result):
+    if result != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+def set_affinity(cpus):
+    """ Pin the calling thread to a list of CPUs. Raise OSError on failure. """
+    if _libc is None:
+        raise OSError(0, 'sched_setaffinity is not available')
+    mask = (ctypes.c_ulong * (CPU_SETSIZE // MASK_WORD_BITS))()
+    for cpu in cpus:
+        mask[cpu // MASK_WORD_BITS] |= 1 << (cpu % MASK_WORD_BITS)
+    # On Linux, pid 0 is the calling thread rather than the whole process
+    _check(_libc.sched_setaffinity(0, ctypes.sizeof(mask), mask))
+
+def set_fifo_priority(priority):
+    """ Schedule the calling thread with SCHED_FIFO at the given priority.
+    Raise OSError on failure, EPERM without the privilege. """
+    if _libc is None:
+        raise OSError(0, 'sched_setscheduler is not available')
+    priority = min(priority, _libc.sched_get_priority_max(SCHED_FIFO))
+    _check(_libc.sched_setscheduler(0, SCHED_FIFO, ctypes.byref(sched_param(priority))))
+    return priority
+
+def apply(thread_name, config):
+    """ Apply a RealtimeConfig to the calling thread, log and return what
+    was actually applied. config may be None. """
+    report = {
+        'cpus': None,
+        'policy': 'SCHED_OTHER',
+        'priority': 0,
+        'busy_poll_us': 0,
+    }
+    if config is None:
+        return report
+    report['busy_poll_us'] = int(config.busy_poll * 1e6)
+
+    if config.cpus is not None:
+        try:
+            set_affinity(config.cpus)
+            report['cpus'] = config.cpus
+        except OSError as err:
+            logger.warning('Could not pin the {} thread to CPUs {}, it may run on any CPU.',
+                thread_name, format_cpus(config.cpus), err = err)
+    if config.priority > 0:
+        try:
+            report['priority'] = set_fifo_priority(config.priority)
+            report['policy'] = 'SCHED_FIFO'
+        except OSError as err:
+            logger.warning('Could not use SCHED_FIFO priority {} for the {} thread, using the normal scheduler.',
+                config.priority, thread_name, err = err)
+
+    logger.info('Real-time mode of the {} thread: CPUs {}, {} priority {}, busy-poll {} us',
+        thread_name, format_cpus(report['cpus']), report['policy'], report['priority'], report['busy_poll_us'])
+    return report
+
+def format_cpus(cpus):
+    if cpus is None:
+        return 'any'
+    return ','.join(str(cpu) for cpu in cpus)
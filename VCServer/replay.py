@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""
+Replay an event log recorded with main.py --record (see event_log.py).
+Key events are turned back into EVENT Messages, or input frames when several
+keys changed at once, and axis events into axis values of the profile. They
+are handled by a Controller with their original timing, a multiple of it, or as fast as possible to
+benchmark the emit path.
+Usage: replay.py LOG [--speed 2] [--max-speed] [--backend recording] [--profile NAME]
+"""
+
+import argparse
+import sys
+import time
+
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from VCCommon import clock
+from VCCommon import message
+from VCCommon import VCLogger
+
+import backends
+import controller
+import event_log
+import key_profiles
+from event_codes import EventTypes
+
+logger = VCLogger.Logger(VCLogger.Level.ALL)
+
+# Client id of the replayed key events (see key_state.py)
+REPLAY_CLIENT = ('replay',)
+
+def event_names(ctrl):
+    """ Return the {event: key name} table of a Controller's mapping """
+    return dict((event, name) for name, event in ctrl.keys.items())
+
+def controller_ids(reader):
+    """ Return the sorted list of controller ids found in a log """
+    return sorted(set(record[1] for record in reader if not event_log.is_session(record)))
+
+def frames(reader):
+    """ Group the key and axis events of a log by input frame: yield
+    (timestamp, controller id, [(event, value), ...]) tuples, one per SYN_REPORT,
+    and (timestamp, event_log.SESSION, None) at the start of every session """
+    events = {}
+    for timestamp, cid, event_type, code, value in reader:
+        if cid == event_log.SESSION and event_type == event_log.SESSION:
+            # Frames left incomplete by the end of the previous session are lost
+            events = {}
+            yield timestamp, cid, None
+        elif event_type in (EventTypes.KEY, EventTypes.ABS):
+            events.setdefault(cid, []).append(((event_type, code), value))
+        elif event_type == EventTypes.SYN and cid in events:
+            yield timestamp, cid, events.pop(cid)
+
+def replay(reader, controllers, speed = 1.0):
+    """ Handle the key events of a log with the given {controller id: Controller}.
+    speed multiplies the original timing; None replays as fast as possible.
+    Single key events go through Controller.handle_message (press_key and
+    release_key), frames of several events through Controller.emit_frame, axis
+    values through Controller.set_axis and are emitted with the frame.
+    Return (replayed events, skipped events, elapsed seconds). """
+    names = dict((cid, event_names(ctrl)) for cid, ctrl in controllers.items())
+    replayed = 0
+    skipped = 0
+    first_timestamp = None
+    start = clock.monotonic()
+    for timestamp, cid, events in frames(reader):
+        if events is None:
+            # A new session has its own monotonic clock: play its first
+            # frame right after the last frame of the previous one
+            first_timestamp = None
+            continue
+        ctrl = controllers.get(cid)
+        keys = []
+        axes = []
+        for event, value in events:
+            if ctrl is not None and event[0] == EventTypes.ABS:
+                axis = ctrl.profile.axis_events.get(event)
+                if axis is not None:
+                    axes.append((axis, value))
+                    continue
+            name = names.get(cid, {}).get(event)
+            if ctrl is None or name is None or value not in (0, 1):
+                skipped += 1
+            else:
+                keys.append((name, value))
+        if not keys and not axes:
+            continue
+
+        if first_timestamp is None:
+            first_timestamp = timestamp
+            session_start = clock.monotonic()
+        if speed is not None:
+            delay = session_start + (timestamp - first_timestamp) / speed - clock.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        for axis, value in axes:
+            ctrl.set_axis(axis, value, REPLAY_CLIENT)
+        if len(keys) == 1:
+            name, value = keys[0]
+            msg = message.Message(
+                title = message.Titles.EVENT,
+                value = name,
+                action = message.Actions.PRESSED if value else message.Actions.RELEASED,
+                status = message.StatusCodes.OK,
+            )
+            msg.client = REPLAY_CLIENT
+            ctrl.handle_message(msg)
+        elif keys:
+            ctrl.emit_frame(keys, REPLAY_CLIENT)
+        ctrl.flush_axes()
+        replayed += len(keys) + len(axes)
+    return replayed, skipped, clock.monotonic() - start
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'Replay an event log recorded by the VirtualController server')
+    parser.add_argument('log', help = 'event log file')
+    parser.add_argument('--speed', type = float, default = 1.0,
+        help = 'replay speed, 2 is twice as fast as recorded (default: 1)')
+    parser.add_argument('--max-speed', action = 'store_true',
+        help = 'replay as fast as possible, ignoring the timing')
+    parser.add_argument('--backend', choices = sorted(backends.BACKENDS), default = 'uinput',
+        help = 'device backend (default: uinput)')
+    parser.add_argument('--profiles', default = key_profiles.PROFILES_DIR,
+        help = 'directory of the key mapping profiles (default: VCServer/profiles)')
+    parser.add_argument('--profile',
+        help = 'key mapping profile of the recorded session (default: the built-in joystick mapping)')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    VCLogger.configure(level = VCLogger.Level.WARNINGS)
+    try:
+        reader = event_log.EventLogReader(args.log)
+    except (IOError, event_log.EventLogError) as err:
+        logger.fatal('Can not read the event log.', err)
+
+    keys = None
+    if args.profile:
+        try:
+            keys = key_profiles.ProfileLibrary(args.profiles).get(args.profile)
+        except key_profiles.ProfileError as err:
+            logger.fatal('Invalid --profile', err)
+
+    controllers = {}
+    for cid in controller_ids(reader):
+        controllers[cid] = controller.Controller(
+            name = 'Replay {}'.format(cid + 1),
+            device_name = 'virtual_controller' if cid == 0 else 'virtual_controller_{}'.format(cid + 1),
+            backend = backends.BACKENDS[args.backend],
+            keys = keys,
+        )
+        controllers[cid].open_device()
+
+    speed = None if args.max_speed else args.speed
+    print 'Replaying {} records for {} controller(s)...'.format(len(reader), len(controllers))
+    try:
+        replayed, skipped, elapsed = replay(reader, controllers, speed)
+        print 'Replayed {} key events in {:.3f}s ({:.0f} events/s), skipped {}.'.format(
+            replayed, elapsed, replayed / elapsed if elapsed else 0, skipped)
+    except KeyboardInterrupt:
+        print 'Interrupted'
+    finally:
+        for ctrl in controllers.values():
+            ctrl.release_client(REPLAY_CLIENT)
+            ctrl.close_device()
+        reader.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""
+Timer thread calling functions at given times of the monotonic clock.
+Every timer of the server lives in a single heap, so the number of threads
+does not grow with the number of active timers. The thread sleeps in
+select() until the next timer is due (or a new, earlier timer is added),
+which wakes up with a much finer resolution than Condition.wait() in Python 2.
+"""
+
+import errno
+import fcntl
+import heapq
+import itertools
+import os
+import select
+import sys
+from threading import Lock, Thread
+
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from VCCommon import clock
+from VCCommon import VCLogger
+
+logger = VCLogger.Logger(VCLogger.Level.ALL)
+
+class Timer:
+    """ Handle of a scheduled call, used to cancel it """
+
+    def __init__(self, due, function, argument):
+        self.due = due
+        self.function = function
+        self.argument = argument
+        self.cancelled = False
+
+class Scheduler(Thread):
+    """ Call functions at given times, from a single thread.
+    Functions are called in the scheduler thread: they must be short, and
+    hand anything writing to a device over to the emitter thread. """
+
+    def __init__(self, spin = 0.0):
+        """ The last spin seconds before a timer is due are spent polling the
+        clock instead of sleeping, for a more precise timing at the cost of CPU. """
+        Thread.__init__(self)
+        self.daemon = True
+        self.spin = spin
+        self.heap = []
+        self.lock = Lock()
+        # Tie breaker between timers due at the same time: first added, first called
+        self.counter = itertools.count()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        # A full pipe already guarantees a wake-up: writes must never block
+        fcntl.fcntl(self.wakeup_w, fcntl.F_SETFL, fcntl.fcntl(self.wakeup_w, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.closed = False
+        # Largest delay between the time a timer was due and the time it was called
+        self.max_lateness = 0.0
+
+    def call_at(self, due, function, argument = None):
+        """ Call function(argument) at the monotonic time due. Return a Timer. """
+        timer = Timer(due, function, argument)
+        with self.lock:
+            if self.closed:
+                timer.cancelled = True
+                return timer
+            heapq.heappush(self.heap, (due, next(self.counter), timer))
+            if self.heap[0][2] is timer:
+                # The thread may be sleeping until a later timer
+                self.wakeup()
+        return timer
+
+    def call_later(self, delay, function, argument = None):
+        """ Call function(argument) in delay seconds. Return a Timer. """
+        return self.call_at(clock.monotonic() + delay, function, argument)
+
+    def cancel(self, timer):
+        """ Cancel a timer. Cancelled timers are dropped when they are due. """
+        timer.cancelled = True
+
+    def pending(self):
+        """ Number of timers in the heap, including cancelled ones not yet due """
+        return len(self.heap)
+
+    def run(self):
+        logger.info('Starting scheduler')
+        while not self.closed:
+            now = clock.monotonic()
+            due_timers = []
+            with self.lock:
+                heap = self.heap
+                while heap and heap[0][0] <= now:
+                    due_timers.append(heapq.heappop(heap)[2])
+                timeout = heap[0][0] - now if heap else None
+
+            for timer in due_timers:
+                if timer.cancelled:
+                    continue
+                lateness = now - timer.due
+                if lateness > self.max_lateness:
+                    self.max_lateness = lateness
+                try:
+                    timer.function(timer.argument)
+                except Exception as err:
+                    logger.warning('Scheduled function failed.', err = err)
+            if due_timers:
+                continue
+
+            if timeout is not None and timeout <= self.spin:
+                continue
+            if timeout is not None:
+                timeout -= self.spin
+            ready = select.select([self.wakeup_r], [], [], timeout)[0]
+            if ready:
+                os.read(self.wakeup_r, 512)
+        logger.info('Scheduler stopped')
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeup_w, 'x')
+        except OSError as err:
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def stop(self):
+        """ Stop the thread; pending timers are not called """
+        with self.lock:
+            self.closed = True
+            del self.heap[:]
+            self.wakeup()
+
+    def close(self):
+        """ Release the wake-up pipe, once the thread is stopped """
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+    def stats(self):
+        return {
+            'pending': len(self.heap),
+            'max_lateness': self.max_lateness,
+        }
@@ -1,118 +1,730 @@
 #!/usr/bin/env python
 
+import errno
+import os
 import socket
 import select
+import stat
 import sys
+from collections import OrderedDict
 from threading import Thread
 
 from os import path
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
+from VCCommon import binary_message
+from VCCommon import clock
 from VCCommon import message
+from VCCommon import shm_ring
 from VCCommon import VCLogger
 
+import realtime
+import stats
+
 logger = VCLogger.Logger(VCLogger.Level.ALL)
 
+# Socket options missing from the socket module of Python 2 (Linux values)
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+TCP_USER_TIMEOUT = getattr(socket, 'TCP_USER_TIMEOUT', 18)
+
+# Seconds without datagrams after which a UDP sender is forgotten and its keys
+# released, without a heartbeat timeout (UdpSender sends snapshots every 0.1s)
+UDP_SENDER_TIMEOUT = 10.0
+
 class SocketServer(Thread):
-    """ Simple socket server. Data must be in JSON format. """
+    """ Event-driven socket server. Data must be in JSON format.
+    A single thread waits on epoll for the listening socket and every connected
+    client, so it does not use any CPU while clients are idle. """
 
-    def __init__(self, cb_read = None, host = '0.0.0.0', port = 2010, max_clients = 3):
+    def __init__(self, cb_read = None, host = '0.0.0.0', port = 2010, max_clients = 3, cb_read_batch = None, cb_disconnect = None, udp_port = None, latency = False, cb_stats = None, unix_path = None, ring_path = None, ring_slots = 1024, reuse_port = False, cb_handoff = None, realtime_config = None, heartbeat_timeout = None, keepalive = None):
         """ Initialize the server with a host and port to listen to.
-        Provide a list of functions that will be used when receiving specific data """
+        cb_read is called with every Message received. If cb_read_batch is set,
+        it is called instead with the list of all Messages extracted from one read.
+        cb_disconnect is called with the client id (Message.client) of every closed connection.
+        If udp_port is set, key events are also received as UDP datagrams on that port.
+        If latency is True, Messages are stamped with the time they were received and parsed.
+        cb_stats returns the dict sent back to clients asking for CONTROL/STATS.
+        If unix_path is set, clients on the same host can also connect to a Unix
+        domain socket at that path. If ring_path is set, a shared-memory ring of
+        ring_slots slots is created at that path (see shm_ring.py).
+        With reuse_port, several processes listen on the same port (see supervisor.py).
+        cb_handoff(conn, controller_id, messages) is called when a connection
+        is bound (HELLO, BIND; None being the default controller), unless it
+        was already handed off once; if it returns True, the connection and
+        the messages left to handle were passed to another process, and the
+        connection is closed here.
+        realtime_config is the realtime.RealtimeConfig of the server thread, if any.
+        If heartbeat_timeout is set, a connection that sends nothing for that
+        many seconds is closed as dead, which releases its keys; idle clients
+        must send CONTROL/HEARTBEAT messages more often than that. UDP senders
+        silent for that long (UDP_SENDER_TIMEOUT by default) are forgotten too.
+        keepalive is an (idle, interval, count) triple of seconds enabling TCP
+        keepalive probes on client sockets (see set_keepalive). """
         Thread.__init__(self)
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         self.host = host
         self.port = port
         self.sock.bind((host, port))
         self.sock.listen(max_clients)
+        self.sock.setblocking(0)
         self.cb_read = cb_read
-        self.sock_threads = []
+        self.cb_read_batch = cb_read_batch
+        self.cb_disconnect = cb_disconnect
+        self.latency = latency
+        self.cb_stats = cb_stats
+        self.cb_handoff = cb_handoff
+        self.realtime_config = realtime_config
+        self.realtime_report = None
+        self.heartbeat_timeout = heartbeat_timeout
+        self.keepalive = keepalive
+        self.clients = {}
+        # fd -> time the client was last heard from, least recently heard first,
+        # so that the timed out clients are found without a scan of every client
+        self.last_seen = OrderedDict()
+        # Other file descriptors watched by the loop: fd -> callback
+        self.readers = {}
+        # Only written by the server thread
+        self.counters = stats.Counters(
+            'connections', 'messages', 'invalid_messages', 'bytes_received',
+            'datagrams', 'late_datagrams', 'ring_wakeups', 'spin_wakeups', 'blocking_polls',
+            'heartbeats', 'timed_out_clients')
+
+        # The wakeup pipe lets stop() interrupt epoll.poll() from another thread
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.epoll = select.epoll()
+        self.epoll.register(self.sock.fileno(), select.EPOLLIN)
+        self.epoll.register(self.wakeup_r, select.EPOLLIN)
+        self.udp = None
+        if udp_port is not None:
+            self.udp = DatagramReceiver(host, udp_port, cb_read, cb_read_batch, latency, self.counters,
+                cb_disconnect, heartbeat_timeout or UDP_SENDER_TIMEOUT)
+            self.epoll.register(self.udp.fileno, select.EPOLLIN)
+        self.unix_path = unix_path
+        self.unix_sock = None
+        if unix_path is not None:
+            self.unix_sock = listen_unix(unix_path, max_clients)
+            self.epoll.register(self.unix_sock.fileno(), select.EPOLLIN)
+            logger.info('Listening on Unix socket {}', unix_path)
+        self.ring = None
+        if ring_path is not None:
+            self.ring = RingReceiver(ring_path, ring_slots, cb_read, cb_read_batch, cb_disconnect, latency, self.counters)
+            self.epoll.register(self.ring.fileno, select.EPOLLIN)
+        self.__stop = False
 
     def close(self):
-        """ Close the client socket threads and server socket if they exists. """
-        logger.info('Closing server socket (host {}, port {})'.format(self.host, self.port))
+        """ Close the client connections and server socket if they exists. """
+        logger.info('Closing server socket (host {}, port {})', self.host, self.port)
 
-        for thr in self.sock_threads:
-            thr.stop()
-            thr.join()
+        for conn in self.clients.values():
+            self.close_client(conn)
 
         if self.sock:
             self.sock.close()
             self.sock = None
+        if self.udp:
+            self.udp.close()
+            self.udp = None
+        if self.unix_sock:
+            self.unix_sock.close()
+            self.unix_sock = None
+            try:
+                os.unlink(self.unix_path)
+            except OSError:
+                pass
+        if self.ring:
+            self.ring.close()
+            self.ring = None
+        if self.epoll:
+            self.epoll.close()
+            self.epoll = None
+            os.close(self.wakeup_r)
+            os.close(self.wakeup_w)
 
     def run(self):
-        """ Accept an incoming connection.
-        Start a new SocketServerThread that will handle the communication. """
-        logger.info('Starting socket server (host {}, port {})'.format(self.host, self.port))
+        """ Wait for readiness events on the server socket and all client sockets.
+        New connections are accepted right away, client data is handed to the
+        ClientConnection that owns the socket. """
+        logger.info('Starting socket server (host {}, port {})', self.host, self.port)
+        self.realtime_report = realtime.apply('socket server', self.realtime_config)
+        spin = self.realtime_config.busy_poll if self.realtime_config is not None else 0.0
 
-        self.__stop = False
         while not self.__stop:
-            self.sock.settimeout(1)
             try:
-                client_sock, client_addr = self.sock.accept()
-            except socket.timeout:
-                client_sock = None
+                events = self.poll(spin, self.next_timeout())
+            except IOError as err:
+                if err.errno == errno.EINTR:
+                    continue
+                logger.warning('epoll() failed on the server socket', err = err)
+                break
+
+            for fd, event_mask in events:
+                if fd == self.sock.fileno():
+                    self.accept_clients(self.sock)
+                elif fd == self.wakeup_r:
+                    os.read(self.wakeup_r, 64)
+                elif self.ring and fd == self.ring.fileno:
+                    self.ring.on_event(event_mask)
+                elif self.udp and fd == self.udp.fileno:
+                    self.udp.on_event(event_mask)
+                elif self.unix_sock and fd == self.unix_sock.fileno():
+                    self.accept_clients(self.unix_sock)
+                elif fd in self.readers:
+                    self.readers[fd]()
+                else:
+                    conn = self.clients.get(fd)
+                    if conn is None:
+                        continue
+                    if not conn.on_event(event_mask):
+                        self.close_client(conn)
+                    elif self.heartbeat_timeout is not None:
+                        self.touch(fd)
+
+            if self.heartbeat_timeout is not None:
+                self.expire_clients()
+            if self.udp:
+                self.udp.expire_senders()
+
+    def poll(self, spin, timeout = -1):
+        """ Return the readiness events, polling without blocking for up to
+        spin seconds before waiting in epoll for up to timeout seconds """
+        if spin:
+            deadline = clock.monotonic() + spin
+            while True:
+                # epoll.poll releases the GIL even without a timeout
+                events = self.epoll.poll(0)
+                if events:
+                    self.counters.spin_wakeups += 1
+                    return events
+                if clock.monotonic() >= deadline:
+                    break
+        self.counters.blocking_polls += 1
+        return self.epoll.poll(timeout)
+
+    def next_timeout(self):
+        """ Return how long epoll may wait before the next client times out, -1 for ever """
+        deadlines = []
+        if self.heartbeat_timeout is not None and self.last_seen:
+            deadlines.append(next(self.last_seen.itervalues()) + self.heartbeat_timeout)
+        if self.udp and self.udp.last_seen:
+            deadlines.append(self.udp.next_deadline())
+        if not deadlines:
+            return -1
+        return max(0.0, min(deadlines) - clock.monotonic())
+
+    def touch(self, fd):
+        """ Record that a client was heard from: it becomes the most recent one """
+        last_seen = self.last_seen
+        last_seen.pop(fd, None)
+        last_seen[fd] = clock.monotonic()
+
+    def expire_clients(self):
+        """ Close the connections that sent nothing for heartbeat_timeout.
+        Only the timed out clients and the oldest live one are visited. """
+        deadline = clock.monotonic() - self.heartbeat_timeout
+        last_seen = self.last_seen
+        while last_seen:
+            fd, seen = next(last_seen.iteritems())
+            if seen > deadline:
+                break
+            del last_seen[fd]
+            conn = self.clients.get(fd)
+            if conn is not None:
+                logger.warning('No data from {} for {}s, closing the connection.', conn.client_addr, self.heartbeat_timeout)
+                self.counters.timed_out_clients += 1
+                self.close_client(conn)
+
+    def accept_clients(self, listen_sock):
+        """ Accept every pending connection on a (non-blocking) listening socket. """
+        while True:
+            try:
+                client_sock, client_addr = listen_sock.accept()
+            except socket.error as err:
+                if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                logger.warning('accept() failed on the server socket', err = err)
+                return
+
+            if listen_sock is self.unix_sock:
+                # Unix clients have no address: the fd identifies the connection
+                client_addr = ('unix', client_sock.fileno())
+            self.add_client(client_sock, client_addr)
+            logger.connection_info('SocketServer accepted client {}', client_addr)
+
+    def add_client(self, client_sock, client_addr):
+        """ Start watching a connected client socket. Return its ClientConnection. """
+        client_sock.setblocking(0)
+        if self.keepalive is not None and client_sock.family == socket.AF_INET:
+            try:
+                set_keepalive(client_sock, *self.keepalive)
+            except socket.error as err:
+                logger.warning('Could not enable TCP keepalive for {}.', client_addr, err = err)
+        conn = ClientConnection(client_sock, client_addr, self.cb_read, self.cb_read_batch,
+            self.latency, self.counters, self.cb_stats, self.cb_handoff)
+        self.clients[conn.fileno] = conn
+        self.counters.connections += 1
+        self.epoll.register(conn.fileno, select.EPOLLIN)
+        if self.heartbeat_timeout is not None:
+            self.touch(conn.fileno)
+        return conn
 
-            if client_sock:
-                client_thr = SocketServerThread(client_sock, client_addr, self.cb_read)
-                self.sock_threads.append(client_thr)
-                client_thr.start()
+    def adopt(self, client_sock, client_addr, protocol, controller_id, pending, messages):
+        """ Serve a connection passed by another process: it used protocol, was
+        bound to controller_id, had received the bytes pending of an incomplete
+        message, and messages are the Messages it had left to handle.
+        Only called from the server thread. """
+        conn = self.add_client(client_sock, client_addr)
+        conn.adopted = True
+        logger.connection_info('SocketServer adopted client {}', client_addr)
+        if protocol == message.Protocols.BINARY:
+            conn.parser = binary_message.BinaryParser()
+        conn.bind(controller_id)
+        if pending:
+            messages = messages + conn.parser.feed(pending)
+        if not conn.dispatch(messages):
+            self.close_client(conn)
+
+    def add_reader(self, fd, callback):
+        """ Call callback() from the server thread whenever fd is readable.
+        Must be called before the server is started. """
+        self.readers[fd] = callback
+        self.epoll.register(fd, select.EPOLLIN)
+
+    def close_client(self, conn):
+        """ Stop watching a client socket and close it. """
+        if self.clients.pop(conn.fileno, None) is None:
+            return
+        self.last_seen.pop(conn.fileno, None)
+        if self.epoll:
+            try:
+                self.epoll.unregister(conn.fileno)
+            except (IOError, ValueError):
+                pass
+        conn.close()
+        if self.cb_disconnect:
+            self.cb_disconnect(conn.client_addr)
 
     def stop(self):
         self.__stop = True
+        if self.epoll:
+            os.write(self.wakeup_w, 'x')
 
-class SocketServerThread(Thread):
-    def __init__(self, client_sock, client_addr, cb_read = None):
-        """ Initialize the Thread with a client socket and address """
-        Thread.__init__(self)
+def set_keepalive(sock, idle, interval, count):
+    """ Probe a connection idle for idle seconds every interval seconds, and
+    abort it after count unanswered probes. Data left unacknowledged for
+    as long also aborts it (TCP_USER_TIMEOUT), even if it was not idle. """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    sock.setsockopt(socket.IPPROTO_TCP, TCP_USER_TIMEOUT, (idle + interval * count) * 1000)
+
+class ClientConnection:
+    """ State of a single client connected to the SocketServer. """
+
+    RECV_SIZE = 4096
+
+    def __init__(self, client_sock, client_addr, cb_read = None, cb_read_batch = None, latency = False, counters = None, cb_stats = None, cb_handoff = None):
+        """ Initialize the connection with a client socket and address.
+        counters are the network Counters of the server, cb_stats returns the
+        answer to CONTROL/STATS messages, cb_handoff may pass the connection to
+        another process when the client binds it (see SocketServer). """
         self.client_sock = client_sock
         self.client_addr = client_addr
+        self.fileno = client_sock.fileno()
         self.cb_read = cb_read
+        self.cb_read_batch = cb_read_batch
+        self.latency = latency
+        self.counters = counters or stats.Counters('messages', 'invalid_messages', 'bytes_received', 'heartbeats')
+        self.cb_stats = cb_stats
+        self.cb_handoff = cb_handoff
+        self.recv_buffer = bytearray(self.RECV_SIZE)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.parser = message.MessageParser()
+        self.controller_id = None
+        # Handed off by another process: it is not passed on again, so that
+        # a client alternating between controllers does not bounce around
+        self.adopted = False
 
-    def run(self):
-        logger.connection_info("SocketServerThread starting with client {}".format(self.client_addr))
-        self.__stop = False
-        while not self.__stop:
-            if self.client_sock:
-                # Check if the client is still connected and if data is available:
-                try:
-                    rdy_read, rdy_write, sock_err = select.select([self.client_sock,], [self.client_sock,], [], 5)
-                except select.error as err:
-                    logger.warning('Select() failed on socket with {}'.format(self.client_addr), err)
-                    self.stop()
-                    return
+    def on_event(self, event_mask):
+        """ Handle a readiness event for this client.
+        Return False when the connection must be closed. """
+        if event_mask & select.EPOLLIN:
+            try:
+                read_size = self.client_sock.recv_into(self.recv_buffer)
+            except socket.error as err:
+                if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return True
+                logger.warning('recv() failed on socket with {}', self.client_addr, err = err)
+                return False
+
+            # Check if socket has been closed
+            if read_size == 0:
+                logger.connection_info('{} closed the socket.', self.client_addr)
+                return False
+
+            received_at = clock.monotonic() if self.latency else None
+            invalid_count = self.parser.invalid_count
+            messages = self.parser.feed(self.recv_view[:read_size])
+            counters = self.counters
+            counters.bytes_received += read_size
+            counters.messages += len(messages)
+            if self.parser.invalid_count != invalid_count:
+                counters.invalid_messages += self.parser.invalid_count - invalid_count
+                logger.warning("Received {} invalid message(s) from {}",
+                    self.parser.invalid_count - invalid_count, self.client_addr)
+            if received_at is not None:
+                stamp(messages, received_at)
+            return self.dispatch(messages)
+
+        if event_mask & (select.EPOLLHUP | select.EPOLLERR):
+            logger.connection_info('{} closed the socket.', self.client_addr)
+            return False
+        return True
 
-                if len(rdy_read) > 0:
-                    read_data = self.client_sock.recv(255)
-
-                    # Check if socket has been closed
-                    if len(read_data) == 0:
-                        logger.connection_info('{} closed the socket.'.format(self.client_addr))
-                        self.stop()
-                    else:
-                        msg = message.Message()
-                        msg.read_message(read_data)
-                        if msg.is_valid():
-                            if msg.title == message.Titles.CONTROL and msg.action == message.Actions.STOP_CONTROLLER:
-                                logger.connection_info('Stopping this controller {}'.format(self.client_addr))
-                                self.stop()
-                            else:
-                                self.cb_read(msg)
-
-                        else:
-                            logger.warning("Received an invalid message from {}: {}".format(self.client_addr, read_data))
+    def dispatch(self, messages):
+        """ Hand the Messages extracted from one read to the callbacks.
+        Return False if the client asked to stop this connection. """
+        keep_open = True
+        routed = []
+        for i, msg in enumerate(messages):
+            if msg.title == message.Titles.CONTROL:
+                if msg.action == message.Actions.STOP_CONTROLLER:
+                    logger.connection_info('Stopping this controller {}', self.client_addr)
+                    keep_open = False
+                    break
+                if msg.action == message.Actions.HELLO:
+                    # The handshake is the last message of its read, the client
+                    # waits for the answer before sending anything else
+                    if self.hand_off(msg.controller, messages[i:], routed):
+                        return False
+                    self.bind(msg.controller)
+                    keep_open = self.handshake(msg)
+                    break
+                if msg.action == message.Actions.HEARTBEAT:
+                    # Receiving it is all that matters
+                    self.counters.heartbeats += 1
+                    continue
+                if msg.action == message.Actions.BIND:
+                    if self.hand_off(msg.value, messages[i:], routed):
+                        return False
+                    self.bind(msg.value)
+                    continue
+                if msg.action == message.Actions.CLOCK:
+                    if not self.send_clock(msg):
+                        keep_open = False
+                        break
+                    continue
+                if msg.action == message.Actions.STATS:
+                    if not self.send_stats():
+                        keep_open = False
+                        break
+                    continue
+            if msg.controller is None:
+                msg.controller = self.controller_id
+            msg.client = self.client_addr
+            routed.append(msg)
+
+        self.deliver(routed)
+        return keep_open
+
+    def deliver(self, messages):
+        """ Hand routed Messages to the callbacks """
+        if messages:
+            if self.cb_read_batch:
+                self.cb_read_batch(messages)
             else:
-                logger.connection_info("No client is connected, SocketServer can't receive data")
-                self.stop()
+                for msg in messages:
+                    self.cb_read(msg)
 
-        self.close()
+    def hand_off(self, controller_id, messages, routed):
+        """ Offer the connection to cb_handoff for a controller, with the
+        Messages left to handle, after delivering the routed ones so that
+        the order is kept. Return True if it was passed to another process. """
+        if self.cb_handoff is None or self.adopted:
+            return False
+        self.deliver(routed)
+        del routed[:]
+        return self.cb_handoff(self, controller_id, messages)
 
-    def stop(self):
-        self.__stop = True
+    def bind(self, controller_id):
+        """ Send the next messages without a controller field to the given controller """
+        if controller_id is not None:
+            self.controller_id = controller_id
+            logger.connection_info('{} bound to controller {}', self.client_addr, controller_id)
+
+    def handshake(self, msg):
+        """ Answer a HELLO message and switch to the requested protocol if supported. """
+        protocol = message.Protocols.JSON
+        if msg.value == message.Protocols.BINARY:
+            protocol = message.Protocols.BINARY
+
+        reply = message.Message(
+            title = message.Titles.CONTROL,
+            value = protocol,
+            action = message.Actions.HELLO,
+            status = message.StatusCodes.OK,
+        )
+        if not self.send(reply.format_frame()):
+            return False
+
+        if protocol == message.Protocols.BINARY:
+            self.parser = binary_message.BinaryParser()
+        logger.connection_info('{} uses protocol {}', self.client_addr, protocol)
+        return True
+
+    def send_clock(self, msg):
+        """ Answer a CLOCK message with the client time it carries and the server time """
+        reply = message.Message(
+            title = message.Titles.CONTROL,
+            value = [msg.value, clock.monotonic()],
+            action = message.Actions.CLOCK,
+            status = message.StatusCodes.OK,
+        )
+        return self.send(reply.format_frame())
+
+    def send_stats(self):
+        """ Answer a STATS message with the counters of the server """
+        if self.cb_stats is None:
+            value = self.counters.snapshot()
+        else:
+            value = self.cb_stats()
+        reply = message.Message(
+            title = message.Titles.CONTROL,
+            value = value,
+            action = message.Actions.STATS,
+            status = message.StatusCodes.OK,
+        )
+        return self.send(reply.format_frame())
+
+    def send(self, data):
+        """ Send data to the client. Return False if the connection is broken. """
+        try:
+            self.client_sock.sendall(data)
+        except socket.error as err:
+            logger.warning('send() failed on socket with {}', self.client_addr, err = err)
+            return False
+        return True
 
     def close(self):
         """ Close connection with the client socket. """
         if self.client_sock:
-            logger.connection_info("Closing connection with {}".format(self.client_addr))
+            logger.connection_info("Closing connection with {}", self.client_addr)
             self.client_sock.close()
+            self.client_sock = None
+
+class DatagramReceiver:
+    """ UDP socket receiving key events and snapshots as binary datagrams
+    (see binary_message.py). Late and duplicated datagrams are dropped using
+    their sequence number. Only EVENT messages are accepted: control messages
+    must use the TCP connection. A sender silent for sender_timeout seconds
+    is forgotten, and cb_disconnect is called with its client id. """
+
+    RECV_SIZE = 2048
+
+    def __init__(self, host, port, cb_read = None, cb_read_batch = None, latency = False, counters = None, cb_disconnect = None, sender_timeout = UDP_SENDER_TIMEOUT):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.setblocking(0)
+        self.host = host
+        self.port = port
+        self.fileno = self.sock.fileno()
+        self.cb_read = cb_read
+        self.cb_read_batch = cb_read_batch
+        self.latency = latency
+        self.cb_disconnect = cb_disconnect
+        self.sender_timeout = sender_timeout
+        self.counters = counters or stats.Counters(
+            'messages', 'invalid_messages', 'bytes_received', 'datagrams', 'late_datagrams', 'timed_out_clients')
+        self.recv_buffer = bytearray(self.RECV_SIZE)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.parser = binary_message.BinaryParser()
+        # Last sequence number accepted from each sender
+        self.sequences = {}
+        # Sender address -> time of its last datagram, least recent first
+        self.last_seen = OrderedDict()
+        logger.info('Receiving UDP datagrams (host {}, port {})', host, port)
+
+    def on_event(self, event_mask):
+        """ Read every pending datagram and hand their Messages to the callbacks. """
+        messages = []
+        header_size = binary_message.DATAGRAM_HEADER.size
+        counters = self.counters
+        while True:
+            try:
+                read_size, addr = self.sock.recvfrom_into(self.recv_buffer)
+            except socket.error as err:
+                if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    logger.warning('recvfrom() failed on the UDP socket', err = err)
+                break
+
+            counters.datagrams += 1
+            counters.bytes_received += read_size
+            if read_size < header_size:
+                counters.invalid_messages += 1
+                continue
+            received_at = clock.monotonic() if self.latency else None
+            self.last_seen.pop(addr, None)
+            self.last_seen[addr] = clock.monotonic()
+            kind, controller_id, sequence = binary_message.DATAGRAM_HEADER.unpack_from(self.recv_buffer, 0)
+            last_sequence = self.sequences.get(addr)
+            if last_sequence is not None and not binary_message.is_newer(sequence, last_sequence):
+                counters.late_datagrams += 1
+                continue
+            self.sequences[addr] = sequence
+
+            if kind == binary_message.DatagramKinds.EVENTS:
+                invalid_count = self.parser.invalid_count
+                datagram_messages = self.parser.feed(self.recv_view[header_size:read_size])
+                counters.invalid_messages += self.parser.invalid_count - invalid_count
+                del self.parser.buffer[:]
+            elif kind == binary_message.DatagramKinds.SNAPSHOT:
+                datagram_messages = [message.Message(
+                    title = message.Titles.EVENT,
+                    value = binary_message.decode_snapshot(self.recv_buffer[:read_size], header_size),
+                    action = message.Actions.SNAPSHOT,
+                    status = message.StatusCodes.OK,
+                )]
+            else:
+                counters.invalid_messages += 1
+                continue
+            if received_at is not None:
+                stamp(datagram_messages, received_at)
+
+            client = ('udp', addr)
+            for msg in datagram_messages:
+                if msg.title != message.Titles.EVENT:
+                    counters.invalid_messages += 1
+                    continue
+                msg.controller = controller_id
+                msg.client = client
+                messages.append(msg)
+
+        if messages:
+            counters.messages += len(messages)
+            if self.cb_read_batch:
+                self.cb_read_batch(messages)
+            else:
+                for msg in messages:
+                    self.cb_read(msg)
+        return True
+
+    def next_deadline(self):
+        """ Return the time the least recent sender times out """
+        return next(self.last_seen.itervalues()) + self.sender_timeout
+
+    def expire_senders(self):
+        """ Forget the senders silent for sender_timeout and release their keys.
+        Only the timed out senders and the oldest live one are visited. """
+        last_seen = self.last_seen
+        if not last_seen:
+            return
+        deadline = clock.monotonic() - self.sender_timeout
+        while last_seen:
+            addr, seen = next(last_seen.iteritems())
+            if seen > deadline:
+                break
+            del last_seen[addr]
+            self.sequences.pop(addr, None)
+            self.counters.timed_out_clients += 1
+            logger.connection_info('No datagram from {} for {}s, forgetting it.', addr, self.sender_timeout)
+            if self.cb_disconnect:
+                self.cb_disconnect(('udp', addr))
+
+    def close(self):
+        self.sock.close()
+
+class RingReceiver:
+    """ Server end of a shared-memory ring (see shm_ring.py).
+    The doorbell FIFO is watched by the epoll loop with the sockets; slots are
+    decoded to Messages and handed to the same callbacks as TCP messages, with
+    the client id ('shm', ring path). STATS, which needs an answer, is not
+    supported; STOP_CONTROLLER ends the session of the producer, which
+    releases its keys like a closed connection. """
+
+    def __init__(self, ring_path, slot_count, cb_read = None, cb_read_batch = None, cb_disconnect = None, latency = False, counters = None):
+        self.ring = shm_ring.ShmRing(ring_path, slot_count)
+        self.path = ring_path
+        self.fileno = shm_ring.create_doorbell(ring_path)
+        self.cb_read = cb_read
+        self.cb_read_batch = cb_read_batch
+        self.cb_disconnect = cb_disconnect
+        self.latency = latency
+        self.counters = counters or stats.Counters('messages', 'invalid_messages', 'ring_wakeups')
+        self.client = ('shm', ring_path)
+        logger.info('Receiving events from shared-memory ring {} ({} slots)', ring_path, slot_count)
+
+    def on_event(self, event_mask):
+        """ Drain the doorbell, then every slot published so far """
+        shm_ring.clear_doorbell(self.fileno)
+        slots = self.ring.drain()
+        if not slots:
+            return True
+        received_at = clock.monotonic() if self.latency else None
+        counters = self.counters
+        counters.ring_wakeups += 1
+        messages = []
+        disconnected = False
+        for slot in slots:
+            try:
+                msg, controller_id = shm_ring.decode(slot)
+            except (KeyError, IndexError):
+                counters.invalid_messages += 1
+                continue
+            if msg.title == message.Titles.CONTROL:
+                if msg.action == message.Actions.STOP_CONTROLLER:
+                    disconnected = True
+                    continue
+                if msg.action == message.Actions.STATS:
+                    counters.invalid_messages += 1
+                    continue
+                if msg.action == message.Actions.HEARTBEAT:
+                    # A ring has no connection to time out
+                    continue
+            msg.controller = controller_id
+            msg.client = self.client
+            messages.append(msg)
+        if received_at is not None:
+            stamp(messages, received_at)
+
+        if messages:
+            counters.messages += len(messages)
+            if self.cb_read_batch:
+                self.cb_read_batch(messages)
+            else:
+                for msg in messages:
+                    self.cb_read(msg)
+        if disconnected:
+            logger.connection_info('{} closed the ring session.', self.client)
+            if self.cb_disconnect:
+                self.cb_disconnect(self.client)
+        return True
+
+    def close(self):
+        os.close(self.fileno)
+        self.ring.close()
+        shm_ring.remove(self.path)
+
+def listen_unix(unix_path, backlog):
+    """ Return a non-blocking Unix domain socket listening at unix_path.
+    A socket file left by a server that did not exit cleanly is replaced. """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        if stat.S_ISSOCK(os.stat(unix_path).st_mode):
+            os.unlink(unix_path)
+    except OSError:
+        pass
+    sock.bind(unix_path)
+    sock.listen(backlog)
+    sock.setblocking(0)
+    return sock
+
+def stamp(messages, received_at):
+    """ Set the reception and parsing times used to measure latency (see latency.py) """
+    parsed_at = clock.monotonic()
+    for msg in messages:
+        msg.received_at = received_at
+        msg.parsed_at = parsed_at
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+"""
+Operational counters of a running server, answered to CONTROL/STATS messages.
+Each thread increments its own Counters (the socket server thread for the
+network, the emitter thread for the Controllers), so counting is a plain
+attribute increment without any lock. Other threads only read them; under
+the GIL a read returns either the old or the new value of a counter.
+"""
+
+class Counters(object):
+    """ Named integer counters, written by a single thread. """
+
+    def __init__(self, *names):
+        for name in names:
+            setattr(self, name, 0)
+
+    def snapshot(self):
+        """ Return a copy of the counters, by name """
+        return dict(self.__dict__)
+
+class Rate:
+    """ Rate of increase of a counter between two calls to update() """
+
+    def __init__(self, now, value = 0):
+        self.time = now
+        self.value = value
+
+    def update(self, now, value):
+        """ Return the increase per second since the previous update """
+        elapsed = now - self.time
+        rate = (value - self.value) / elapsed if elapsed > 0 else 0.0
+        self.time = now
+        self.value = value
+        return rate
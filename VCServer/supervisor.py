@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+
+"""
+Supervisor mode: the players are shared by several worker processes, so that
+the server is not limited to a single core by the GIL.
+
+Worker i owns the controllers whose id modulo the number of workers is i, and
+runs a ControllerHub for them. Every worker listens on the same TCP port with
+SO_REUSEPORT, so the kernel spreads the connections over the workers. When a
+connection is bound to a controller owned by another worker (HELLO, BIND; no
+controller means controller 0), it is handed off: its socket is passed to the
+owner (SCM_RIGHTS over a Unix socket) with the messages it had left to
+handle, and the owner serves it as if it had accepted the connection. A
+connection is handed off at most once: the messages it sends afterwards to
+the controllers of another worker, like the control messages injected by the
+supervisor, are forwarded to their owner through the supervisor, and the keys
+they pressed there are released when the connection closes. STOP_SERVER
+stops every worker.
+
+The supervisor restarts a worker that exits unexpectedly. Only the devices of
+that worker are recreated; the other players are not affected. Workers only
+keep the ends of the channels they use, and exit when the supervisor dies.
+"""
+
+import _multiprocessing
+import base64
+import errno
+import json
+import multiprocessing
+import os
+import select
+import socket
+import sys
+
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from VCCommon import binary_message
+from VCCommon import clock
+from VCCommon import message
+from VCCommon import VCLogger
+
+import stats
+
+logger = VCLogger.Logger(VCLogger.Level.ALL)
+
+# Controller of the messages and handshakes without a controller id
+DEFAULT_CONTROLLER = 0
+# Largest metadata datagram of a hand-off
+HANDOFF_SIZE = 1 << 16
+
+class HandoffChannel:
+    """ Datagram socket pair passing client sockets from one worker to another.
+    Each channel has a single sender, so the datagram carrying a socket and the
+    one carrying its metadata are never interleaved with another hand-off. """
+
+    def __init__(self):
+        self.receiver, self.sender = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def send(self, sock, metadata):
+        """ Pass a socket and its metadata, a JSON object """
+        _multiprocessing.sendfd(self.sender.fileno(), sock.fileno())
+        self.sender.send(metadata)
+
+    def receive(self, timeout = 1.0):
+        """ Return the (fd, metadata) of a hand-off, or None if the sender
+        died before sending both parts. """
+        try:
+            fd = _multiprocessing.recvfd(self.receiver.fileno())
+        except (RuntimeError, OSError) as err:
+            logger.warning('Received a hand-off without a socket.', err = err)
+            return None
+        try:
+            if not select.select([self.receiver], [], [], timeout)[0]:
+                raise ValueError('no metadata')
+            metadata = json.loads(self.receiver.recv(HANDOFF_SIZE))
+            if not isinstance(metadata, dict):
+                raise ValueError('invalid metadata')
+        except (ValueError, socket.error) as err:
+            logger.warning('Dropping a hand-off without metadata.', err = err)
+            os.close(fd)
+            return None
+        return fd, metadata
+
+class WorkerLink:
+    """ What a worker knows of the supervisor: the controllers it owns, the
+    hand-off channels to the other workers, and the control connection. """
+
+    def __init__(self, index, worker_count, controller_count, outgoing, incoming, control):
+        """ outgoing maps worker indexes to the channels this worker sends to,
+        incoming lists the channels it receives from. """
+        self.index = index
+        self.worker_count = worker_count
+        self.controller_count = controller_count
+        self.outgoing = outgoing
+        self.incoming = incoming
+        self.control = control
+        self.control_buffer = ''
+        self.hub = None
+        self.controllers = frozenset(i for i in range(controller_count) if i % worker_count == index)
+        # Clients whose messages were forwarded to other workers
+        self.forwarded_clients = set()
+        self.counters = stats.Counters('handoffs_sent', 'handoffs_received', 'forwarded')
+
+    def owner(self, controller_id):
+        """ Return the index of the worker owning a controller, or None if there is no such controller """
+        try:
+            controller_id = int(controller_id)
+        except (TypeError, ValueError):
+            return None
+        if not 0 <= controller_id < self.controller_count:
+            return None
+        return controller_id % self.worker_count
+
+    def owns(self, controller_id):
+        try:
+            return int(controller_id) in self.controllers
+        except (TypeError, ValueError):
+            return False
+
+    def is_remote(self, controller_id):
+        """ Return True if the controller exists and is owned by another worker """
+        return not self.owns(controller_id) and self.owner(controller_id) is not None
+
+    def used_sockets(self):
+        """ Return the sockets of the channels and control connection this worker uses """
+        return ([channel.sender for channel in self.outgoing.values()]
+            + [channel.receiver for channel in self.incoming] + [self.control])
+
+    def attach(self, hub):
+        """ Watch the hand-off channels and the control connection in the socket server of the hub """
+        self.hub = hub
+        self.control.setblocking(0)
+        server = hub.server_sock
+        for channel in self.incoming:
+            server.add_reader(channel.receiver.fileno(), lambda channel = channel: self.on_handoff(channel))
+        server.add_reader(self.control.fileno(), self.on_control)
+
+    def handoff(self, conn, controller_id, messages):
+        """ Pass a connection to the worker owning a controller, with the
+        Messages it has left to handle. Return False if it has to be served here. """
+        if controller_id is None:
+            controller_id = DEFAULT_CONTROLLER
+        owner = self.owner(controller_id)
+        if owner is None or owner == self.index:
+            return False
+        metadata = json.dumps({
+            'client': list(conn.client_addr),
+            'protocol': message.Protocols.BINARY if isinstance(conn.parser, binary_message.BinaryParser) else message.Protocols.JSON,
+            'controller': conn.controller_id,
+            'pending': base64.b64encode(str(conn.parser.buffer)),
+            'messages': [msg.format_json() for msg in messages],
+        })
+        if len(metadata) > HANDOFF_SIZE:
+            logger.warning('Too many messages to hand {} to worker {}.', conn.client_addr, owner)
+            return False
+        try:
+            self.outgoing[owner].send(conn.client_sock, metadata)
+        except (OSError, socket.error) as err:
+            logger.warning('Could not hand {} to worker {}.', conn.client_addr, owner, err = err)
+            return False
+        self.counters.handoffs_sent += 1
+        logger.connection_info('Handed {} to worker {} (controller {})', conn.client_addr, owner, controller_id)
+        return True
+
+    def on_handoff(self, channel):
+        """ Serve a connection handed off by another worker """
+        handoff = channel.receive()
+        if handoff is None:
+            return
+        fd, metadata = handoff
+        try:
+            client_sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        finally:
+            os.close(fd)
+        parser = message.MessageParser()
+        messages = []
+        for text in metadata.get('messages', []):
+            messages.extend(parser.feed(str(text) + message.FRAME_DELIMITER))
+        try:
+            pending = base64.b64decode(metadata.get('pending', ''))
+        except (TypeError, ValueError):
+            pending = ''
+        self.counters.handoffs_received += 1
+        self.hub.server_sock.adopt(client_sock, tuple(metadata.get('client') or ('handoff', fd)),
+            metadata.get('protocol'), metadata.get('controller'), pending, messages)
+
+    def forward(self, msg):
+        """ Send a message for a controller of another worker to the supervisor """
+        self.counters.forwarded += 1
+        client = msg.client
+        if client is not None:
+            self.forwarded_clients.add(client)
+            client = list(client) if isinstance(client, tuple) else client
+        self.send_control({'forward': msg.format_json(), 'client': client})
+
+    def forget(self, client):
+        """ Release on the other workers the keys of a closed connection whose messages were forwarded """
+        if client in self.forwarded_clients:
+            self.forwarded_clients.discard(client)
+            self.send_control({'release': list(client) if isinstance(client, tuple) else client})
+
+    def request_stop(self):
+        """ Ask the supervisor to stop every worker """
+        self.send_control({'stop': True})
+
+    def send_control(self, data):
+        try:
+            self.control.sendall(json.dumps(data) + '\n')
+        except socket.error as err:
+            logger.warning('Lost the connection to the supervisor.', err = err)
+            self.hub.stop()
+
+    def on_control(self):
+        """ Read the messages sent by the supervisor """
+        try:
+            data = self.control.recv(4096)
+        except socket.error as err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            logger.warning('Lost the connection to the supervisor, stopping worker {}.', self.index)
+            self.hub.stop()
+            return
+        lines = (self.control_buffer + data).split('\n')
+        self.control_buffer = lines.pop()
+        for line in lines:
+            try:
+                command = json.loads(line)
+            except ValueError:
+                continue
+            if command.get('stop'):
+                logger.info('Worker {} stopping', self.index)
+                self.hub.stop()
+            elif 'message' in command:
+                messages = message.MessageParser().feed(str(command['message']) + message.FRAME_DELIMITER)
+                client = client_key(command.get('client'))
+                for msg in messages:
+                    msg.client = client
+                if messages:
+                    self.hub.on_client_events(messages)
+            elif 'release' in command:
+                self.hub.on_client_disconnect(client_key(command['release']))
+
+    def stats(self):
+        worker_stats = self.counters.snapshot()
+        worker_stats['index'] = self.index
+        return worker_stats
+
+def client_key(client):
+    """ Return the client of a message decoded from JSON, as the socket server names it """
+    if client is None:
+        return ('supervisor',)
+    if isinstance(client, list):
+        return tuple(client_key(part) for part in client)
+    if isinstance(client, unicode):
+        return str(client)
+    return client
+
+class Supervisor:
+    """ Fork the workers, route the control messages between them, and restart the ones that die """
+
+    def __init__(self, worker_count, controller_count, run_worker, restart_delay = 1.0):
+        """ run_worker(link) runs a worker in the child process, link being its WorkerLink """
+        self.worker_count = worker_count
+        self.controller_count = controller_count
+        self.run_worker = run_worker
+        self.restart_delay = restart_delay
+        # Created before the first fork, so restarted workers inherit them too
+        self.channels = dict(((sender, receiver), HandoffChannel())
+            for sender in range(worker_count) for receiver in range(worker_count) if sender != receiver)
+        self.controls = [socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM) for i in range(worker_count)]
+        self.buffers = [''] * worker_count
+        self.workers = [None] * worker_count
+        self.restart_at = [None] * worker_count
+        self.restarts = 0
+        self.stopping = False
+
+    def link(self, index):
+        outgoing = dict((receiver, channel) for (sender, receiver), channel in self.channels.items() if sender == index)
+        incoming = [channel for (sender, receiver), channel in self.channels.items() if receiver == index]
+        return WorkerLink(index, self.worker_count, self.controller_count, outgoing, incoming, self.controls[index][1])
+
+    def start_worker(self, index):
+        # Daemonic, so that the workers are terminated when the supervisor exits
+        worker = multiprocessing.Process(target = self.worker_main, args = (index,), name = 'worker-{}'.format(index))
+        worker.daemon = True
+        worker.start()
+        self.workers[index] = worker
+        self.restart_at[index] = None
+        logger.info('Started worker {} (pid {})', index, worker.pid)
+
+    def worker_main(self, index):
+        """ Run a worker in the child process. Every channel is inherited from
+        the supervisor: the ends the worker does not use are closed, so that it
+        sees the end of its control connection when the supervisor dies. """
+        link = self.link(index)
+        used = set(sock.fileno() for sock in link.used_sockets())
+        sockets = [sock for channel in self.channels.values() for sock in (channel.sender, channel.receiver)]
+        sockets.extend(sock for pair in self.controls for sock in pair)
+        for sock in sockets:
+            if sock.fileno() not in used:
+                sock.close()
+        self.run_worker(link)
+
+    def run(self):
+        """ Start the workers and supervise them until stop() or a STOP_SERVER message """
+        logger.info('Starting {} workers for {} controller(s)', self.worker_count, self.controller_count)
+        for index in range(self.worker_count):
+            self.start_worker(index)
+        control_ends = dict((pair[0].fileno(), index) for index, pair in enumerate(self.controls))
+        try:
+            while not self.stopping:
+                try:
+                    ready = select.select(control_ends.keys(), [], [], 0.5)[0]
+                except select.error as err:
+                    if err.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for fd in ready:
+                    self.on_control(control_ends[fd])
+                self.check_workers()
+        finally:
+            self.stop()
+
+    def check_workers(self):
+        """ Restart the workers that exited, after restart_delay """
+        now = clock.monotonic()
+        for index, worker in enumerate(self.workers):
+            if worker.is_alive() or self.stopping:
+                continue
+            if self.restart_at[index] is None:
+                logger.warning('Worker {} exited with code {}, restarting it.', index, worker.exitcode)
+                self.restart_at[index] = now + self.restart_delay
+            elif now >= self.restart_at[index]:
+                self.restarts += 1
+                self.start_worker(index)
+
+    def on_control(self, index):
+        """ Handle the messages of a worker: forward control messages, or stop """
+        try:
+            data = self.controls[index][0].recv(4096)
+        except socket.error:
+            return
+        lines = (self.buffers[index] + data).split('\n')
+        self.buffers[index] = lines.pop()
+        for line in lines:
+            try:
+                command = json.loads(line)
+            except ValueError:
+                continue
+            if command.get('stop'):
+                logger.info('Worker {} asked to stop the server', index)
+                self.stopping = True
+            elif 'forward' in command:
+                self.forward(command['forward'], command.get('client'))
+            elif 'release' in command:
+                for other in range(self.worker_count):
+                    if other != index:
+                        self.send(other, {'release': command['release']})
+
+    def forward(self, text, client = None):
+        """ Send a message to the worker owning its controller """
+        try:
+            controller_id = json.loads(text).get('controller')
+        except (ValueError, AttributeError):
+            return
+        if controller_id is None:
+            controller_id = DEFAULT_CONTROLLER
+        try:
+            owner = int(controller_id) % self.worker_count
+        except (TypeError, ValueError):
+            return
+        self.send(owner, {'message': text, 'client': client})
+
+    def send(self, index, command):
+        try:
+            self.controls[index][0].sendall(json.dumps(command) + '\n')
+        except socket.error as err:
+            logger.warning('Could not reach worker {}.', index, err = err)
+
+    def stop(self, timeout = 5.0):
+        """ Ask every worker to stop, and wait for them """
+        self.stopping = True
+        for index, worker in enumerate(self.workers):
+            if worker is not None and worker.is_alive():
+                self.send(index, {'stop': True})
+        for index, worker in enumerate(self.workers):
+            if worker is None:
+                continue
+            worker.join(timeout)
+            if worker.is_alive():
+                logger.warning('Worker {} did not stop, terminating it.', index)
+                worker.terminate()
+                worker.join()
+        self.workers = [None] * self.worker_count
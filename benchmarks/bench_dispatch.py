@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""
+Measure the number of events per second dispatched by Controller.handle_message,
+compared with the if/elif chain it replaced (legacy_handle_message below).
+The Controller uses a RecordingBackend, so no uinput device is needed.
+Usage: bench_dispatch.py [number_of_events]
+"""
+
+import sys
+import time
+
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), 'VCServer'))
+
+from VCCommon import message
+from VCCommon import VCLogger
+
+import backends
+import controller
+
+logger = VCLogger.Logger(VCLogger.Level.ALL)
+
+KEYS = ['a', 'z', 's', 'd', 'Key.left', 'Key.right', 'Key.up', 'Key.down']
+
+def legacy_handle_message(ctrl, msg):
+    """ Dispatch of Controller.on_client_event before the dispatch tables """
+    logger.info('Controller received message: {}'.format(msg.format_json()))
+    if msg.is_valid():
+        if msg.is_ok():
+            if msg.title == message.Titles.CONTROL:
+                pass
+            elif msg.title == message.Titles.EVENT:
+                in_key = msg.value.upper()
+                if msg.action == message.Actions.PRESSED:
+                    if not in_key in ctrl.keys:
+                        raise ValueError('Key {0} is not supported by this Controller.'.format(in_key))
+                    ctrl.device.emit(ctrl.keys[in_key], 1)
+                    logger.event_info('Sending uinput event: press key {} ({}).'.format(in_key, ctrl.keys[in_key]))
+                elif msg.action == message.Actions.RELEASED:
+                    if not in_key in ctrl.keys:
+                        raise ValueError('Key {0} is not supported by this Controller.'.format(in_key))
+                    ctrl.device.emit(ctrl.keys[in_key], 0)
+                    logger.event_info('Sending uinput event: release key {} ({}).'.format(in_key, ctrl.keys[in_key]))
+
+def make_events(count):
+    events = []
+    for i in range(count):
+        action = message.Actions.PRESSED if i % 2 == 0 else message.Actions.RELEASED
+        events.append(message.Message(
+            title = message.Titles.EVENT,
+            value = KEYS[(i // 2) % len(KEYS)],
+            action = action,
+            status = message.StatusCodes.OK,
+        ))
+    return events
+
+def run(name, handle, events):
+    start = time.time()
+    for msg in events:
+        handle(msg)
+    elapsed = time.time() - start
+    print '{:<8} {:>10.0f} events/s {:>8.2f} us/event'.format(name, len(events) / elapsed, elapsed * 1e6 / len(events))
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    # Measure the dispatch, not the terminal
+    VCLogger.configure(level = VCLogger.Level.WARNINGS)
+
+    ctrl = controller.Controller(name = 'bench', backend = lambda: backends.RecordingBackend(keep_events = False))
+    ctrl.open_device()
+    events = make_events(count)
+
+    run('legacy', lambda msg: legacy_handle_message(ctrl, msg), events)
+    run('tables', ctrl.handle_message, events)
+    ctrl.close_device()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""
+Compare the cost of parsing JSON messages and binary frames.
+Usage: bench_message.py [number_of_events]
+"""
+
+import sys
+import time
+
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from VCCommon import binary_message
+from VCCommon import message
+
+KEYS = ['A', 'Z', 'S', 'D', 'KEY.LEFT', 'KEY.RIGHT', 'KEY.UP', 'KEY.DOWN']
+CHUNK_SIZE = 4096
+
+def make_events(count):
+    events = []
+    for i in range(count):
+        action = message.Actions.PRESSED if i % 2 == 0 else message.Actions.RELEASED
+        events.append(message.Message(
+            title = message.Titles.EVENT,
+            value = KEYS[(i // 2) % len(KEYS)],
+            action = action,
+            status = message.StatusCodes.OK,
+        ))
+    return events
+
+def run(name, parser, stream, count):
+    """ Feed the stream to the parser in socket-sized chunks """
+    start = time.time()
+    parsed = 0
+    for offset in range(0, len(stream), CHUNK_SIZE):
+        parsed += len(parser.feed(stream[offset:offset + CHUNK_SIZE]))
+    elapsed = time.time() - start
+    assert parsed == count, '{}: parsed {} of {} messages'.format(name, parsed, count)
+    print '{:<8} {:>6} bytes/msg {:>10.0f} msg/s {:>8.2f} us/msg'.format(
+        name, len(stream) // count, count / elapsed, elapsed * 1e6 / count)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    events = make_events(count)
+    json_stream = ''.join(msg.format_frame() for msg in events)
+    binary_stream = ''.join(binary_message.encode_message(msg) for msg in events)
+
+    run('json', message.MessageParser(), json_stream, count)
+    run('binary', binary_message.BinaryParser(), binary_stream, count)
+
+if __name__ == "__main__":
+    main()
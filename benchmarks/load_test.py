@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+"""
+Load test of the whole server: a ControllerHub with RecordingBackend devices
+receives key streams from N simulated clients, for several client counts and
+message formats. Clients are separate processes replaying realistic streams:
+    autorepeat  a key held down, repeated by the keyboard, then released
+    chord       several keys pressed together, then released
+    taps        rapid press / release of single keys
+Each case reports the sustained events/s handled by the Controllers, the CPU
+time of the server process per event, and the latency percentiles measured
+by the server (see VCServer/latency.py). Results are printed and can be
+written as JSON to compare runs.
+With --unix-socket, clients connect through a Unix domain socket instead of TCP.
+The real-time options of the server (--net-cpus, --emit-cpus, --rt-priority,
+--busy-poll, see VCServer/realtime.py) are available too; --background-load
+runs processes spinning on every core meanwhile, like an emulator saturating
+the CPU. Compare runs with and without them to measure their effect.
+Usage: load_test.py [--clients 1,4,16] [--formats JSON,BINARY] [--duration 3] [--output results.json]
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import time
+
+from os import path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), 'VCServer'))
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), 'VCClient'))
+
+from VCCommon import clock
+from VCCommon import message
+from VCCommon import VCLogger
+
+import backends
+import controller
+import hub
+import latency
+import realtime
+from connection import Connection
+
+KEYS = ['a', 'z', 's', 'd', 'Key.left', 'Key.right', 'Key.up', 'Key.down', 'Key.enter', 'Key.space']
+PATTERNS = ['autorepeat', 'chord', 'taps']
+
+def autorepeat_steps(rng):
+    """ Hold a key down for 10 to 30 keyboard repeats, then release it """
+    key = rng.choice(KEYS)
+    steps = [(key, message.Actions.PRESSED)] * rng.randint(10, 30)
+    return steps + [(key, message.Actions.RELEASED)]
+
+def chord_steps(rng):
+    """ Press 2 to 4 keys together, then release them """
+    keys = rng.sample(KEYS, rng.randint(2, 4))
+    return ([(key, message.Actions.PRESSED) for key in keys]
+        + [(key, message.Actions.RELEASED) for key in reversed(keys)])
+
+def tap_steps(rng):
+    key = rng.choice(KEYS)
+    return [(key, message.Actions.PRESSED), (key, message.Actions.RELEASED)]
+
+STEPS = {
+    'autorepeat': autorepeat_steps,
+    'chord': chord_steps,
+    'taps': tap_steps,
+}
+
+def key_stream(pattern, seed):
+    """ Yield an endless stream of (key, action) events of a pattern """
+    rng = random.Random(seed)
+    make_steps = STEPS[pattern]
+    while True:
+        for step in make_steps(rng):
+            yield step
+
+def run_client(port, unix_path, protocol, controller_id, pattern, duration, rate, seed, go, results):
+    """ Send a key stream to the server for duration seconds, at rate events/s
+    (as fast as possible if rate is 0), and put the counters in results. """
+    VCLogger.configure(level = VCLogger.Level.WARNINGS, asynchronous = False)
+    conn = Connection('127.0.0.1', port, protocol, controller_id, buffer_size = 4096, timestamps = True,
+        unix_path = unix_path)
+    go.wait()
+    conn.connect()
+    conn.start()
+
+    sent = 0
+    start = clock.monotonic()
+    end = start + duration
+    for key, action in key_stream(pattern, seed):
+        now = clock.monotonic()
+        if now >= end:
+            break
+        if rate:
+            # Send the events that are due, then sleep until the next one
+            due = start + sent / float(rate)
+            if due > now:
+                time.sleep(due - now)
+        conn.send_key(key, action)
+        sent += 1
+    conn.close()
+    results.put({'sent': sent, 'dropped': conn.dropped})
+
+def spin(stop):
+    """ Burn a CPU until stop is set, as a background load """
+    while not stop.is_set():
+        for i in xrange(10000):
+            pass
+
+def wait_until_drained(server, timeout = 5.0):
+    """ Wait until the Controllers stop receiving messages and the queue is empty """
+    deadline = clock.monotonic() + timeout
+    handled = -1
+    while clock.monotonic() < deadline:
+        current = sum(ctrl.counters.messages for ctrl in server.controllers)
+        if current == handled and server.emitter.queue.depth() == 0:
+            return
+        handled = current
+        time.sleep(0.05)
+
+def cpu_time():
+    """ User and system CPU time of this process (the server), in seconds """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def run_case(protocol, client_count, args, port):
+    """ Run the server and client_count clients with the given protocol, and return the results """
+    controllers = [controller.Controller(
+        name = 'Player {}'.format(i + 1),
+        device_name = 'load_test_{}'.format(i + 1),
+        backend = lambda: backends.RecordingBackend(keep_events = False),
+    ) for i in range(args.players)]
+    network_realtime, emitter_realtime = [realtime.RealtimeConfig(cpus, args.rt_priority, args.busy_poll / 1e6)
+        for cpus in (args.net_cpus, args.emit_cpus)]
+    server = hub.ControllerHub(controllers, port = port, max_clients = client_count,
+        queue_size = args.queue_size, latency = True, unix_path = args.unix_socket,
+        network_realtime = network_realtime if network_realtime.is_enabled() else None,
+        emitter_realtime = emitter_realtime if emitter_realtime.is_enabled() else None)
+
+    # Clients are forked before the server threads start
+    go = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target = run_client, args = (
+        port, args.unix_socket, protocol, i % args.players, PATTERNS[i % len(PATTERNS)],
+        args.duration, args.rate, args.seed + i, go, results,
+    )) for i in range(client_count)]
+    for client in clients:
+        client.start()
+    stop_load = multiprocessing.Event()
+    load = [multiprocessing.Process(target = spin, args = (stop_load,)) for i in range(args.background_load)]
+    for process in load:
+        process.start()
+
+    server.start()
+    try:
+        time.sleep(0.2)
+        start_cpu = cpu_time()
+        start = clock.monotonic()
+        go.set()
+        client_results = [results.get() for client in clients]
+        for client in clients:
+            client.join()
+        wait_until_drained(server)
+        elapsed = clock.monotonic() - start
+        cpu = cpu_time() - start_cpu
+
+        handled = sum(ctrl.counters.messages for ctrl in controllers)
+        device_events = sum(ctrl.device.event_count for ctrl in controllers)
+        stages = {}
+        for ctrl in controllers:
+            for stage, hist in server.latency.controllers.get(ctrl.name, {}).items():
+                if stage not in stages:
+                    stages[stage] = latency.Histogram()
+                stages[stage].merge(hist)
+    finally:
+        stop_load.set()
+        for process in load:
+            process.join()
+        server.stop()
+        server.join()
+
+    return {
+        'protocol': protocol,
+        'transport': 'unix' if args.unix_socket else 'tcp',
+        'clients': client_count,
+        'players': args.players,
+        'elapsed': elapsed,
+        'sent': sum(result['sent'] for result in client_results),
+        'client_dropped': sum(result['dropped'] for result in client_results),
+        'handled': handled,
+        'device_events': device_events,
+        'events_per_second': handled / elapsed,
+        'cpu_seconds': cpu,
+        'cpu_us_per_event': cpu / handled * 1e6 if handled else None,
+        'queue': server.queue_stats(),
+        'latency_ms': dict((stage, hist.summary()) for stage, hist in stages.items()),
+        'background_load': args.background_load,
+        'realtime': server.realtime_stats(),
+    }
+
+def print_result(result):
+    total = result['latency_ms'].get('total', {})
+    print '{:<7} {:>4} clients {:>10.0f} events/s {:>8.2f} us CPU/event   latency p50 {:>7.3f} p99 {:>7.3f} max {:>8.3f} ms   dropped {}'.format(
+        result['protocol'], result['clients'], result['events_per_second'],
+        result['cpu_us_per_event'] or 0, total.get('p50', 0), total.get('p99', 0), total.get('max', 0),
+        result['client_dropped'] + result['queue']['dropped'])
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'Load test of the VirtualController server')
+    parser.add_argument('--clients', default = '1,4,16',
+        help = 'comma separated numbers of clients to run (default: 1,4,16)')
+    parser.add_argument('--formats', default = ','.join([message.Protocols.JSON, message.Protocols.BINARY]),
+        help = 'comma separated message formats (default: JSON,BINARY)')
+    parser.add_argument('--duration', type = float, default = 3,
+        help = 'seconds each client sends events (default: 3)')
+    parser.add_argument('--rate', type = float, default = 0,
+        help = 'events/s sent by each client, 0 for as fast as possible (default: 0)')
+    parser.add_argument('--players', type = int, default = 1,
+        help = 'number of controllers hosted by the server (default: 1)')
+    parser.add_argument('--queue-size', type = int, default = 1024,
+        help = 'size of the queue between the network and the devices (default: 1024)')
+    parser.add_argument('--port', type = int, default = 2111,
+        help = 'first TCP port used by the server, one per case (default: 2111)')
+    parser.add_argument('--unix-socket',
+        help = 'connect the clients to a Unix domain socket at this path instead of TCP')
+    parser.add_argument('--net-cpus', type = realtime.parse_cpus,
+        help = 'pin the socket server thread to these CPUs')
+    parser.add_argument('--emit-cpus', type = realtime.parse_cpus,
+        help = 'pin the emitter thread to these CPUs')
+    parser.add_argument('--rt-priority', type = int, default = 0,
+        help = 'SCHED_FIFO priority of the socket server and emitter threads (default: 0, normal scheduler)')
+    parser.add_argument('--busy-poll', type = float, default = 0, metavar = 'US',
+        help = 'microseconds the server threads poll before blocking (default: 0)')
+    parser.add_argument('--background-load', type = int, default = 0, metavar = 'N',
+        help = 'run N processes burning a CPU each during the test (default: 0)')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', help = 'write the results to this JSON file')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    VCLogger.configure(level = VCLogger.Level.WARNINGS, asynchronous = False)
+
+    cases = itertools.product(args.formats.split(','), [int(count) for count in args.clients.split(',')])
+    results = []
+    for i, (protocol, client_count) in enumerate(cases):
+        result = run_case(protocol, client_count, args, args.port + i)
+        print_result(result)
+        results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'monotonic_clock': clock.IS_MONOTONIC,
+                'args': vars(args),
+                'results': results,
+            }, output, indent = 2, sort_keys = True)
+        print 'Results written to ' + args.output
+
+if __name__ == "__main__":
+    main()